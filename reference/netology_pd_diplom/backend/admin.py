@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.contrib import messages
 from backend.models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
-from .tasks import do_import, process_avatar, process_product_image
+    Contact, ConfirmEmailToken, ImportJob
+from backend.checkout import cancel_order, refresh_order_total, release_stock
+from backend.catalog_cache import bump_catalog_version
+from .tasks import start_import, process_avatar, process_product_image
 
 
 @admin.register(User)
@@ -41,17 +43,23 @@ class CustomUserAdmin(UserAdmin):
 
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin):
-    list_display = ('name', 'url', 'user', 'state')
+    list_display = ('name', 'url', 'user', 'state', 'refresh_interval', 'next_refresh_at', 'refresh_failures')
     search_fields = ('name', 'url', 'user__email')
     list_filter = ('state',)
 
     actions = ['import_products']
 
     def import_products(self, request, queryset):
+        started = 0
         for shop in queryset:
+            if not shop.url:
+                self.message_user(request, f"У магазина '{shop.name}' не указан URL для импорта.",
+                                  level=messages.WARNING)
+                continue
             # Запускаем задачу импорта для каждого выбранного магазина
-            do_import.delay(shop.id)
-        self.message_user(request, "Задача импорта запущена для выбранных магазинов.")
+            start_import(shop, 'admin', url=shop.url)
+            started += 1
+        self.message_user(request, f"Задача импорта запущена для выбранных магазинов: {started}.")
 
     import_products.short_description = "Импортировать товары для выбранных магазинов"
 
@@ -62,8 +70,36 @@ class CategoryAdmin(admin.ModelAdmin):
     search_fields = ('name',)
 
 
+class CatalogDeleteMixin:
+    """
+    Удаление товаров из админки увеличивает версии каталога. Это делается здесь, а не в post_delete:
+    приёмник удаления отключил бы быстрое каскадное удаление при импорте с заменой и удалении магазина
+    """
+    product_info_lookup = 'pk__in'
+
+    def _catalog_scopes(self, queryset):
+        product_infos = ProductInfo.objects.filter(**{self.product_info_lookup: queryset.values('pk')})
+        scopes = {'products'}
+        for shop_id, category_id in product_infos.values_list('shop_id', 'category_id').distinct():
+            scopes.add(f'shop:{shop_id}')
+            if category_id is not None:
+                scopes.add(f'category:{category_id}')
+        return scopes
+
+    def delete_model(self, request, obj):
+        scopes = self._catalog_scopes(type(obj).objects.filter(pk=obj.pk))
+        super().delete_model(request, obj)
+        bump_catalog_version(*scopes)
+
+    def delete_queryset(self, request, queryset):
+        scopes = self._catalog_scopes(queryset)
+        super().delete_queryset(request, queryset)
+        bump_catalog_version(*scopes)
+
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(CatalogDeleteMixin, admin.ModelAdmin):
+    product_info_lookup = 'product__in'
     list_display = ('name', 'category',)
     search_fields = ('name', 'category')
     list_filter = ('category',)
@@ -76,10 +112,10 @@ class ProductAdmin(admin.ModelAdmin):
 
 
 @admin.register(ProductInfo)
-class ProductInfoAdmin(admin.ModelAdmin):
-    list_display = ('product', 'shop', 'quantity', 'price', 'price_rrc')
+class ProductInfoAdmin(CatalogDeleteMixin, admin.ModelAdmin):
+    list_display = ('product', 'shop', 'quantity', 'price', 'price_rrc', 'is_active')
     search_fields = ('product__name', 'shop__name')
-    list_filter = ('shop',)
+    list_filter = ('shop', 'is_active')
 
 
 @admin.register(Parameter)
@@ -89,7 +125,8 @@ class ParameterAdmin(admin.ModelAdmin):
 
 
 @admin.register(ProductParameter)
-class ProductParameterAdmin(admin.ModelAdmin):
+class ProductParameterAdmin(CatalogDeleteMixin, admin.ModelAdmin):
+    product_info_lookup = 'product_parameters__in'
     list_display = ('product_info', 'parameter', 'value')
     search_fields = ('product_info__product__name', 'parameter__name', 'value')
     list_filter = ('parameter',)
@@ -97,17 +134,69 @@ class ProductParameterAdmin(admin.ModelAdmin):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'dt', 'state')
+    list_display = ('id', 'user', 'dt', 'state', 'total_sum', 'stock_reserved')
     search_fields = ('user__email', 'id')
+    readonly_fields = ('total_sum', 'stock_reserved')
     list_filter = ('state', 'dt')
 
+    actions = ['cancel_orders']
+
+    def get_readonly_fields(self, request, obj=None):
+        # остатки отменённого заказа уже возвращены, вернуть его в работу без нового резерва нельзя
+        if obj is not None and obj.state == 'canceled':
+            return (*self.readonly_fields, 'state')
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        """
+        При отмене заказа через форму возвращаем зарезервированные остатки; статус и флаг резерва берутся
+        из заблокированной строки в БД, а не из формы, которую могли открыть до оформления или отмены заказа.
+        Корзину в работу переводит только оформление покупателем (checkout), которое резервирует остатки.
+        """
+        with transaction.atomic():
+            previous = None
+            if change:
+                previous, obj.stock_reserved = Order.objects.select_for_update().filter(pk=obj.pk).values_list(
+                    'state', 'stock_reserved').first()
+                if previous == 'canceled' and obj.state != 'canceled':
+                    obj.state = previous
+                    self.message_user(request, f"Заказ {obj.pk} уже отменён, остатки возвращены: статус не изменён. "
+                                               f"Для повторной покупки оформите новый заказ.", messages.ERROR)
+                elif previous == 'basket' and obj.state not in ('basket', 'canceled'):
+                    obj.state = previous
+                    self.message_user(request, f"Заказ {obj.pk} - корзина без резерва остатков: статус не изменён. "
+                                               f"Корзину оформляет покупатель.", messages.ERROR)
+            super().save_model(request, obj, form, change)
+            if previous != 'canceled' and obj.state == 'canceled':
+                release_stock(obj.id)
+
+    def cancel_orders(self, request, queryset):
+        canceled = sum(cancel_order(order_id) for order_id in queryset.values_list('id', flat=True))
+        self.message_user(request, f"Отменено заказов: {canceled}, остатки возвращены.")
+
+    cancel_orders.short_description = "Отменить выбранные заказы"
+
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
-    list_display = ('order', 'product_info', 'quantity')
+    list_display = ('order', 'product_info', 'quantity', 'price')
     search_fields = ('order__id', 'product_info__product__name')
     list_filter = ('order',)
 
+    def _refresh_totals(self, order_ids):
+        # сумма корзины не хранится, пересчитываются только оформленные заказы
+        for order_id in Order.objects.filter(id__in=order_ids).exclude(state='basket').values_list('id', flat=True):
+            refresh_order_total(order_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self._refresh_totals([obj.order_id])
+
+    def delete_queryset(self, request, queryset):
+        order_ids = set(queryset.values_list('order_id', flat=True))
+        super().delete_queryset(request, queryset)
+        self._refresh_totals(order_ids)
+
 
 @admin.register(Contact)
 class ContactAdmin(admin.ModelAdmin):
@@ -115,6 +204,15 @@ class ContactAdmin(admin.ModelAdmin):
     search_fields = ('user__email', 'city', 'street', 'phone')
 
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'shop', 'source', 'state', 'goods_parsed', 'rows_written', 'inserted', 'updated',
+                    'removed', 'created_at', 'finished_at')
+    search_fields = ('shop__name', 'url', 'content_hash')
+    list_filter = ('state', 'source', 'shop')
+    readonly_fields = [field.name for field in ImportJob._meta.fields]
+
+
 @admin.register(ConfirmEmailToken)
 class ConfirmEmailTokenAdmin(admin.ModelAdmin):
     list_display = ('user', 'key', 'created_at',)
@@ -0,0 +1,180 @@
+"""
+Пакетные изменения корзины: все позиции проверяются одним запросом и записываются одной транзакцией,
+поэтому ошибка в любой позиции не оставляет корзину заполненной наполовину
+"""
+from django.conf import settings
+from django.db import transaction
+
+from backend.models import Order, OrderItem, ProductInfo
+
+
+class BasketError(Exception):
+    """
+    Ошибки в позициях запроса: список {'item': номер позиции в запросе, 'error': описание}
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def _positive_int(value):
+    return type(value) == int and value > 0
+
+
+def parse_add_items(items):
+    """
+    Позиции для добавления [{'product_info': ИД, 'quantity': количество}] -> {ИД товара: количество};
+    повторяющиеся товары складываются
+    """
+    if not isinstance(items, list):
+        raise BasketError([{'item': None, 'error': 'Ожидается список позиций'}])
+    quantities = {}
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not _positive_int(item.get('product_info')) \
+                or not _positive_int(item.get('quantity')):
+            errors.append({'item': index, 'error': 'Ожидаются целые положительные product_info и quantity'})
+            continue
+        quantities[item['product_info']] = quantities.get(item['product_info'], 0) + item['quantity']
+    if errors:
+        raise BasketError(errors)
+    return quantities
+
+
+def parse_update_items(items):
+    """
+    Новые количества позиций корзины [{'id': ИД позиции, 'quantity': количество}] -> {ИД позиции: количество}
+    """
+    if not isinstance(items, list):
+        raise BasketError([{'item': None, 'error': 'Ожидается список позиций'}])
+    quantities = {}
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not _positive_int(item.get('id')) or not _positive_int(item.get('quantity')):
+            errors.append({'item': index, 'error': 'Ожидаются целые положительные id и quantity'})
+            continue
+        quantities[item['id']] = item['quantity']
+    if errors:
+        raise BasketError(errors)
+    return quantities
+
+
+def parse_remove_items(items):
+    """
+    ИД удаляемых позиций: строка «1,2,3» или список чисел
+    """
+    if isinstance(items, str):
+        return [int(item_id) for item_id in items.split(',') if item_id.strip().isdigit()]
+    if isinstance(items, list):
+        return [item_id for item_id in items if _positive_int(item_id)]
+    raise BasketError([{'item': None, 'error': 'Ожидается список ИД позиций'}])
+
+
+def _check_products(quantities, items):
+    """
+    Одним запросом проверяет, что товары существуют и продаются в работающих магазинах
+    """
+    available = set(ProductInfo.objects.filter(
+        id__in=list(quantities), is_active=True, shop__state=True).values_list('id', flat=True))
+    errors = [{'item': index, 'error': f"Товар {item['product_info']} не найден или не продаётся"}
+              for index, item in enumerate(items) if item['product_info'] not in available]
+    if errors:
+        raise BasketError(errors)
+
+
+def get_basket(user_id, lock=False):
+    """
+    Корзина пользователя; с lock=True строка заказа блокируется до конца транзакции,
+    чтобы параллельные изменения корзины выполнялись по очереди
+    """
+    basket, _ = Order.objects.get_or_create(user_id=user_id, state='basket')
+    if lock:
+        Order.objects.select_for_update().filter(pk=basket.pk).exists()
+    return basket
+
+
+def add_items(basket, items):
+    """
+    Добавляет позиции в корзину: товар, который уже есть в корзине, увеличивает количество.
+    Возвращает (создано позиций, обновлено позиций). Вызывается внутри transaction.atomic.
+    """
+    quantities = parse_add_items(items)
+    if not quantities:
+        return 0, 0
+    _check_products(quantities, items)
+
+    existing = dict(OrderItem.objects.filter(order=basket, product_info_id__in=list(quantities)).values_list(
+        'product_info_id', 'quantity'))
+    # вставка с обновлением по ограничению unique_order_item
+    OrderItem.objects.bulk_create([
+        OrderItem(order=basket, product_info_id=product_info_id, quantity=existing.get(product_info_id, 0) + quantity)
+        for product_info_id, quantity in quantities.items()
+    ], batch_size=settings.IMPORT_BATCH_SIZE, update_conflicts=True, unique_fields=['order', 'product_info'],
+        update_fields=['quantity'])
+    return len(quantities) - len(existing), len(existing)
+
+
+def update_items(basket, items):
+    """
+    Меняет количество позиций корзины одним UPDATE ... CASE WHEN (bulk_update); позиции не из этой корзины
+    пропускаются. Возвращает число обновлённых позиций.
+    """
+    quantities = parse_update_items(items)
+    if not quantities:
+        return 0
+    order_items = list(OrderItem.objects.filter(order=basket, id__in=list(quantities)).only('id', 'quantity'))
+    for order_item in order_items:
+        order_item.quantity = quantities[order_item.id]
+    OrderItem.objects.bulk_update(order_items, ['quantity'], batch_size=settings.IMPORT_BATCH_SIZE)
+    return len(order_items)
+
+
+def remove_items(basket, items):
+    """
+    Удаляет позиции корзины одним запросом по id__in. Возвращает число удалённых позиций.
+    """
+    item_ids = parse_remove_items(items)
+    if not item_ids:
+        return 0
+    return OrderItem.objects.filter(order=basket, id__in=item_ids).delete()[0]
+
+
+def add_to_basket(user_id, items):
+    """
+    Добавление позиций в корзину пользователя одной транзакцией
+    """
+    with transaction.atomic():
+        basket = get_basket(user_id, lock=True)
+        return add_items(basket, items)
+
+
+def update_basket(user_id, items):
+    """
+    Изменение количества позиций корзины пользователя одной транзакцией
+    """
+    with transaction.atomic():
+        basket = get_basket(user_id, lock=True)
+        return update_items(basket, items)
+
+
+def remove_from_basket(user_id, items):
+    """
+    Удаление позиций из корзины пользователя одной транзакцией
+    """
+    with transaction.atomic():
+        basket = get_basket(user_id, lock=True)
+        return remove_items(basket, items)
+
+
+def sync_basket(user_id, add=None, update=None, remove=None):
+    """
+    Удаление, изменение и добавление позиций одним запросом клиента и одной транзакцией.
+    Возвращает {'created': ..., 'updated': ..., 'deleted': ...}.
+    """
+    with transaction.atomic():
+        basket = get_basket(user_id, lock=True)
+        deleted = remove_items(basket, remove) if remove else 0
+        updated = update_items(basket, update) if update else 0
+        created, merged = add_items(basket, add) if add else (0, 0)
+    return {'created': created, 'updated': updated + merged, 'deleted': deleted}
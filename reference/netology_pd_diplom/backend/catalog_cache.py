@@ -0,0 +1,133 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+from rest_framework.response import Response
+
+# Версии каталога в кеше, из них складываются ETag ответов:
+# base - магазины и категории (названия, статус магазина), в ETag каждого ответа каталога;
+# shop:<ИД> - товары магазина; category:<ИД> - товары и фасеты категории; products - весь список товаров
+CATALOG_VERSION_KEY = 'catalog-version:{}'
+CATALOG_RESPONSE_KEY = 'catalog-response:{}'
+
+
+def _bump(scopes):
+    for scope in scopes:
+        key = CATALOG_VERSION_KEY.format(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def bump_catalog_version(*scopes):
+    """
+    Увеличивает версии каталога: сразу и ещё раз после фиксации транзакции, чтобы ответы,
+    построенные до фиксации по старым данным, тоже устарели
+    """
+    _bump(scopes)
+    transaction.on_commit(lambda: _bump(scopes))
+
+
+def catalog_versions(scopes):
+    """
+    Текущие версии каталога одним запросом к кешу
+    """
+    keys = [CATALOG_VERSION_KEY.format(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # вытесненная из кеша версия начинается заново с текущего времени и не совпадает с прежними ETag
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key) for key in keys]
+
+
+def _id_param(request, name):
+    """
+    ИД из параметра запроса как число: «01» и «1» дают одну версию; некорректное значение - None
+    """
+    try:
+        return int(request.GET.get(name, ''))
+    except ValueError:
+        return None
+
+
+def product_scopes(request):
+    """
+    Версии, от которых зависит список товаров с фильтрами shop_id и category_id.
+    Без корректных фильтров - версия всего списка products, она увеличивается при любом изменении товаров.
+    """
+    shop_id = _id_param(request, 'shop_id')
+    category_id = _id_param(request, 'category_id')
+    scopes = ['base']
+    if shop_id is not None:
+        scopes.append(f'shop:{shop_id}')
+    if category_id is not None:
+        scopes.append(f'category:{category_id}')
+    if shop_id is None and category_id is None:
+        scopes.append('products')
+    return scopes
+
+
+def catalog_key(request, scopes=None, *extra):
+    """
+    Хеш запроса (путь и параметры без учёта порядка) вместе с текущими версиями каталога
+    """
+    versions = catalog_versions(scopes(request) if scopes else ['base'])
+    query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    raw = f"{request.path}|{query}|{'|'.join(extra)}|{versions}"
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def catalog_etag(scopes=None):
+    """
+    ETag из версий каталога и Cache-Control для CDN: на запрос с If-None-Match, совпадающим с ETag,
+    отдаётся 304 без обращения к БД. scopes(request) - список версий, по умолчанию только base.
+    Для классов: @method_decorator(catalog_etag(), name='get')
+    """
+
+    def etag(request, *args, **kwargs):
+        return catalog_key(request, scopes, request.META.get('HTTP_ACCEPT', ''))
+
+    def decorator(view):
+        # ответ зависит от Accept (JSON или Browsable API), общий кеш должен хранить варианты раздельно
+        return vary_on_headers('Accept')(
+            cache_control(public=True, max_age=settings.CATALOG_CACHE_MAX_AGE)(condition(etag_func=etag)(view)))
+
+    return decorator
+
+
+def cache_catalog_response(scopes=None):
+    """
+    Кеш данных успешных ответов каталога по параметрам запроса и версиям каталога: после увеличения версии
+    (импорт магазина, смена статуса) старые записи больше не читаются и вытесняются по таймауту.
+    Для классов: @method_decorator(cache_catalog_response(product_scopes), name='get')
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            timeout = settings.CATALOG_RESPONSE_CACHE_TIMEOUT
+            if not timeout:
+                return view(request, *args, **kwargs)
+            # ссылки next/previous абсолютные, поэтому схема и хост входят в ключ
+            key = CATALOG_RESPONSE_KEY.format(catalog_key(request, scopes, request.scheme, request.get_host()))
+            data = cache.get(key)
+            if data is not None:
+                return Response(data)
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, timeout)
+            return response
+
+        return wrapper
+
+    return decorator
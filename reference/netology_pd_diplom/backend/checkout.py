@@ -0,0 +1,141 @@
+"""
+Оформление и отмена заказов с резервированием остатков: количество товара уменьшается условным UPDATE
+(quantity >= заказанного), строки товаров блокируются всегда в порядке ИД, поэтому параллельные оформления
+не продают последнюю единицу дважды и не попадают во взаимную блокировку
+"""
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+
+from backend.catalog_cache import bump_catalog_version
+from backend.models import Contact, Order, OrderItem, ProductInfo
+
+# статусы, в которых остатки заказа зарезервированы
+RESERVED_STATES = ('new', 'confirmed', 'assembled', 'sent', 'delivered')
+# статусы, в которых покупатель может отменить заказ сам
+BUYER_CANCELABLE_STATES = ('new', 'confirmed')
+
+
+class CheckoutError(Exception):
+    """
+    Ошибки оформления: список {'product_info': ИД товара или None, 'error': описание}
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def _order_lines(order_id):
+    # порядок блокировки строк товаров - по ИД
+    return list(OrderItem.objects.filter(order_id=order_id).order_by('product_info_id').values_list(
+        'product_info_id', 'quantity'))
+
+
+def _stock_changed(product_info_ids):
+    """
+    Остатки товаров изменились - списки каталога с этими товарами устаревают
+    """
+    scopes = {'products'}
+    for shop_id, category_id in ProductInfo.objects.filter(id__in=product_info_ids).values_list(
+            'shop_id', 'category_id'):
+        scopes.add(f'shop:{shop_id}')
+        if category_id is not None:
+            scopes.add(f'category:{category_id}')
+    bump_catalog_version(*scopes)
+
+
+def snapshot_prices(items):
+    """
+    Фиксирует в позициях текущие цены товаров одним UPDATE
+    """
+    price = ProductInfo.objects.filter(pk=OuterRef('product_info_id')).values('price')[:1]
+    return items.update(price=Subquery(price))
+
+
+def refresh_order_total(order_id):
+    """
+    Фиксирует цены позиций, добавленных в оформленный заказ без цены (например, через админку),
+    и пересчитывает сохранённую сумму заказа
+    """
+    with transaction.atomic():
+        snapshot_prices(OrderItem.objects.filter(order_id=order_id, price__isnull=True))
+        Order.objects.filter(pk=order_id).update_total_sum()
+
+
+def checkout(user_id, order_id, contact_id):
+    """
+    Оформляет корзину order_id: резервирует остатки по каждой позиции, фиксирует цены и сумму
+    и переводит заказ в статус new.
+    Если хотя бы одной позиции не хватает, ничего не меняется и выбрасывается CheckoutError со всеми такими позициями.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(id=order_id, user_id=user_id, state='basket').first()
+        if order is None:
+            raise CheckoutError([{'product_info': None, 'error': 'Корзина не найдена'}])
+        if not Contact.objects.filter(id=contact_id, user_id=user_id).exists():
+            raise CheckoutError([{'product_info': None, 'error': 'Контакт не найден'}])
+        lines = _order_lines(order.id)
+        if not lines:
+            raise CheckoutError([{'product_info': None, 'error': 'Корзина пуста'}])
+
+        failed = []
+        for product_info_id, quantity in lines:
+            reserved = ProductInfo.objects.filter(
+                id=product_info_id, quantity__gte=quantity, is_active=True, shop__state=True).update(
+                quantity=F('quantity') - quantity)
+            if not reserved:
+                failed.append((product_info_id, quantity))
+        if failed:
+            # исключение откатывает уже сделанные резервы
+            available = dict(ProductInfo.objects.filter(
+                id__in=[product_info_id for product_info_id, _ in failed], is_active=True,
+                shop__state=True).values_list('id', 'quantity'))
+            raise CheckoutError([
+                {'product_info': product_info_id,
+                 'error': f'Недостаточно товара: заказано {quantity}, доступно {available.get(product_info_id, 0)}'}
+                for product_info_id, quantity in failed
+            ])
+
+        # цены и сумма фиксируются в той же транзакции, что и резерв
+        snapshot_prices(OrderItem.objects.filter(order_id=order.id))
+        Order.objects.filter(pk=order.id).update_total_sum()
+        order.state = 'new'
+        order.contact_id = contact_id
+        order.stock_reserved = True
+        order.save(update_fields=['state', 'contact', 'stock_reserved'])
+        _stock_changed([product_info_id for product_info_id, _ in lines])
+    return order
+
+
+def release_stock(order_id):
+    """
+    Возвращает зарезервированные остатки заказа (в том же порядке блокировки) и снимает флаг резерва.
+    Заказы без резерва (созданные не через checkout, в том числе до появления флага) остатки не меняют.
+    Вызывается внутри транзакции; возвращает False, если резерва не было.
+    """
+    if not Order.objects.filter(pk=order_id, stock_reserved=True).update(stock_reserved=False):
+        return False
+    lines = _order_lines(order_id)
+    for product_info_id, quantity in lines:
+        ProductInfo.objects.filter(id=product_info_id).update(quantity=F('quantity') + quantity)
+    _stock_changed([product_info_id for product_info_id, _ in lines])
+    return True
+
+
+def cancel_order(order_id, user_id=None, states=RESERVED_STATES):
+    """
+    Отменяет заказ в одном из статусов states и возвращает его остатки; с user_id - только заказ этого покупателя.
+    Возвращает False, если такого заказа нет.
+    """
+    with transaction.atomic():
+        orders = Order.objects.select_for_update().filter(id=order_id, state__in=states)
+        if user_id is not None:
+            orders = orders.filter(user_id=user_id)
+        order = orders.first()
+        if order is None:
+            return False
+        release_stock(order.id)
+        order.state = 'canceled'
+        order.stock_reserved = False
+        order.save(update_fields=['state', 'stock_reserved'])
+    return True
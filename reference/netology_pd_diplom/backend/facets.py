@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from backend.catalog_cache import bump_catalog_version
+from backend.models import Category, CategoryFacet, ProductParameter
+
+
+def refresh_category_facets(category_ids):
+    """
+    Пересчитывает фасеты категорий одним агрегирующим запросом по параметрам товаров в продаже
+    """
+    category_ids = sorted(category_ids)
+    if not category_ids:
+        return 0
+    with transaction.atomic():
+        # пересчёты одной категории из разных задач выполняются по очереди (блокировки строк в порядке ИД);
+        # агрегат считается после получения блокировки и видит последние зафиксированные импорты
+        list(Category.objects.select_for_update().filter(id__in=category_ids).order_by('id').values_list(
+            'id', flat=True))
+        rows = ProductParameter.objects.filter(
+            product_info__is_active=True, product_info__shop__state=True,
+            product_info__product__category_id__in=category_ids).values(
+            'product_info__product__category_id', 'parameter_id', 'value').annotate(count=Count('id')).order_by()
+        CategoryFacet.objects.filter(category_id__in=category_ids).delete()
+        facets = CategoryFacet.objects.bulk_create([
+            CategoryFacet(category_id=row['product_info__product__category_id'], parameter_id=row['parameter_id'],
+                          value=row['value'], count=row['count'])
+            for row in rows
+        ], batch_size=settings.IMPORT_BATCH_SIZE)
+    # фасеты отдаются вместе со списком товаров категории
+    bump_catalog_version(*[f'category:{category_id}' for category_id in category_ids])
+    return len(facets)
+
+
+def refresh_shop_facets(shop_id):
+    """
+    Пересчитывает фасеты всех категорий магазина
+    """
+    return refresh_category_facets(Category.objects.filter(shops=shop_id).values_list('id', flat=True))
+
+
+def category_facets(category_id):
+    """
+    Фасеты категории для боковой панели фильтров: {параметр: {значение: количество}}, один запрос
+    """
+    facets = {}
+    for name, value, count in CategoryFacet.objects.filter(category_id=category_id).order_by(
+            'parameter__name', '-count', 'value').values_list('parameter__name', 'value', 'count'):
+        facets.setdefault(name, {})[value] = count
+    return facets
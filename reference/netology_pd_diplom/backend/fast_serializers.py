@@ -0,0 +1,129 @@
+"""
+Быстрая сериализация списков только для чтения: словари ответа строятся из строк .values() без создания
+моделей и экземпляров ModelSerializer. Вывод совпадает с ProductInfoSerializer и OrderSerializer
+(см. тесты FastSerializerParityTestCase); при FAST_SERIALIZATION = False используются сами сериализаторы.
+"""
+from django.conf import settings
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+from backend.models import OrderItem, ProductParameter
+from backend.serializers import OrderSerializer, OrderSummarySerializer, ProductInfoSerializer, requested
+
+# поля ProductInfoSerializer без вложенных, в порядке вывода: поле ответа -> поле .values()
+PRODUCT_INFO_COLUMNS = {'id': 'id', 'model': 'model', 'shop': 'shop_id', 'quantity': 'quantity', 'price': 'price',
+                        'price_rrc': 'price_rrc'}
+PRODUCT_INFO_FIELDS = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_parameters')
+CONTACT_FIELDS = ('id', 'city', 'street', 'house', 'structure', 'building', 'apartment', 'phone')
+
+
+def _product_parameters(product_info_ids, fields):
+    """
+    Параметры товаров одним запросом: {ИД ProductInfo: [{'parameter': ..., 'value': ...}]}
+    """
+    names = [name for name in ('parameter', 'value') if requested(fields, f'product_parameters.{name}')]
+    parameters = {}
+    for product_info_id, parameter, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).order_by('id').values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        row = {'parameter': parameter, 'value': value}
+        parameters.setdefault(product_info_id, []).append({name: row[name] for name in names})
+    return parameters
+
+
+def product_info_rows(queryset, fields=None, ordering=()):
+    """
+    Queryset каталога для product_infos_data: строки .values() с нужными колонками
+    (и полями сортировки для курсора) или модели со связями для ProductInfoSerializer
+    """
+    if not settings.FAST_SERIALIZATION:
+        return ProductInfoSerializer.setup_queryset(queryset, fields)
+    columns = {'id'} | {column for name, column in PRODUCT_INFO_COLUMNS.items() if requested(fields, name)}
+    if requested(fields, 'product.name'):
+        columns.add('product__name')
+    if requested(fields, 'product.category'):
+        columns.add('product__category__name')
+    columns.update(field.lstrip('-') for field in ordering)
+    return queryset.values(*columns)
+
+
+def product_infos_data(rows, fields=None):
+    """
+    Данные ответа для страницы каталога из product_info_rows
+    """
+    if not settings.FAST_SERIALIZATION:
+        return ProductInfoSerializer(rows, many=True, fields=fields).data
+
+    names = [name for name in PRODUCT_INFO_FIELDS if requested(fields, name)]
+    product_names = [name for name in ('name', 'category') if requested(fields, f'product.{name}')]
+    parameters = {}
+    if 'product_parameters' in names:
+        parameters = _product_parameters([row['id'] for row in rows], fields)
+
+    data = []
+    for row in rows:
+        item = {}
+        for name in names:
+            if name == 'product':
+                product = {'name': row.get('product__name'), 'category': row.get('product__category__name')}
+                item[name] = {product_name: product[product_name] for product_name in product_names}
+            elif name == 'product_parameters':
+                item[name] = parameters.get(row['id'], [])
+            else:
+                item[name] = row[PRODUCT_INFO_COLUMNS[name]]
+        data.append(item)
+    return data
+
+
+def ordered_by_ids(rows, ids):
+    """
+    Строки rows в порядке ids (например, по релевантности поиска)
+    """
+    by_id = {row['id'] if isinstance(row, dict) else row.pk: row for row in rows}
+    return [by_id[pk] for pk in ids if pk in by_id]
+
+
+def orders_data(orders, items=None, total='total_sum', summary=False):
+    """
+    Данные ответа для списка заказов; items - позиции, которые попадают в ordered_items
+    (по умолчанию все позиции заказа), total - поле или аннотация с суммой для total_sum.
+    С summary=True - только сводка по заказам, без ordered_items и без запроса позиций.
+    """
+    items = (items if items is not None else OrderItem.objects.all()).order_by('id')
+    if not settings.FAST_SERIALIZATION:
+        orders = orders.select_related('contact')
+        if not summary:
+            orders = orders.prefetch_related(Prefetch('ordered_items', queryset=items))
+        orders = list(orders)
+        for order in orders:
+            order.total_sum = getattr(order, total)
+        return (OrderSummarySerializer if summary else OrderSerializer)(orders, many=True).data
+
+    rows = list(orders.values('id', 'state', 'dt', total, 'contact_id',
+                              *[f'contact__{name}' for name in CONTACT_FIELDS[1:]]))
+    ordered_items = {}
+    if not summary:
+        for item in items.filter(order_id__in=[row['id'] for row in rows]).values(
+                'id', 'order_id', 'product_info_id', 'quantity'):
+            ordered_items.setdefault(item['order_id'], []).append(
+                {'id': item['id'], 'product_info': item['product_info_id'], 'quantity': item['quantity']})
+
+    # дата в том же формате и часовом поясе, что и в DRF
+    dt_field = serializers.DateTimeField()
+    data = []
+    for row in rows:
+        contact = None
+        if row['contact_id'] is not None:
+            contact = {'id': row['contact_id']}
+            contact.update((name, row[f'contact__{name}']) for name in CONTACT_FIELDS[1:])
+        order = {'id': row['id']}
+        if not summary:
+            order['ordered_items'] = ordered_items.get(row['id'], [])
+        order.update({
+            'state': row['state'],
+            'dt': dt_field.to_representation(row['dt']),
+            'total_sum': row[total],
+            'contact': contact,
+        })
+        data.append(order)
+    return data
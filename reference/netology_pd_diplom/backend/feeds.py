@@ -0,0 +1,418 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import time
+import zlib
+
+import requests
+import yaml
+from django.conf import settings
+from yaml.events import (AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent, SequenceEndEvent,
+                         SequenceStartEvent)
+from yaml.nodes import ScalarNode
+
+try:
+    # C-реализация libyaml в разы быстрее чистого Python
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    from yaml import SafeLoader as FeedLoader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ошибки распаковки и декодирования повреждённого прайс-листа
+CORRUPT_FEED_ERRORS = (gzip.BadGzipFile, EOFError, zlib.error, UnicodeDecodeError)
+if zstandard is not None:
+    CORRUPT_FEED_ERRORS += (zstandard.ZstdError,)
+
+# секции прайс-листа, которые отдаются пачками
+FEED_SECTIONS = ('categories', 'goods')
+
+FEED_FORMAT_YAML = 'yaml'
+FEED_FORMAT_JSONL = 'jsonl'
+FEED_FORMAT_CSV = 'csv'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# сколько байт прайс-листа читается для определения формата
+SNIFF_SIZE = 64 * 1024
+
+# числовые поля товара в CSV, параметры передаются в колонках parameters.<название>
+CSV_INT_FIELDS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+CSV_PARAMETER_PREFIX = 'parameters.'
+
+
+class FeedFormatError(ValueError):
+    """
+    Прайс-лист не соответствует формату shop1.yaml
+    """
+
+
+class FeedDownloadError(Exception):
+    """
+    Прайс-лист не удалось загрузить: превышен размер или время загрузки
+    """
+
+
+class FeedNotModified(Exception):
+    """
+    Прайс-лист не изменился с прошлой загрузки (ответ 304 Not Modified)
+    """
+
+
+class YamlFeedReader:
+    """
+    Потоковое чтение прайс-листа в формате shop1.yaml.
+
+    Документ разбирается по событиям парсера, в памяти одновременно держится не больше одной
+    пачки из chunk_size категорий или товаров, а не весь граф объектов документа.
+    """
+
+    def __init__(self, stream, chunk_size):
+        self.loader = FeedLoader(stream)
+        self.chunk_size = chunk_size
+        self._anchors = {}
+
+    def __iter__(self):
+        """
+        Выдаёт пары (секция, значение): ('shop', название) и ('categories' | 'goods', список)
+        """
+        try:
+            self._expect(yaml.StreamStartEvent)
+            if self.loader.check_event(yaml.StreamEndEvent):
+                return
+            self._expect(yaml.DocumentStartEvent)
+            if not self.loader.check_event(MappingStartEvent):
+                raise FeedFormatError('Прайс-лист должен быть словарём с ключами shop, categories и goods')
+            self.loader.get_event()
+
+            while not self.loader.check_event(MappingEndEvent):
+                key = self._build()
+                if key in FEED_SECTIONS and self.loader.check_event(SequenceStartEvent):
+                    yield from self._iter_sequence(key)
+                else:
+                    value = self._build()
+                    if key == 'shop':
+                        yield 'shop', value
+        finally:
+            self.loader.dispose()
+
+    def _iter_sequence(self, section):
+        self.loader.get_event()
+        chunk = []
+        while not self.loader.check_event(SequenceEndEvent):
+            chunk.append(self._build())
+            if len(chunk) >= self.chunk_size:
+                yield section, chunk
+                chunk = []
+        self.loader.get_event()
+        if chunk:
+            yield section, chunk
+
+    def _expect(self, event_class):
+        event = self.loader.get_event()
+        if not isinstance(event, event_class):
+            raise FeedFormatError(f'Неожиданное событие YAML: {event}')
+        return event
+
+    def _build(self):
+        """
+        Собирает одно значение (скаляр, словарь или список) из очередных событий парсера
+        """
+        event = self.loader.get_event()
+        if isinstance(event, ScalarEvent):
+            value = self._construct_scalar(event)
+        elif isinstance(event, MappingStartEvent):
+            value = {}
+            self._remember(event, value)
+            while not self.loader.check_event(MappingEndEvent):
+                key = self._build()
+                value[key] = self._build()
+            self.loader.get_event()
+            return value
+        elif isinstance(event, SequenceStartEvent):
+            value = []
+            self._remember(event, value)
+            while not self.loader.check_event(SequenceEndEvent):
+                value.append(self._build())
+            self.loader.get_event()
+            return value
+        elif isinstance(event, AliasEvent):
+            if event.anchor not in self._anchors:
+                raise FeedFormatError(f'Неизвестная ссылка YAML: {event.anchor}')
+            return self._anchors[event.anchor]
+        else:
+            raise FeedFormatError(f'Неожиданное событие YAML: {event}')
+
+        self._remember(event, value)
+        return value
+
+    def _construct_scalar(self, event):
+        # тип скаляра определяется так же, как в yaml.safe_load: числа, bool, null и строки
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = self.loader.resolve(ScalarNode, event.value, event.implicit)
+        constructor = self.loader.yaml_constructors.get(tag)
+        if constructor is None:
+            return event.value
+        return constructor(self.loader, ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style))
+
+    def _remember(self, event, value):
+        if event.anchor is not None:
+            self._anchors[event.anchor] = value
+
+
+class JsonLinesFeedReader:
+    """
+    Потоковое чтение прайс-листа в формате JSON Lines: одна запись на строку,
+    тип записи в поле type - shop, category или good, остальные поля как в shop1.yaml:
+
+        {"type": "shop", "name": "Связной"}
+        {"type": "category", "id": 224, "name": "Смартфоны"}
+        {"type": "good", "id": 4216292, "category": 224, "name": "...", "price": 110000, ...}
+    """
+    sections = {'category': 'categories', 'good': 'goods'}
+
+    def __init__(self, stream, chunk_size):
+        self.stream = io.TextIOWrapper(stream, encoding='utf-8-sig')
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        section, chunk = None, []
+        for line_number, line in enumerate(self.stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise FeedFormatError(f'Строка {line_number}: {e}')
+            if not isinstance(record, dict):
+                raise FeedFormatError(f'Строка {line_number}: запись должна быть объектом')
+
+            record_type = record.pop('type', None)
+            if record_type == 'shop':
+                yield 'shop', record.get('name')
+                continue
+            if record_type not in self.sections:
+                raise FeedFormatError(f'Строка {line_number}: неизвестный тип записи {record_type}')
+
+            if chunk and (self.sections[record_type] != section or len(chunk) >= self.chunk_size):
+                yield section, chunk
+                chunk = []
+            section = self.sections[record_type]
+            chunk.append(record)
+        if chunk:
+            yield section, chunk
+
+
+class CsvFeedReader:
+    """
+    Потоковое чтение прайс-листа в формате CSV: одна строка на товар, колонки
+    id, category, category_name, name, model, price, price_rrc, quantity и parameters.<название> для параметров.
+    Категории собираются из колонок category и category_name.
+    """
+
+    def __init__(self, stream, chunk_size):
+        self.stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        self.chunk_size = chunk_size
+        self._categories = set()
+
+    def __iter__(self):
+        header = self.stream.readline()
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        reader = csv.DictReader(self.stream, fieldnames=next(csv.reader([header], delimiter=delimiter)),
+                                delimiter=delimiter)
+        chunk = []
+        try:
+            for row in reader:
+                # заголовок прочитан отдельно, поэтому номер строки файла на единицу больше
+                chunk.append(self._good(row, reader.line_num + 1))
+                if len(chunk) >= self.chunk_size:
+                    yield from self._flush(chunk)
+                    chunk = []
+        except csv.Error as e:
+            raise FeedFormatError(f'Строка {reader.line_num + 1}: {e}')
+        if chunk:
+            yield from self._flush(chunk)
+
+    def _good(self, row, line_number):
+        good = {'parameters': {}}
+        for column, value in row.items():
+            if column is None or value is None or value == '':
+                continue
+            if column.startswith(CSV_PARAMETER_PREFIX):
+                good['parameters'][column[len(CSV_PARAMETER_PREFIX):]] = value
+            elif column in CSV_INT_FIELDS:
+                try:
+                    good[column] = int(value)
+                except ValueError:
+                    raise FeedFormatError(f'Строка {line_number}: {column} должно быть числом, получено {value!r}')
+            else:
+                good[column] = value
+        return good
+
+    def _flush(self, goods):
+        # новые категории отдаются перед товарами, которые на них ссылаются
+        categories = []
+        for good in goods:
+            category_name = good.pop('category_name', None)
+            if category_name and good.get('category') not in self._categories:
+                self._categories.add(good['category'])
+                categories.append({'id': good['category'], 'name': category_name})
+        if categories:
+            yield 'categories', categories
+        yield 'goods', goods
+
+
+FEED_READERS = {
+    FEED_FORMAT_YAML: YamlFeedReader,
+    FEED_FORMAT_JSONL: JsonLinesFeedReader,
+    FEED_FORMAT_CSV: CsvFeedReader,
+}
+
+
+class PrefixedStream(io.RawIOBase):
+    """
+    Поток, в начало которого возвращены уже прочитанные для определения формата байты.
+    Позволяет заглянуть в начало несжатого или распаковываемого потока без перемотки.
+    Если задан limit, чтение больше limit байт прерывается ошибкой (защита от «zip-бомб»).
+    """
+
+    def __init__(self, head, stream, limit=None):
+        self.head = head
+        self.stream = stream
+        self.limit = limit
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            data, self.head = self.head[:len(buffer)], self.head[len(buffer):]
+        else:
+            data = self.stream.read(len(buffer))
+        self.bytes_read += len(data)
+        if self.limit is not None and self.bytes_read > self.limit:
+            raise FeedFormatError(f'Размер распакованного прайс-листа превышает {self.limit} байт')
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def peek(stream, size, limit=None):
+    """
+    Читает начало потока; возвращает прочитанные байты и поток, который снова начинается с них
+    """
+    head = stream.read(size)
+    return head, io.BufferedReader(PrefixedStream(head, stream, limit=limit))
+
+
+def decompress(stream):
+    """
+    Распознаёт сжатие gzip или zstd по сигнатуре и возвращает поток с распакованными данными
+    """
+    head, stream = peek(stream, len(ZSTD_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif head.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise FeedFormatError('Для прайс-листов, сжатых zstd, требуется пакет zstandard')
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    else:
+        return stream
+    _, stream = peek(stream, 0, limit=settings.IMPORT_MAX_UNPACKED_SIZE)
+    return stream
+
+
+def detect_format(head):
+    """
+    Определяет формат прайс-листа по его началу: JSON Lines, CSV или YAML
+    """
+    # пустые строки и комментарии YAML («# прайс-лист, выгрузка 01.01.2024») не определяют формат
+    lines = (line.strip() for line in head.lstrip(b'\xef\xbb\xbf').split(b'\n'))
+    first_line = next((line for line in lines if line and not line.startswith(b'#')), b'')
+    if first_line.startswith(b'{'):
+        try:
+            record = json.loads(first_line)
+        except ValueError:
+            record = None
+        # JSON-документ целиком тоже корректный YAML, JSON Lines отличаются полем type в каждой строке
+        if isinstance(record, dict) and 'type' in record:
+            return FEED_FORMAT_JSONL
+    elif b':' not in first_line and (b',' in first_line or b';' in first_line):
+        return FEED_FORMAT_CSV
+    return FEED_FORMAT_YAML
+
+
+def iter_feed(stream, chunk_size):
+    """
+    Потоково разбирает прайс-лист из файлового объекта или байтов.
+
+    Сжатие (gzip, zstd) и формат (YAML, JSON Lines, CSV) определяются автоматически по содержимому,
+    распаковка и разбор идут потоком, все форматы отдают одинаковые пары (секция, значение).
+    """
+    if isinstance(stream, str):
+        stream = stream.encode()
+    if isinstance(stream, bytes):
+        stream = io.BytesIO(stream)
+    try:
+        head, stream = peek(decompress(stream), SNIFF_SIZE)
+        yield from FEED_READERS[detect_format(head)](stream, chunk_size)
+    except CORRUPT_FEED_ERRORS as e:
+        raise FeedFormatError(f'Повреждённый прайс-лист: {e}')
+
+
+def download_feed(url, on_progress=None, etag=None, last_modified=None):
+    """
+    Скачивает прайс-лист во временный файл с таймаутами и ограничением размера.
+
+    Возвращает открытый временный файл, установленный на начало (файл удаляется при закрытии),
+    SHA-256 его содержимого и валидаторы ответа {'etag': ..., 'last_modified': ...}.
+    on_progress вызывается с количеством уже загруженных байт.
+
+    Если переданы etag/last_modified прошлой загрузки, запрос делается условным и при ответе
+    304 Not Modified выбрасывается FeedNotModified.
+    """
+    max_size = settings.IMPORT_MAX_FEED_SIZE
+    deadline = time.monotonic() + settings.IMPORT_FETCH_DEADLINE
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    feed_file = tempfile.TemporaryFile()
+    content_hash = hashlib.sha256()
+    try:
+        with requests.get(url, stream=True, headers=headers,
+                          timeout=(settings.IMPORT_CONNECT_TIMEOUT, settings.IMPORT_READ_TIMEOUT)) as response:
+            if response.status_code == 304:
+                raise FeedNotModified(url)
+            response.raise_for_status()
+            validators = {'etag': response.headers.get('ETag', ''),
+                          'last_modified': response.headers.get('Last-Modified', '')}
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > max_size:
+                raise FeedDownloadError(f'Размер прайс-листа превышает {max_size} байт')
+
+            bytes_read = 0
+            for block in response.iter_content(chunk_size=64 * 1024):
+                bytes_read += len(block)
+                if bytes_read > max_size:
+                    raise FeedDownloadError(f'Размер прайс-листа превышает {max_size} байт')
+                if time.monotonic() > deadline:
+                    raise FeedDownloadError('Превышено время загрузки прайс-листа')
+                feed_file.write(block)
+                content_hash.update(block)
+                if on_progress:
+                    on_progress(bytes_read)
+    except BaseException:
+        feed_file.close()
+        raise
+
+    feed_file.seek(0)
+    return feed_file, content_hash.hexdigest(), validators
@@ -0,0 +1,204 @@
+import datetime
+import re
+
+from django.db.models import Exists, F, FilteredRelation, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from backend.models import STATE_CHOICES, Parameter, ProductParameter
+
+# фильтры по параметрам товара: ?param[Цвет]=черный&param[Цвет]=белый,
+# по диапазону числового значения: ?param_min[Диагональ (дюйм)]=6&param_max[Диагональ (дюйм)]=7
+PARAMETER_FILTER_RE = re.compile(r'^(param|param_min|param_max)\[(.+)\]$')
+# сортировка по числовому параметру: ?ordering=param:Встроенная память (Гб), по убыванию - с «-»
+PARAMETER_ORDERING_PREFIX = 'param:'
+# сортировка по полям ProductInfo: ?ordering=price, ?ordering=-quantity
+ORDERING_FIELDS = ('price', 'quantity')
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+# статусы оформленных заказов для фильтра ?state=new,confirmed
+ORDER_STATES = tuple(state for state, _ in STATE_CHOICES if state != 'basket')
+# вид списка заказов: full - с позициями, summary - только сводка по заказу
+ORDER_VIEWS = ('full', 'summary')
+
+
+class CatalogFilterError(ValueError):
+    """
+    Некорректный фильтр или сортировка каталога
+    """
+
+
+class OrderFilterError(ValueError):
+    """
+    Некорректный фильтр списка заказов
+    """
+
+
+def parameter_filters(query_params):
+    """
+    Фильтры по параметрам из строки запроса: {название параметра: {'values': [...], 'min': ..., 'max': ...}}
+    """
+    filters = {}
+    for key in query_params:
+        match = PARAMETER_FILTER_RE.match(key)
+        if not match:
+            continue
+        kind, name = match.groups()
+        values = [value for value in query_params.getlist(key) if value != '']
+        if not values:
+            continue
+        if kind == 'param':
+            filters.setdefault(name, {})['values'] = values
+            continue
+        try:
+            number = float(values[-1].replace(',', '.'))
+        except ValueError:
+            raise CatalogFilterError(f'{key}: ожидается число, получено {values[-1]!r}')
+        filters.setdefault(name, {})['min' if kind == 'param_min' else 'max'] = number
+    return filters
+
+
+def _int_param(query_params, name):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise CatalogFilterError(f'{name}: ожидается целое число, получено {value!r}')
+
+
+def _bool_param(query_params, name):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise CatalogFilterError(f'{name}: ожидается true или false, получено {value!r}')
+
+
+def filter_catalog(queryset, query_params):
+    """
+    Фильтры каталога: товары в продаже в работающих магазинах, shop_id, category_id, цена, наличие и параметры.
+    Несколько значений одного параметра объединяются через ИЛИ, разные параметры - через И.
+    """
+    query = Q(shop__state=True, is_active=True)
+    shop_id = query_params.get('shop_id')
+    category_id = query_params.get('category_id')
+    price_min = _int_param(query_params, 'price_min')
+    price_max = _int_param(query_params, 'price_max')
+    in_stock = _bool_param(query_params, 'in_stock')
+
+    if shop_id:
+        query = query & Q(shop_id=shop_id)
+
+    # категория берётся из копии в ProductInfo, чтобы работали индексы (category, price) и (category, id)
+    if category_id:
+        query = query & Q(category_id=category_id)
+
+    if price_min is not None:
+        query = query & Q(price__gte=price_min)
+
+    if price_max is not None:
+        query = query & Q(price__lte=price_max)
+
+    if in_stock is not None:
+        query = query & (Q(quantity__gt=0) if in_stock else Q(quantity=0))
+
+    queryset = queryset.filter(query)
+    # каждый параметр - отдельный EXISTS по индексу (parameter, value) или (parameter, value_num),
+    # строки товаров не размножаются
+    for name, condition in parameter_filters(query_params).items():
+        parameters = ProductParameter.objects.filter(product_info=OuterRef('pk'), parameter__name=name)
+        if 'values' in condition:
+            parameters = parameters.filter(value__in=condition['values'])
+        if 'min' in condition:
+            parameters = parameters.filter(value_num__gte=condition['min'])
+        if 'max' in condition:
+            parameters = parameters.filter(value_num__lte=condition['max'])
+        queryset = queryset.filter(Exists(parameters))
+    return queryset
+
+
+def order_catalog(queryset, query_params):
+    """
+    Сортировка каталога из параметра ordering. Возвращает queryset и порядок для постраничного вывода по курсору;
+    при сортировке по числовому параметру товары без этого параметра не выводятся.
+    """
+    ordering = query_params.get('ordering')
+    if not ordering:
+        return queryset, ('id',)
+
+    descending = ordering.startswith('-')
+    field = ordering[1:] if descending else ordering
+    # id - второй ключ курсора в том же направлении, что и сортировка: страница после серии равных значений
+    # выбирается условием по (значение, id) и обходом индекса (..., значение, id) в одну сторону
+    tiebreak = '-id' if descending else 'id'
+    if field in ORDERING_FIELDS:
+        return queryset, (ordering, tiebreak)
+    if not field.startswith(PARAMETER_ORDERING_PREFIX):
+        raise CatalogFilterError(f'Неизвестная сортировка: {ordering}')
+
+    parameter_id = Parameter.objects.filter(
+        name=field[len(PARAMETER_ORDERING_PREFIX):]).values_list('id', flat=True).first()
+    # одна строка параметра на товар (уникальность product_info, parameter), поэтому JOIN не размножает товары
+    queryset = queryset.annotate(
+        sort_parameter=FilteredRelation('product_parameters',
+                                        condition=Q(product_parameters__parameter_id=parameter_id))).annotate(
+        sort_value=F('sort_parameter__value_num')).filter(sort_value__isnull=False)
+    return queryset, ('-sort_value' if descending else 'sort_value', tiebreak)
+
+
+def _date_param(query_params, name):
+    """
+    Граница периода из даты (YYYY-MM-DD) или даты со временем в ISO 8601.
+    Возвращает (момент, True если указана только дата) или (None, False).
+    """
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None, False
+    try:
+        day = parse_date(value)
+        moment = datetime.datetime.combine(day, datetime.time()) if day else parse_datetime(value)
+    except ValueError:
+        day = moment = None
+    if moment is None:
+        raise OrderFilterError(f'{name}: ожидается дата YYYY-MM-DD или дата и время ISO 8601, получено {value!r}')
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment, day is not None
+
+
+def filter_orders(queryset, query_params):
+    """
+    Фильтры истории заказов: state (несколько через запятую), date_from и date_to - период по дате заказа,
+    дата без времени в date_to включает весь день
+    """
+    states = [state for value in query_params.getlist('state') for state in value.split(',') if state]
+    unknown = [state for state in states if state not in ORDER_STATES]
+    if unknown:
+        raise OrderFilterError(f"state: неизвестный статус {', '.join(unknown)}; допустимы {', '.join(ORDER_STATES)}")
+    date_from, _ = _date_param(query_params, 'date_from')
+    date_to, whole_day = _date_param(query_params, 'date_to')
+
+    if states:
+        queryset = queryset.filter(state__in=states)
+    if date_from is not None:
+        queryset = queryset.filter(dt__gte=date_from)
+    if date_to is not None:
+        # условия по самому dt, без выделения даты, чтобы работал индекс (user, state, dt)
+        queryset = queryset.filter(dt__lt=date_to + datetime.timedelta(days=1)) if whole_day else \
+            queryset.filter(dt__lte=date_to)
+    return queryset
+
+
+def order_list_view(query_params):
+    """
+    Вид списка заказов из параметра view: True - только сводка без позиций
+    """
+    view = query_params.get('view') or 'full'
+    if view not in ORDER_VIEWS:
+        raise OrderFilterError(f"view: ожидается {' или '.join(ORDER_VIEWS)}, получено {view!r}")
+    return view == 'summary'
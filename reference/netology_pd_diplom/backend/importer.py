@@ -0,0 +1,399 @@
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from backend.catalog_cache import bump_catalog_version
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
+from backend.search import get_search_backend, search_document
+
+logger = logging.getLogger(__name__)
+
+IMPORT_MODE_DIFF = 'diff'
+IMPORT_MODE_REPLACE = 'replace'
+
+# поля ProductInfo, которые сравниваются и обновляются при инкрементальном импорте
+DIFF_FIELDS = ('product', 'category', 'model', 'price', 'price_rrc', 'quantity', 'is_active')
+
+NUMBER_RE = re.compile(r'^[-+]?\d+(?:[.,]\d+)?$')
+
+
+def parse_number(value):
+    """
+    Числовое значение параметра: числа из прайс-листа и строки вида «6.1» или «6,1», иначе None
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    if NUMBER_RE.match(value):
+        return float(value.replace(',', '.'))
+    return None
+
+
+class ImportStats:
+    """
+    Статистика импорта прайс-листа: количество записанных строк и скорость записи
+    """
+
+    def __init__(self):
+        self.categories = 0
+        self.products = 0
+        self.parameters = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.product_parameters = 0
+        # время разбора прайс-листа и записи в базу данных
+        self.parse_time = 0.0
+        self.write_time = 0.0
+        self.elapsed = 0.0
+        self._started = time.monotonic()
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self._started
+
+    @property
+    def goods(self):
+        return self.inserted + self.updated + self.unchanged
+
+    @property
+    def rows(self):
+        return (self.categories + self.products + self.parameters + self.inserted +
+                self.updated + self.removed + self.product_parameters)
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    def as_dict(self):
+        return {
+            'categories': self.categories,
+            'products': self.products,
+            'parameters': self.parameters,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'removed': self.removed,
+            'product_parameters': self.product_parameters,
+            'rows': self.rows,
+            'parse_time': round(self.parse_time, 3),
+            'write_time': round(self.write_time, 3),
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+    def __str__(self):
+        return (f'добавлено {self.inserted}, обновлено {self.updated}, без изменений {self.unchanged}, '
+                f'снято с продажи {self.removed}; {self.rows} строк за {self.elapsed:.2f} с '
+                f'({self.rows_per_second:.0f} строк/с)')
+
+
+class ProductImporter:
+    """
+    Загрузка прайс-листа магазина в базу данных пакетными запросами.
+
+    Категории, продукты и имена параметров разрешаются одним запросом на тип сущности,
+    строки ProductInfo и ProductParameter записываются через bulk_create/bulk_update пачками по batch_size.
+
+    В режиме diff товары сопоставляются с уже загруженными по (shop, external_id): неизменённые строки
+    пропускаются, изменённые обновляются, пропавшие из прайс-листа снимаются с продажи (is_active=False).
+    В режиме replace старые товары магазина удаляются и загружаются заново.
+    """
+
+    def __init__(self, shop, batch_size=None, mode=None, on_progress=None):
+        self.shop = shop
+        # вызывается со статистикой после записи каждой пачки товаров
+        self.on_progress = on_progress
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        self.mode = mode or settings.IMPORT_MODE
+        if self.mode not in (IMPORT_MODE_DIFF, IMPORT_MODE_REPLACE):
+            raise ValueError(f'Неизвестный режим импорта: {self.mode}')
+        self.stats = ImportStats()
+        # товары магазина изменились - фасеты его категорий нужно пересчитать после фиксации транзакции
+        self.facets_stale = False
+        # кеши уже разрешённых идентификаторов, чтобы не искать их повторно для следующих пачек товаров
+        self._products = {}
+        self._parameters = {}
+        self._category_names = {}
+        self.search = get_search_backend()
+        # внешние ИД товаров, встреченные в прайс-листе
+        self._seen = set()
+
+    def run(self, data):
+        """
+        Полный импорт словаря прайс-листа в одной транзакции
+        """
+        goods = data.get('goods') or []
+        feed = [('categories', data.get('categories') or [])]
+        feed.extend(('goods', goods[offset:offset + self.batch_size])
+                    for offset in range(0, len(goods), self.batch_size))
+        return self.run_feed(feed)
+
+    def run_feed(self, feed):
+        """
+        Импорт прайс-листа, разобранного на пачки (см. backend.feeds.iter_feed), в одной транзакции
+        """
+        with transaction.atomic():
+            # блокировка строки магазина: параллельные импорты одного магазина выполняются по очереди
+            Shop.objects.select_for_update().filter(pk=self.shop.pk).exists()
+            self.start()
+            for section, items in self._timed(feed):
+                started = time.monotonic()
+                if section == 'categories':
+                    self.load_categories(items)
+                elif section == 'goods':
+                    self.load_goods(items)
+                self.stats.write_time += time.monotonic() - started
+                if section == 'goods' and self.on_progress:
+                    self.on_progress(self.stats)
+            self.finish()
+        return self.stats
+
+    def _timed(self, feed):
+        """
+        Учитывает время, потраченное на получение очередной пачки из прайс-листа, как время разбора
+        """
+        feed = iter(feed)
+        while True:
+            started = time.monotonic()
+            try:
+                section, items = next(feed)
+            except StopIteration:
+                return
+            finally:
+                self.stats.parse_time += time.monotonic() - started
+            yield section, items
+
+    def start(self):
+        if self.mode == IMPORT_MODE_REPLACE:
+            # Удаляем старую информацию о товарах для этого магазина
+            self.search.delete_shop(self.shop)
+            ProductInfo.objects.filter(shop=self.shop).delete()
+
+    def finish(self):
+        """
+        Снимает с продажи товары, которых не было в прайс-листе, увеличивает версии каталога
+        и фиксирует статистику. Фасеты пересчитываются вне транзакции импорта (см. backend.tasks)
+        """
+        if self.mode == IMPORT_MODE_DIFF:
+            active = ProductInfo.objects.filter(shop=self.shop, is_active=True).values_list('id', 'external_id')
+            removed = [product_info_id for product_info_id, external_id in active
+                       if external_id not in self._seen]
+            for offset in range(0, len(removed), self.batch_size):
+                self.stats.removed += ProductInfo.objects.filter(
+                    id__in=removed[offset:offset + self.batch_size]).update(is_active=False)
+
+        if self.mode == IMPORT_MODE_REPLACE or self.stats.inserted or self.stats.updated or self.stats.removed:
+            self.facets_stale = True
+            categories = Category.objects.filter(shops=self.shop).values_list('id', flat=True)
+            bump_catalog_version(f'shop:{self.shop.id}', 'products',
+                                 *[f'category:{category_id}' for category_id in categories])
+        if self.stats.categories:
+            bump_catalog_version('base')
+        self.stats.finish()
+        logger.info("Импорт магазина '%s': %s", self.shop.name, self.stats)
+
+    def load_categories(self, categories):
+        """
+        Создаёт недостающие категории, обновляет изменившиеся названия и привязывает категории к магазину
+        """
+        names = {category['id']: category['name'] for category in categories}
+        if not names:
+            return
+        self._category_names.update(names)
+
+        existing = Category.objects.in_bulk(list(names))
+        to_create = [Category(id=category_id, name=name) for category_id, name in names.items()
+                     if category_id not in existing]
+        to_update = []
+        for category_id, category_obj in existing.items():
+            if category_obj.name != names[category_id]:
+                category_obj.name = names[category_id]
+                to_update.append(category_obj)
+
+        Category.objects.bulk_create(to_create, batch_size=self.batch_size)
+        Category.objects.bulk_update(to_update, ['name'], batch_size=self.batch_size)
+
+        # связь категория-магазин, уже существующие пары пропускаются
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id) for category_id in names],
+            batch_size=self.batch_size, ignore_conflicts=True)
+
+        self.stats.categories += len(to_create) + len(to_update)
+
+    def load_goods(self, goods):
+        """
+        Записывает пачку товаров: ProductInfo и их параметры
+        """
+        goods = self._unique_goods(goods)
+        if not goods:
+            return
+
+        self._resolve_products(goods)
+        self._resolve_parameters(goods)
+
+        existing = {}
+        existing_parameters = {}
+        if self.mode == IMPORT_MODE_DIFF:
+            existing = {
+                product_info.external_id: product_info
+                for product_info in ProductInfo.objects.filter(
+                    shop=self.shop, external_id__in=[item['id'] for item in goods]).only('external_id', *DIFF_FIELDS)
+            }
+            if existing:
+                for product_info_id, parameter_id, value, value_num in ProductParameter.objects.filter(
+                        product_info_id__in=[product_info.id for product_info in existing.values()]).values_list(
+                        'product_info_id', 'parameter_id', 'value', 'value_num'):
+                    existing_parameters.setdefault(product_info_id, {})[parameter_id] = (value, value_num)
+
+        to_create = []
+        to_update = []
+        # товары, параметры которых нужно записать заново: (параметры, ProductInfo)
+        parameters_to_write = []
+        # существующие товары, у которых изменился набор параметров
+        replaced = []
+        # новые и изменённые товары для поискового индекса: (товар из прайс-листа, ProductInfo)
+        to_index = []
+        for item in goods:
+            values = {
+                'product_id': self._products[(item['name'], item['category'])],
+                'category_id': item['category'],
+                'model': item.get('model', ''),
+                'price': item['price'],
+                'price_rrc': item.get('price_rrc', 0),
+                'quantity': item['quantity'],
+                'is_active': True,
+            }
+            parameters = self._item_parameters(item)
+            product_info = existing.get(item['id'])
+
+            if product_info is None:
+                product_info = ProductInfo(shop=self.shop, external_id=item['id'], **values)
+                to_create.append(product_info)
+                parameters_to_write.append((parameters, product_info))
+                to_index.append((item, product_info))
+                continue
+
+            changed = False
+            for field, value in values.items():
+                if getattr(product_info, field) != value:
+                    setattr(product_info, field, value)
+                    changed = True
+            if changed:
+                to_update.append(product_info)
+            if existing_parameters.get(product_info.id, {}) != parameters:
+                parameters_to_write.append((parameters, product_info))
+                replaced.append(product_info.id)
+                changed = True
+
+            if changed:
+                self.stats.updated += 1
+                to_index.append((item, product_info))
+            else:
+                self.stats.unchanged += 1
+
+        ProductInfo.objects.bulk_create(to_create, batch_size=self.batch_size)
+        self._ensure_product_info_pks(to_create)
+        self.stats.inserted += len(to_create)
+
+        ProductInfo.objects.bulk_update(to_update, DIFF_FIELDS, batch_size=self.batch_size)
+
+        if replaced:
+            ProductParameter.objects.filter(product_info_id__in=replaced).delete()
+        product_parameters = ProductParameter.objects.bulk_create([
+            ProductParameter(product_info_id=product_info.id, parameter_id=parameter_id, value=value,
+                             value_num=value_num)
+            for parameters, product_info in parameters_to_write
+            for parameter_id, (value, value_num) in parameters.items()
+        ], batch_size=self.batch_size)
+        self.stats.product_parameters += len(product_parameters)
+
+        self.search.index({
+            product_info.id: search_document(item['name'], item.get('model', ''),
+                                             self._category_names.get(item['category'], ''),
+                                             (item.get('parameters') or {}).values())
+            for item, product_info in to_index
+        })
+
+    def _unique_goods(self, goods):
+        """
+        В режиме diff товар однозначно определяется внешним ИД, повторы в прайс-листе пропускаются
+        """
+        if self.mode != IMPORT_MODE_DIFF:
+            return list(goods)
+
+        unique = []
+        for item in goods:
+            if item['id'] in self._seen:
+                logger.warning("Импорт магазина '%s': повторный товар с ИД %s пропущен", self.shop.name, item['id'])
+                continue
+            self._seen.add(item['id'])
+            unique.append(item)
+        return unique
+
+    def _item_parameters(self, item):
+        """
+        Параметры товара: {ИД параметра: (строковое значение, числовое значение или None)}
+        """
+        return {self._parameters[name]: (str(value), parse_number(value))
+                for name, value in (item.get('parameters') or {}).items()}
+
+    def _resolve_products(self, goods):
+        keys = {(item['name'], item['category']) for item in goods} - self._products.keys()
+        if not keys:
+            return
+
+        lookup = Product.objects.filter(
+            name__in={name for name, _ in keys},
+            category_id__in={category_id for _, category_id in keys}).order_by('-id')
+        for product_id, name, category_id in lookup.values_list('id', 'name', 'category_id'):
+            if (name, category_id) in keys:
+                self._products[(name, category_id)] = product_id
+
+        missing = keys - self._products.keys()
+        if not missing:
+            return
+        created = Product.objects.bulk_create(
+            [Product(name=name, category_id=category_id) for name, category_id in missing],
+            batch_size=self.batch_size)
+        if created and created[0].pk is None:
+            # СУБД не возвращает первичные ключи из bulk_create — дочитываем их
+            created = Product.objects.filter(
+                name__in={name for name, _ in missing},
+                category_id__in={category_id for _, category_id in missing})
+        for product in created:
+            self._products[(product.name, product.category_id)] = product.pk
+        self.stats.products += len(missing)
+
+    def _resolve_parameters(self, goods):
+        names = {name for item in goods for name in (item.get('parameters') or {})} - self._parameters.keys()
+        if not names:
+            return
+
+        self._parameters.update(Parameter.objects.filter(name__in=names).values_list('name', 'id'))
+        missing = names - self._parameters.keys()
+        if not missing:
+            return
+        created = Parameter.objects.bulk_create([Parameter(name=name) for name in missing],
+                                                batch_size=self.batch_size)
+        if created and created[0].pk is None:
+            created = Parameter.objects.filter(name__in=missing)
+        self._parameters.update((parameter.name, parameter.pk) for parameter in created)
+        self.stats.parameters += len(missing)
+
+    def _ensure_product_info_pks(self, product_infos):
+        if not product_infos or product_infos[0].pk is not None:
+            return
+        pks = dict(ProductInfo.objects.filter(
+            shop=self.shop, external_id__in=[product_info.external_id for product_info in product_infos]
+        ).values_list('external_id', 'id'))
+        for product_info in product_infos:
+            product_info.pk = pks[product_info.external_id]
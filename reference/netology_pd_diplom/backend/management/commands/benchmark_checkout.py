@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+from backend.checkout import CheckoutError, checkout
+from backend.models import Category, Contact, Order, OrderItem, Product, ProductInfo, Shop, User
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочная проверка оформления заказов: покупатели параллельно оформляют корзины с одними и теми же '
+            'товарами, остатков на всех не хватает. Выводит пропускную способность и проверяет, что товар '
+            'не продан сверх остатка. Создаёт временные данные и удаляет их после проверки. '
+            'Запускать на PostgreSQL: SQLite не допускает параллельной записи, и потоки получают «database is locked».')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200, help='Число покупателей (оформлений)')
+        parser.add_argument('--threads', type=int, default=16, help='Число параллельных потоков')
+        parser.add_argument('--products', type=int, default=5, help='Число товаров в каждой корзине')
+        parser.add_argument('--stock', type=int, default=100, help='Остаток каждого товара')
+
+    def handle(self, *args, **options):
+        if options['buyers'] < 1 or options['threads'] < 1 or options['products'] < 1:
+            raise CommandError('Число покупателей, потоков и товаров должно быть положительным')
+
+        marker = uuid.uuid4().hex[:8]
+        shop, product_infos, baskets = self._prepare(marker, options)
+        try:
+            pending = queue.Queue()
+            for basket in baskets:
+                pending.put(basket)
+            results = []
+            workers = [threading.Thread(target=self._worker, args=(pending, results))
+                       for _ in range(options['threads'])]
+            started = time.monotonic()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.monotonic() - started
+
+            placed = results.count('ok')
+            sold = {product_info.id: 0 for product_info in product_infos}
+            for product_info_id, quantity in OrderItem.objects.filter(
+                    order__user__email__startswith=f'benchmark-{marker}-', order__state='new').values_list(
+                    'product_info_id', 'quantity'):
+                sold[product_info_id] += quantity
+            stock = dict(ProductInfo.objects.filter(shop=shop).values_list('id', 'quantity'))
+
+            self.stdout.write(
+                f"Оформлений: {len(baskets)} за {elapsed:.2f} с ({len(baskets) / elapsed:.1f} в секунду); "
+                f"успешно: {placed}, не хватило товара: {results.count('out_of_stock')}, "
+                f"ошибок БД: {results.count('error')}")
+            oversold = [product_info_id for product_info_id in stock
+                        if sold[product_info_id] + stock[product_info_id] != options['stock']
+                        or stock[product_info_id] < 0]
+            if oversold:
+                raise CommandError(f'Остатки не сходятся с проданным количеством: товары {oversold}')
+            self.stdout.write('Продаж сверх остатка нет')
+        finally:
+            User.objects.filter(email__startswith=f'benchmark-{marker}-').delete()
+            shop.delete()
+            Product.objects.filter(name__startswith=f'Benchmark {marker} ').delete()
+            Category.objects.filter(name=f'Benchmark {marker}').delete()
+
+    def _prepare(self, marker, options):
+        """
+        Магазин с товарами и корзины покупателей: в каждой корзине все товары по одной единице
+        """
+        shop = Shop.objects.create(name=f'Benchmark {marker}')
+        category = Category.objects.create(name=f'Benchmark {marker}')
+        product_infos = [
+            ProductInfo.objects.create(
+                product=Product.objects.create(name=f'Benchmark {marker} {index}', category=category),
+                category=category, shop=shop, external_id=index, quantity=options['stock'], price=100, price_rrc=100)
+            for index in range(options['products'])
+        ]
+        baskets = []
+        for index in range(options['buyers']):
+            user = User.objects.create_user(email=f'benchmark-{marker}-{index}@example.com', is_active=True)
+            contact = Contact.objects.create(user=user, city='Москва', street='Тверская', phone='+70000000000')
+            order = Order.objects.create(user=user, state='basket')
+            OrderItem.objects.bulk_create([OrderItem(order=order, product_info=product_info, quantity=1)
+                                           for product_info in product_infos])
+            baskets.append((user.id, order.id, contact.id))
+        return shop, product_infos, baskets
+
+    @staticmethod
+    def _worker(pending, results):
+        """
+        Поток оформляет корзины из очереди через собственное соединение с БД
+        """
+        try:
+            while True:
+                try:
+                    basket = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    checkout(*basket)
+                    results.append('ok')
+                except CheckoutError:
+                    results.append('out_of_stock')
+                except DatabaseError:
+                    results.append('error')
+        finally:
+            connections.close_all()
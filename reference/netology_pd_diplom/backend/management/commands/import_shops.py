@@ -0,0 +1,38 @@
+from celery import chord
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.models import Shop, ImportJob
+from backend.tasks import do_import, import_summary
+
+
+class Command(BaseCommand):
+    help = ('Параллельный импорт прайс-листов магазинов по ссылке на воркерах Celery. '
+            'Один магазин импортируется не больше чем одной задачей одновременно, '
+            'общее число одновременных импортов ограничено IMPORT_MAX_CONCURRENCY.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('shop_ids', nargs='*', type=int, help='ИД магазинов (по умолчанию - все с указанной ссылкой)')
+        parser.add_argument('--timeout', type=int, default=60 * 60,
+                            help='Сколько секунд ждать завершения всех импортов')
+        parser.add_argument('--no-wait', action='store_true', help='Не ждать завершения импортов')
+
+    def handle(self, *args, **options):
+        shops = Shop.objects.exclude(url__isnull=True).exclude(url='')
+        if options['shop_ids']:
+            shops = shops.filter(id__in=options['shop_ids'])
+        shops = list(shops)
+        if not shops:
+            raise CommandError('Нет магазинов со ссылкой на прайс-лист')
+
+        jobs = [ImportJob.objects.create(shop=shop, source='command', url=shop.url) for shop in shops]
+        result = chord(do_import.s(job.id) for job in jobs)(import_summary.s())
+        self.stdout.write(f'Запущен импорт для магазинов: {len(jobs)}')
+        if options['no_wait']:
+            return
+
+        summary = result.get(timeout=options['timeout'])
+        self.stdout.write(
+            f"Завершено: {summary['done']}, без изменений: {summary['skipped']}, с ошибкой: {summary['failed']}; "
+            f"записано строк: {summary['rows_written']}")
+        for shop_id, error in summary['errors'].items():
+            self.stderr.write(f'Магазин {shop_id}: {error}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from backend.models import ProductInfo
+from backend.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Полная переиндексация товаров для поиска (импорт прайс-листов обновляет индекс сам)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, help='ИД магазина (по умолчанию - все магазины)')
+
+    def handle(self, *args, **options):
+        queryset = ProductInfo.objects.all()
+        if options['shop']:
+            queryset = queryset.filter(shop_id=options['shop'])
+        indexed = rebuild_index(queryset)
+        self.stdout.write(f'Проиндексировано товаров: {indexed}')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.checkout import snapshot_prices
+from backend.models import Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = ('Заполняет цены позиций оформленных заказов, у которых цена не зафиксирована (заказы, сделанные '
+            'до появления поля), текущими ценами товаров и пересчитывает сохранённые суммы заказов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Пересчитать суммы всех оформленных заказов, а не только заказов без цен')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.exclude(state='basket')
+        with transaction.atomic():
+            if not options['all']:
+                orders = orders.filter(id__in=list(OrderItem.objects.filter(
+                    order__in=orders, price__isnull=True).values_list('order_id', flat=True).distinct()))
+            priced = snapshot_prices(OrderItem.objects.filter(order__in=orders, price__isnull=True))
+            updated = orders.update_total_sum()
+        self.stdout.write(f'Зафиксировано цен позиций: {priced}, пересчитано заказов: {updated}')
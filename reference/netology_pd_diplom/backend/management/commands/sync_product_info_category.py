@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+
+from backend.catalog_cache import bump_catalog_version
+from backend.models import Product, ProductInfo
+
+
+class Command(BaseCommand):
+    help = ('Заполняет копию категории продукта в ProductInfo.category у товаров, где она не задана или устарела '
+            '(товары, загруженные до появления поля или созданные в обход импорта). Без неё товары не попадают '
+            'в фильтр каталога по category_id.')
+
+    def handle(self, *args, **options):
+        stale = ProductInfo.objects.filter(Q(category__isnull=True) | ~Q(category_id=F('product__category_id')))
+        with transaction.atomic():
+            scopes = {'products'}
+            for shop_id, category_id in stale.values_list('shop_id', 'product__category_id').distinct():
+                scopes.update((f'shop:{shop_id}', f'category:{category_id}'))
+            category = Product.objects.filter(pk=OuterRef('product_id')).values('category_id')[:1]
+            updated = ProductInfo.objects.filter(id__in=list(stale.values_list('id', flat=True))).update(
+                category_id=Subquery(category))
+            if updated:
+                bump_catalog_version(*scopes)
+        self.stdout.write(f'Обновлено товаров: {updated}')
@@ -1,7 +1,12 @@
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Exists, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from easy_thumbnails.fields import ThumbnailerImageField
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
@@ -21,6 +26,26 @@ USER_TYPE_CHOICES = (
     ('buyer', 'Покупатель'),
 )
 
+IMPORT_STATE_CHOICES = (
+    ('pending', 'В очереди'),
+    ('fetching', 'Загрузка прайс-листа'),
+    ('importing', 'Запись в базу данных'),
+    ('done', 'Завершён'),
+    ('skipped', 'Пропущен: прайс-лист не изменился'),
+    ('failed', 'Ошибка'),
+)
+
+IMPORT_SOURCE_CHOICES = (
+    ('url', 'Ссылка'),
+    ('file', 'Файл'),
+    ('admin', 'Админка'),
+    ('command', 'Команда'),
+    ('schedule', 'Расписание'),
+)
+
+# состояния задачи импорта, в которых она больше не выполняется
+IMPORT_FINISHED_STATES = ('done', 'skipped', 'failed')
+
 # Create your models here.
 
 
@@ -108,12 +133,23 @@ class Shop(models.Model):
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='статус получения заказов', default=True)
+    # валидаторы HTTP и хеш последнего загруженного прайс-листа для условной загрузки по ссылке
+    feed_etag = models.CharField(verbose_name='ETag прайс-листа', max_length=255, blank=True)
+    feed_last_modified = models.CharField(verbose_name='Last-Modified прайс-листа', max_length=64, blank=True)
+    feed_hash = models.CharField(verbose_name='SHA-256 прайс-листа', max_length=64, blank=True)
+    # автоматическое обновление прайс-листа по ссылке (см. backend.tasks.refresh_feeds)
+    refresh_interval = models.PositiveIntegerField(verbose_name='Интервал обновления, мин', null=True, blank=True)
+    next_refresh_at = models.DateTimeField(verbose_name='Следующее обновление', null=True, blank=True)
+    refresh_failures = models.PositiveSmallIntegerField(verbose_name='Неудачных обновлений подряд', default=0)
 
     # filename
     class Meta:
         verbose_name = 'Магазин'
         verbose_name_plural = "Список магазинов"
         ordering = ('-name',)
+        indexes = [
+            models.Index(fields=['next_refresh_at'], name='shop_next_refresh_at'),
+        ]
 
     def __str__(self):
         return self.name
@@ -155,11 +191,17 @@ class ProductInfo(models.Model):
     external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
     product = models.ForeignKey(Product, verbose_name='Продукт', related_name='product_infos', blank=True,
                                 on_delete=models.CASCADE)
+    # копия product.category для составных индексов каталога (category, price): заполняется при импорте и в pre_save,
+    # у старых товаров - командой sync_product_info_category
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='product_infos', null=True,
+                                 blank=True, on_delete=models.SET_NULL)
     shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='product_infos', blank=True,
                              on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    # товары, пропавшие из прайс-листа, не удаляются, а снимаются с продажи
+    is_active = models.BooleanField(verbose_name='В продаже', default=True)
 
     class Meta:
         verbose_name = 'Информация о продукте'
@@ -167,11 +209,63 @@ class ProductInfo(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product', 'shop', 'external_id'], name='unique_product_info'),
         ]
+        indexes = [
+            models.Index(fields=['shop', 'external_id'], name='product_info_shop_external_id'),
+            # постраничный вывод каталога магазина по курсору (см. backend.pagination)
+            models.Index(fields=['shop', 'is_active', 'id'], name='product_info_shop_active_id'),
+            # фильтры и сортировка каталога по цене и наличию (см. backend.filters)
+            models.Index(fields=['shop', 'price', 'id'], name='product_info_shop_price'),
+            models.Index(fields=['category', 'price', 'id'], name='product_info_category_price'),
+            models.Index(fields=['category', 'id'], name='product_info_category_id'),
+            models.Index(fields=['shop', 'quantity', 'id'], name='product_info_shop_quantity'),
+        ]
 
     def __str__(self):
         return f'{self.product.name} - {self.shop.name}'
 
 
+class ProductSearchTerm(models.Model):
+    """
+    Обратный поисковый индекс: основа слова из названия, модели, категории или параметров товара
+    """
+    objects = models.manager.Manager()
+    term = models.CharField(verbose_name='Терм', max_length=40)
+    product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте', related_name='search_terms',
+                                     on_delete=models.CASCADE)
+    weight = models.PositiveSmallIntegerField(verbose_name='Вес', default=1)
+
+    class Meta:
+        verbose_name = 'Поисковый терм'
+        verbose_name_plural = "Поисковый индекс"
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'product_info'], name='unique_search_term'),
+        ]
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Поисковый документ товара для полнотекстового поиска PostgreSQL (создаётся только на PostgreSQL)
+    """
+    objects = models.manager.Manager()
+    # без ограничения внешнего ключа: на других СУБД таблицы нет, и удаление товаров не должно к ней обращаться;
+    # документы товаров, удалённых не импортом, не попадают в поиск и удаляются в search.rebuild_index
+    product_info = models.OneToOneField(ProductInfo, verbose_name='Информация о продукте', primary_key=True,
+                                        related_name='search_document', on_delete=models.DO_NOTHING,
+                                        db_constraint=False)
+    name = models.TextField(verbose_name='Название', blank=True)
+    model = models.TextField(verbose_name='Модель', blank=True)
+    extra = models.TextField(verbose_name='Категория и параметры', blank=True)
+    document = SearchVectorField(null=True)
+
+    class Meta:
+        verbose_name = 'Поисковый документ'
+        verbose_name_plural = "Поисковые документы"
+        required_db_vendor = 'postgresql'
+        indexes = [
+            GinIndex(fields=['document'], name='product_search_document'),
+        ]
+
+
 class Parameter(models.Model):
     objects = models.manager.Manager()
     name = models.CharField(max_length=40, verbose_name='Название')
@@ -193,6 +287,8 @@ class ProductParameter(models.Model):
     parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='product_parameters', blank=True,
                                   on_delete=models.CASCADE)
     value = models.CharField(verbose_name='Значение', max_length=100)
+    # числовое значение параметра (если value - число) для фильтров по диапазону и сортировки
+    value_num = models.FloatField(verbose_name='Числовое значение', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Параметр'
@@ -200,6 +296,32 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'], name='unique_product_parameter'),
         ]
+        indexes = [
+            # фильтр каталога по значению параметра (param[Цвет]=черный)
+            models.Index(fields=['parameter', 'value', 'product_info'], name='product_parameter_value'),
+            models.Index(fields=['parameter', 'value_num', 'product_info'], name='product_parameter_value_num'),
+        ]
+
+
+class CategoryFacet(models.Model):
+    """
+    Материализованные фасеты: количество товаров в продаже с данным значением параметра в категории.
+    Пересчитывается при импорте прайс-листов и смене статуса магазина (см. backend.facets)
+    """
+    objects = models.manager.Manager()
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='facets',
+                                 on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='facets',
+                                  on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+    count = models.PositiveIntegerField(verbose_name='Количество товаров')
+
+    class Meta:
+        verbose_name = 'Фасет категории'
+        verbose_name_plural = "Фасеты категорий"
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'parameter', 'value'], name='unique_category_facet'),
+        ]
 
 
 class Contact(models.Model):
@@ -224,8 +346,50 @@ class Contact(models.Model):
         return f'{self.city} {self.street} {self.house}'
 
 
+class OrderQuerySet(models.QuerySet):
+    """
+    Выборки заказов без JOIN по позициям: фильтр по магазину через EXISTS, суммы подзапросом,
+    поэтому строки заказов не размножаются и не нужен DISTINCT.
+    Сумма оформленного заказа хранится в Order.total_sum и считается по ценам на момент оформления.
+    """
+
+    def _items(self, shop_user_id=None):
+        items = OrderItem.objects.filter(order=OuterRef('pk'))
+        if shop_user_id is not None:
+            items = items.filter(product_info__shop__user_id=shop_user_id)
+        return items
+
+    def _sum(self, items, price):
+        total = items.values('order').annotate(total=Sum(F('quantity') * F(price))).values('total')
+        return Coalesce(Subquery(total, output_field=models.IntegerField()), 0)
+
+    def with_shop(self, shop_user_id):
+        """
+        Заказы, в которых есть товары магазина пользователя shop_user_id
+        """
+        return self.filter(Exists(self._items(shop_user_id)))
+
+    def with_shop_total(self, shop_user_id):
+        """
+        Сумма позиций магазина пользователя shop_user_id в заказе (по зафиксированным ценам) в поле shop_total
+        """
+        return self.annotate(shop_total=self._sum(self._items(shop_user_id), 'price'))
+
+    def with_basket_total(self):
+        """
+        Сумма корзины по текущим ценам товаров в поле basket_total
+        """
+        return self.annotate(basket_total=self._sum(self._items(), 'product_info__price'))
+
+    def update_total_sum(self):
+        """
+        Пересчитывает сохранённую сумму заказов одним UPDATE по зафиксированным ценам позиций
+        """
+        return self.update(total_sum=self._sum(self._items(), 'price'))
+
+
 class Order(models.Model):
-    objects = models.manager.Manager()
+    objects = OrderQuerySet.as_manager()
     user = models.ForeignKey(User, verbose_name='Пользователь',
                              related_name='orders', blank=True,
                              on_delete=models.CASCADE)
@@ -234,11 +398,19 @@ class Order(models.Model):
     contact = models.ForeignKey(Contact, verbose_name='Контакт',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    # сумма по ценам на момент оформления, обновляется вместе с позициями (см. backend.checkout)
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа', default=0)
+    # остатки позиций списаны при оформлении и ещё не возвращены; отмена возвращает их только при этом флаге
+    stock_reserved = models.BooleanField(verbose_name='Остатки зарезервированы', default=False)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказов"
         ordering = ('-dt',)
+        indexes = [
+            # история заказов покупателя по статусу и периоду
+            models.Index(fields=['user', 'state', 'dt'], name='order_user_state_dt'),
+        ]
 
     def __str__(self):
         return str(self.dt)
@@ -257,6 +429,8 @@ class OrderItem(models.Model):
                                      blank=True,
                                      on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
+    # цена за единицу на момент оформления; у позиций корзины не задана
+    price = models.PositiveIntegerField(verbose_name='Цена', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Заказанная позиция'
@@ -266,6 +440,68 @@ class OrderItem(models.Model):
         ]
 
 
+class ImportJob(models.Model):
+    """
+    Задача импорта прайс-листа магазина и её прогресс
+    """
+    objects = models.manager.Manager()
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_jobs',
+                             on_delete=models.CASCADE)
+    source = models.CharField(verbose_name='Источник', choices=IMPORT_SOURCE_CHOICES, max_length=10, default='url')
+    url = models.URLField(verbose_name='Ссылка на прайс-лист', null=True, blank=True)
+    # загруженный прайс-лист хранится в default_storage до окончания импорта
+    file = models.FileField(verbose_name='Файл прайс-листа', upload_to='imports/', null=True, blank=True)
+    state = models.CharField(verbose_name='Статус', choices=IMPORT_STATE_CHOICES, max_length=15, default='pending')
+    content_hash = models.CharField(verbose_name='SHA-256 прайс-листа', max_length=64, blank=True)
+    bytes_read = models.PositiveBigIntegerField(verbose_name='Загружено байт', default=0)
+    goods_parsed = models.PositiveIntegerField(verbose_name='Разобрано товаров', default=0)
+    rows_written = models.PositiveIntegerField(verbose_name='Записано строк', default=0)
+    inserted = models.PositiveIntegerField(verbose_name='Добавлено товаров', default=0)
+    updated = models.PositiveIntegerField(verbose_name='Обновлено товаров', default=0)
+    unchanged = models.PositiveIntegerField(verbose_name='Товаров без изменений', default=0)
+    removed = models.PositiveIntegerField(verbose_name='Снято с продажи', default=0)
+    fetch_time = models.FloatField(verbose_name='Загрузка, с', null=True, blank=True)
+    parse_time = models.FloatField(verbose_name='Разбор, с', null=True, blank=True)
+    write_time = models.FloatField(verbose_name='Запись, с', null=True, blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    started_at = models.DateTimeField(verbose_name='Начата', null=True, blank=True)
+    finished_at = models.DateTimeField(verbose_name='Завершена', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Импорт прайс-листа'
+        verbose_name_plural = "Список импортов прайс-листов"
+        ordering = ('-created_at',)
+        indexes = [
+            models.Index(fields=['shop', 'state', 'finished_at'], name='import_job_shop_state'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop} - {self.created_at}'
+
+    @property
+    def progress_cache_key(self):
+        return f'import-job:{self.pk}:progress'
+
+    def set_progress(self, **progress):
+        """
+        Сохраняет текущий прогресс в кеш: запись в БД идёт в транзакции импорта и до её
+        завершения не видна другим соединениям
+        """
+        cache.set(self.progress_cache_key, progress, timeout=60 * 60)
+
+    def get_progress(self):
+        if self.state in IMPORT_FINISHED_STATES:
+            return {}
+        return cache.get(self.progress_cache_key) or {}
+
+    def is_duplicate(self):
+        """
+        Совпадает ли прайс-лист с последним успешно загруженным для этого магазина
+        """
+        return bool(self.content_hash) and self.shop.feed_hash == self.content_hash
+
+
 class ConfirmEmailToken(models.Model):
     objects = models.manager.Manager()
     class Meta:
@@ -0,0 +1,126 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+def _cursor_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Постраничный вывод по составному ключу (keyset): курсор хранит значения всех полей ordering последней
+    (или первой) строки страницы, следующая страница выбирается условием
+    (f1 > v1) OR (f1 = v1 AND f2 > v2) ..., а не OFFSET. Последнее поле ordering должно быть уникальным (id),
+    тогда время ответа не зависит от номера страницы и при длинных сериях равных значений.
+    Строки страницы - модели или словари .values(), в которых есть все поля ordering.
+    """
+    ordering = ('id',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        ordering = (self.ordering,) if isinstance(self.ordering, str) else tuple(self.ordering)
+        position, reverse = self.decode_cursor(request)
+        if reverse:
+            # предыдущая страница: идём от первой строки текущей в обратном порядке
+            ordering = tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._after(ordering, position))
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        self.has_next = position is not None if reverse else has_more
+        self.has_previous = has_more if reverse else position is not None
+        if (self.has_next or self.has_previous) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def _after(ordering, position):
+        """
+        Условие «строго после position» для порядка ordering
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            condition |= Q(**equal, **{f"{name}__{'lt' if field.startswith('-') else 'gt'}": value})
+            equal[name] = value
+        return condition
+
+    def _position(self, row):
+        ordering = (self.ordering,) if isinstance(self.ordering, str) else self.ordering
+        return [row[field.lstrip('-')] if isinstance(row, dict) else getattr(row, field.lstrip('-'))
+                for field in ordering]
+
+    def decode_cursor(self, request):
+        """
+        Курсор из запроса: (значения полей ordering или None, назад)
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            position, reverse = cursor['p'], bool(cursor['r'])
+            ordering = (self.ordering,) if isinstance(self.ordering, str) else self.ordering
+            if not isinstance(position, list) or len(position) != len(ordering):
+                raise ValueError
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, position, reverse=False):
+        # даты - полный isoformat с микросекундами (DjangoJSONEncoder обрезает их до миллисекунд)
+        cursor = json.dumps({'p': position, 'r': int(reverse)}, default=_cursor_value, separators=(',', ':'))
+        encoded = urlsafe_b64encode(cursor.encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self._position(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(self._position(self.page[0]), reverse=True)
+
+
+class ProductInfoCursorPagination(KeysetCursorPagination):
+    """
+    Постраничный вывод каталога по курсору; ordering задаёт представление: ('id',) или (поле сортировки, id)
+    """
+    ordering = ('id',)
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = settings.PRODUCTS_PAGE_SIZE
+        self.max_page_size = settings.PRODUCTS_MAX_PAGE_SIZE
+
+
+class OrderCursorPagination(KeysetCursorPagination):
+    """
+    Постраничный вывод истории заказов по курсору на (dt, id) от новых к старым:
+    заказы с одинаковым временем не требуют OFFSET
+    """
+    ordering = ('-dt', '-id')
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = settings.ORDERS_PAGE_SIZE
+        self.max_page_size = settings.ORDERS_MAX_PAGE_SIZE
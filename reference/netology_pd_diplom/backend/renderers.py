@@ -0,0 +1,18 @@
+import ujson
+from rest_framework.renderers import JSONRenderer
+
+
+class UJSONRenderer(JSONRenderer):
+    """
+    JSON-ответы через ujson; данные, которые ujson не умеет сериализовать (даты, ленивые строки),
+    рендерятся стандартным JSONRenderer
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        try:
+            return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, indent=indent or 0).encode()
+        except (TypeError, OverflowError):
+            return super().render(data, accepted_media_type, renderer_context)
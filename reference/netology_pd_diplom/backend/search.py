@@ -0,0 +1,245 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Exists, F, OuterRef, Sum
+
+from backend.models import ProductInfo, ProductSearchTerm, ProductSearchDocument
+
+# веса полей товара при ранжировании: совпадение в названии важнее совпадения в параметрах
+FIELD_WEIGHTS = {'name': 4, 'model': 3, 'category': 2, 'parameters': 1}
+
+_VOWELS = 'аеиоуыэюя'
+_TOKEN_RE = re.compile(r'[^\W\d_]+|\d+')
+_CYRILLIC_RE = re.compile('[а-я]')
+
+# окончания для стеммера (упрощённый snowball для русского языка), группа 1 - только после «а» или «я»
+_PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+_REFLEXIVE = ((), ('ся', 'сь'))
+_ADJECTIVE = ((), ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его',
+                   'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'))
+_PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+_VERB = (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+         ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило',
+          'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю'))
+_NOUN = ((), ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+              'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия',
+              'ья', 'я'))
+_SUPERLATIVE = ((), ('ейше', 'ейш'))
+_DERIVATIONAL = ((), ('ость', 'ост'))
+
+
+def _regions(word):
+    """
+    Начала областей RV и R2 алгоритма snowball
+    """
+    rv = r1 = r2 = len(word)
+    for index, char in enumerate(word):
+        if char in _VOWELS:
+            rv = index + 1
+            break
+    for start in range(1, len(word)):
+        if word[start - 1] in _VOWELS and word[start] not in _VOWELS:
+            r1 = start + 1
+            break
+    for start in range(r1 + 1, len(word)):
+        if word[start - 1] in _VOWELS and word[start] not in _VOWELS:
+            r2 = start + 1
+            break
+    return rv, r2
+
+
+def _strip(word, start, endings):
+    """
+    Отрезает самое длинное окончание из endings, лежащее в области начиная со start.
+    Возвращает слово без окончания или None, если ни одно окончание не подошло.
+    """
+    after_a, plain = endings
+    for ending in sorted(after_a + plain, key=len, reverse=True):
+        if not word.endswith(ending) or len(word) - len(ending) < start:
+            continue
+        if ending in plain:
+            return word[:-len(ending)]
+        position = len(word) - len(ending) - 1
+        if position >= start and word[position] in 'ая':
+            return word[:-len(ending)]
+    return None
+
+
+def stem(word):
+    """
+    Основа русского слова по упрощённому алгоритму snowball; слова не на кириллице не изменяются
+    """
+    word = word.lower().replace('ё', 'е')
+    if not _CYRILLIC_RE.search(word):
+        return word
+    rv, r2 = _regions(word)
+
+    # шаг 1: деепричастие, иначе возвратная частица и прилагательное / глагол / существительное
+    stripped = _strip(word, rv, _PERFECTIVE_GERUND)
+    if stripped is None:
+        word = _strip(word, rv, _REFLEXIVE) or word
+        stripped = _strip(word, rv, _ADJECTIVE)
+        if stripped is not None:
+            stripped = _strip(stripped, rv, _PARTICIPLE) or stripped
+        else:
+            stripped = _strip(word, rv, _VERB)
+            if stripped is None:
+                stripped = _strip(word, rv, _NOUN)
+    word = stripped if stripped is not None else word
+
+    # шаг 2-4: «и», словообразовательные суффиксы, превосходная степень, «нн» и мягкий знак
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    word = _strip(word, r2, _DERIVATIONAL) or word
+    word = _strip(word, rv, _SUPERLATIVE) or word
+    if word.endswith('нн') and len(word) - 1 >= rv:
+        word = word[:-1]
+    elif word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def terms(text):
+    """
+    Термы текста: основы слов и числа отдельно от букв («512GB» -> «512», «gb»)
+    """
+    max_length = ProductSearchTerm._meta.get_field('term').max_length
+    return [stem(token)[:max_length] for token in _TOKEN_RE.findall(str(text).lower())]
+
+
+def search_document(name, model='', category='', parameters=()):
+    """
+    Поля товара, по которым ведётся поиск
+    """
+    return {'name': name or '', 'model': model or '', 'category': category or '',
+            'parameters': ' '.join(str(value) for value in parameters)}
+
+
+class InvertedIndexBackend:
+    """
+    Обратный индекс в таблице ProductSearchTerm: терм -> товары с весом поля, в котором он встретился.
+    Поиск - один запрос по индексу (term, product_info) с группировкой по товару, без LIKE по таблице товаров.
+    """
+
+    def index(self, documents):
+        """
+        Пересчитывает термы товаров; documents - {ИД ProductInfo: search_document(...)}
+        """
+        if not documents:
+            return
+        rows = []
+        for product_info_id, document in documents.items():
+            weights = {}
+            for field, text in document.items():
+                for term in terms(text):
+                    weights[term] = max(weights.get(term, 0), FIELD_WEIGHTS[field])
+            rows.extend(ProductSearchTerm(term=term, product_info_id=product_info_id, weight=weight)
+                        for term, weight in weights.items())
+        ProductSearchTerm.objects.filter(product_info_id__in=list(documents)).delete()
+        ProductSearchTerm.objects.bulk_create(rows, batch_size=settings.IMPORT_BATCH_SIZE)
+
+    def delete_shop(self, shop):
+        # термы удаляются каскадно вместе с товарами
+        pass
+
+    def delete_orphans(self):
+        # термы удаляются каскадно вместе с товарами, потерянных не бывает
+        return 0
+
+    def search(self, queryset, query, limit):
+        """
+        ИД товаров из queryset, содержащих все слова запроса, по убыванию суммарного веса совпадений
+        """
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        ranked = ProductSearchTerm.objects.filter(term__in=query_terms, product_info__in=queryset).values(
+            'product_info').annotate(matched=Count('id'), rank=Sum('weight')).filter(
+            matched=len(query_terms)).order_by('-rank', 'product_info')[:limit]
+        return [row['product_info'] for row in ranked]
+
+
+class PostgresSearchBackend:
+    """
+    Полнотекстовый поиск PostgreSQL: tsvector в ProductSearchDocument с GIN-индексом и ранжированием ts_rank
+    """
+    config = 'russian'
+
+    def index(self, documents):
+        from django.contrib.postgres.search import SearchVector
+
+        if not documents:
+            return
+        ProductSearchDocument.objects.bulk_create([
+            ProductSearchDocument(product_info_id=product_info_id, name=document['name'], model=document['model'],
+                                  extra=f"{document['category']} {document['parameters']}")
+            for product_info_id, document in documents.items()
+        ], batch_size=settings.IMPORT_BATCH_SIZE, update_conflicts=True, unique_fields=['product_info'],
+            update_fields=['name', 'model', 'extra'])
+        ProductSearchDocument.objects.filter(product_info_id__in=list(documents)).update(
+            document=SearchVector('name', weight='A', config=self.config) +
+            SearchVector('model', weight='B', config=self.config) +
+            SearchVector('extra', weight='C', config=self.config))
+
+    def delete_shop(self, shop):
+        # у документа нет внешнего ключа в БД, поэтому перед удалением товаров магазина документы удаляются явно
+        ProductSearchDocument.objects.filter(product_info__shop=shop).delete()
+
+    def delete_orphans(self):
+        """
+        Удаляет документы товаров, удалённых в обход импорта (админка, удаление магазина или продукта)
+        """
+        return ProductSearchDocument.objects.filter(
+            ~Exists(ProductInfo.objects.filter(pk=OuterRef('product_info_id')))).delete()[0]
+
+    def search(self, queryset, query, limit):
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        search_query = SearchQuery(query, config=self.config, search_type='plain')
+        # product_info__in - подзапрос по существующим товарам, документы удалённых товаров не попадают в выдачу
+        return list(ProductSearchDocument.objects.filter(
+            document=search_query, product_info__in=queryset).annotate(
+            rank=SearchRank(F('document'), search_query)).order_by('-rank', 'product_info_id').values_list(
+            'product_info_id', flat=True)[:limit])
+
+
+def get_search_backend():
+    """
+    Поисковый движок из настройки SEARCH_BACKEND: index, postgres или auto (postgres на PostgreSQL)
+    """
+    backend = settings.SEARCH_BACKEND
+    if backend == 'auto':
+        backend = 'postgres' if connection.vendor == 'postgresql' else 'index'
+    if backend == 'postgres':
+        return PostgresSearchBackend()
+    if backend == 'index':
+        return InvertedIndexBackend()
+    raise ValueError(f'Неизвестный поисковый движок: {backend}')
+
+
+def rebuild_index(queryset=None, batch_size=None):
+    """
+    Полная переиндексация товаров (например, после изменения товаров через админку)
+    с удалением документов уже удалённых товаров
+    """
+    backend = get_search_backend()
+    backend.delete_orphans()
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    queryset = (queryset if queryset is not None else ProductInfo.objects.all()).order_by('id')
+    last_id = 0
+    indexed = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id).select_related('product__category').prefetch_related(
+            'product_parameters')[:batch_size])
+        if not batch:
+            return indexed
+        backend.index({
+            product_info.id: search_document(
+                product_info.product.name, product_info.model,
+                product_info.product.category.name if product_info.product.category else '',
+                [parameter.value for parameter in product_info.product_parameters.all()])
+            for product_info in batch
+        })
+        indexed += len(batch)
+        last_id = batch[-1].id
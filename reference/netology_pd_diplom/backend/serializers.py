@@ -1,7 +1,77 @@
+from django.db.models import Prefetch
 from drf_spectacular.utils import extend_schema_serializer, OpenApiExample
 from rest_framework import serializers
 
-from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
+from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact, \
+    ImportJob
+
+
+class SparseFieldsError(ValueError):
+    """
+    Запрошено поле, которого нет в сериализаторе
+    """
+
+
+def parse_fields(value, serializer_class=None):
+    """
+    Разбирает параметр ?fields=id,price,product.name в дерево {'id': None, 'price': None, 'product': {'name': None}};
+    None - поле целиком. Пустое значение - все поля (None). С serializer_class поля сразу проверяются.
+    """
+    if not value:
+        return None
+    tree = {}
+    for path in value.split(','):
+        names = [name.strip() for name in path.split('.')]
+        if not all(names):
+            raise SparseFieldsError(f'Некорректное поле: {path!r}')
+        node = tree
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = None
+    if serializer_class is not None:
+        serializer_class(fields=tree)
+    return tree
+
+
+def requested(fields, path):
+    """
+    Запрошено ли поле path ('product.category') в дереве полей из parse_fields
+    """
+    for name in path.split('.'):
+        if fields is None:
+            return True
+        if name not in fields:
+            return False
+        fields = fields[name]
+    return True
+
+
+def _select_fields(serializer, fields, prefix=''):
+    serializer = getattr(serializer, 'child', serializer)
+    unknown = set(fields) - set(serializer.fields)
+    if unknown:
+        raise SparseFieldsError(f'Неизвестные поля: {", ".join(sorted(prefix + name for name in unknown))}')
+    for name in list(serializer.fields):
+        if name not in fields:
+            serializer.fields.pop(name)
+        elif fields[name] is not None:
+            if not hasattr(getattr(serializer.fields[name], 'child', serializer.fields[name]), 'fields'):
+                raise SparseFieldsError(f'У поля {prefix + name} нет вложенных полей')
+            _select_fields(serializer.fields[name], fields[name], f'{prefix}{name}.')
+
+
+class SparseFieldsMixin:
+    """
+    Сериализатор с выбором полей: ProductInfoSerializer(page, many=True, fields=parse_fields('id,product.name'))
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            _select_fields(self, fields)
 
 
 @extend_schema_serializer(
@@ -153,7 +223,7 @@ class ProductParameterSerializer(serializers.ModelSerializer):
         )
     ]
 )
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_parameters = ProductParameterSerializer(read_only=True, many=True)
 
@@ -162,6 +232,23 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         fields = ('id', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'product_parameters',)
         read_only_fields = ('id',)
 
+    @staticmethod
+    def setup_queryset(queryset, fields=None):
+        """
+        Подгружает только связи, нужные для запрошенных полей: без product_parameters нет запроса параметров
+        """
+        if requested(fields, 'product.category'):
+            queryset = queryset.select_related('product__category')
+        elif requested(fields, 'product'):
+            queryset = queryset.select_related('product')
+        if requested(fields, 'product_parameters.parameter'):
+            queryset = queryset.prefetch_related(Prefetch(
+                'product_parameters', queryset=ProductParameter.objects.select_related('parameter').order_by('id')))
+        elif requested(fields, 'product_parameters'):
+            queryset = queryset.prefetch_related(Prefetch('product_parameters',
+                                                          queryset=ProductParameter.objects.order_by('id')))
+        return queryset
+
 
 @extend_schema_serializer(
     examples=[
@@ -238,3 +325,55 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact',)
         read_only_fields = ('id',)
+
+
+class OrderSummarySerializer(OrderSerializer):
+    """
+    Сводка по заказу для списка истории заказов, без позиций
+    """
+
+    class Meta(OrderSerializer.Meta):
+        fields = ('id', 'state', 'dt', 'total_sum', 'contact',)
+
+
+@extend_schema_serializer(
+    examples=[
+        OpenApiExample(
+            name="Пример импорта прайс-листа",
+            value={
+                "id": 1,
+                "source": "url",
+                "url": "https://example.com/shop1.yaml",
+                "state": "done",
+                "content_hash": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08",
+                "bytes_read": 1048576,
+                "goods_parsed": 2000,
+                "rows_written": 8000,
+                "inserted": 10,
+                "updated": 25,
+                "unchanged": 1965,
+                "removed": 3,
+                "fetch_time": 1.2,
+                "parse_time": 3.4,
+                "write_time": 5.6,
+                "error": "",
+                "created_at": "2024-01-01T12:00:00Z",
+                "started_at": "2024-01-01T12:00:01Z",
+                "finished_at": "2024-01-01T12:00:12Z"
+            }
+        )
+    ]
+)
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'source', 'url', 'state', 'content_hash', 'bytes_read', 'goods_parsed', 'rows_written',
+                  'inserted', 'updated', 'unchanged', 'removed', 'fetch_time', 'parse_time', 'write_time', 'error',
+                  'created_at', 'started_at', 'finished_at',)
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # пока импорт выполняется, счётчики берутся из кеша прогресса
+        data.update(instance.get_progress())
+        return data
@@ -2,11 +2,14 @@ from typing import Type
 
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from backend.models import ConfirmEmailToken, User, Product
+from backend.catalog_cache import bump_catalog_version
+from backend.checkout import refresh_order_total
+from backend.models import ConfirmEmailToken, User, Product, ProductInfo, ProductParameter, Shop, Category, Order, \
+    OrderItem
 from .tasks import send_email, process_avatar, process_product_image
 
 new_user_registered = Signal()
@@ -79,3 +82,96 @@ def handle_product_image_upload(sender, instance, created, **kwargs):
     if created and instance.image:
         # Запускаем задачу Celery для обработки изображения товара
         process_product_image.delay(instance.id)
+
+
+def product_infos_changed(product_infos, *scopes):
+    """
+    Товары изменены не импортом (админка и т.п.) - списки каталога с ними устаревают
+    """
+    scopes = {'products', *scopes}
+    for shop_id, category_id in product_infos.values_list('shop_id', 'category_id').distinct():
+        scopes.add(f'shop:{shop_id}')
+        if category_id is not None:
+            scopes.add(f'category:{category_id}')
+    bump_catalog_version(*scopes)
+
+
+# поля продукта, которые видны в каталоге
+CATALOG_PRODUCT_FIELDS = {'name', 'category'}
+
+
+@receiver(post_save, sender=Product)
+def sync_product_info_category(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Переносим смену категории продукта в копию категории у его ProductInfo; название и категория
+    видны в списках товаров, поэтому их версии (и версия прежней категории) увеличиваются
+    """
+    if created or not (update_fields is None or CATALOG_PRODUCT_FIELDS & set(update_fields)):
+        return
+    product_infos = ProductInfo.objects.filter(product=instance)
+    moved = product_infos.exclude(category_id=instance.category_id)
+    old_categories = {f'category:{category_id}' for category_id in moved.values_list('category_id', flat=True)
+                      if category_id is not None}
+    moved.update(category_id=instance.category_id)
+    product_infos_changed(product_infos, *old_categories)
+
+
+@receiver(pre_save, sender=ProductInfo)
+def set_product_info_category(sender, instance, **kwargs):
+    """
+    ProductInfo, созданный или изменённый не импортом (например, через админку), получает копию категории продукта
+    """
+    if instance.product_id is not None:
+        instance.category_id = instance.product.category_id
+
+
+@receiver(post_save, sender=ProductInfo)
+def product_info_catalog_changed(sender, instance, **kwargs):
+    """
+    Цена, остаток или статус товара изменены через админку - ответы каталога устаревают.
+    Импорт пишет через bulk_create/bulk_update без сигналов и увеличивает версии сам;
+    удаление обрабатывается в админке (post_delete отключил бы быстрое каскадное удаление).
+    """
+    product_infos_changed(ProductInfo.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ProductParameter)
+def product_parameter_catalog_changed(sender, instance, **kwargs):
+    """
+    Параметр товара изменён через админку - ответы каталога и фильтры по параметрам устаревают
+    """
+    product_infos_changed(ProductInfo.objects.filter(pk=instance.product_info_id))
+
+
+# поля магазина, которые видны в каталоге; сохранение служебных полей (расписание обновления и т.п.) версию не меняет
+CATALOG_SHOP_FIELDS = {'name', 'state'}
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def shop_catalog_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    Магазин изменён или удалён (например, через админку) - ответы каталога устаревают
+    """
+    if update_fields is None or CATALOG_SHOP_FIELDS & set(update_fields):
+        bump_catalog_version('base', f'shop:{instance.pk}')
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_catalog_changed(sender, instance, **kwargs):
+    """
+    Категория изменена или удалена - ответы каталога устаревают
+    """
+    bump_catalog_version('base', f'category:{instance.pk}')
+
+
+@receiver(post_save, sender=OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    """
+    Позиция оформленного заказа изменена (например, через админку) - пересчитываем сохранённую сумму заказа.
+    Удаление позиций пересчитывается в админке: приёмник post_delete отключил бы быстрое каскадное удаление
+    заказов и товаров.
+    """
+    if Order.objects.filter(pk=instance.order_id).exclude(state='basket').exists():
+        refresh_order_total(instance.order_id)
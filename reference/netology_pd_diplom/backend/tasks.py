@@ -1,13 +1,31 @@
 # backend/tasks.py
+from contextlib import contextmanager
+
 from celery import shared_task
 from django.core.mail import EmailMultiAlternatives
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+import datetime
+import hashlib
+import logging
+import os
+import random
+import time
+import uuid
 import yaml
 import requests
+import sentry_sdk
 from easy_thumbnails.files import get_thumbnailer
-from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, User
+from .facets import refresh_shop_facets
+from .feeds import FeedDownloadError, FeedFormatError, FeedNotModified, download_feed, iter_feed
+from .importer import ProductImporter
+from .models import Product, Shop, User, ImportJob, IMPORT_FINISHED_STATES, IMPORT_STATE_CHOICES
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task(bind=True, max_retries=3)
@@ -24,99 +42,398 @@ def send_email(self, subject, message, recipient_list):
         self.retry(exc=e, countdown=60)  # Повторить через 60 секунд
 
 
-def load_data_to_db(data, shop):
+def load_data_to_db(data, shop, batch_size=None):
     """
     Загрузка данных из словаря в базу данных для указанного магазина.
+    Возвращает статистику импорта (количество строк и скорость записи).
     """
-    from django.db import transaction
-
-    with transaction.atomic():
-        # Обновляем или создаем категории
-        for category in data.get('categories', []):
-            category_obj, _ = Category.objects.get_or_create(
-                id=category['id'],
-                defaults={'name': category['name']}
-            )
-            if category_obj.name != category['name']:
-                category_obj.name = category['name']
-                category_obj.save()
-            category_obj.shops.add(shop)
-            category_obj.save()
-
-        # Удаляем старую информацию о товарах для этого магазина
-        ProductInfo.objects.filter(shop=shop).delete()
-
-        # Обрабатываем товары
-        for item in data.get('goods', []):
-            product, _ = Product.objects.get_or_create(
-                name=item['name'],
-                category_id=item['category'],
-                defaults={'name': item['name']}
-            )
-            product_info = ProductInfo.objects.create(
-                product=product,
-                external_id=item['id'],
-                model=item.get('model', ''),
-                price=item['price'],
-                price_rrc=item.get('price_rrc', 0),
-                quantity=item['quantity'],
-                shop=shop
-            )
-            for param_name, param_value in item.get('parameters', {}).items():
-                parameter, _ = Parameter.objects.get_or_create(name=param_name)
-                ProductParameter.objects.create(
-                    product_info=product_info,
-                    parameter=parameter,
-                    value=param_value
-                )
+    importer = ProductImporter(shop, batch_size=batch_size)
+    stats = importer.run(data)
+    schedule_facets(importer)
+    return stats
 
 
-@shared_task
-def do_import(shop_id):
-    # Получаем магазин по ID
-    try:
-        shop = Shop.objects.get(id=shop_id)
-    except Shop.DoesNotExist:
-        # Логируем ошибку или уведомляем администратора
-        print(f"Магазин с ID {shop_id} не найден.")
-        return
+def load_feed_to_db(stream, shop, batch_size=None, on_progress=None):
+    """
+    Потоковая загрузка прайс-листа из файлового объекта: товары разбираются
+    и записываются в базу пачками, без загрузки всего документа в память.
+    """
+    importer = ProductImporter(shop, batch_size=batch_size, on_progress=on_progress)
+    stats = importer.run_feed(iter_feed(stream, chunk_size=importer.batch_size))
+    schedule_facets(importer)
+    return stats
 
-    url = shop.url
 
-    # Проверка наличия URL
-    if not url:
-        # Нет URL для импорта, логируем или уведомляем администратора
-        print(f"У магазина '{shop.name}' не указан URL для импорта.")
-        return
+def schedule_facets(importer):
+    """
+    Пересчёт фасетов после фиксации импорта отдельной задачей: внутри транзакции импорта он
+    конфликтовал бы с параллельными импортами других магазинов тех же категорий
+    """
+    if importer.facets_stale:
+        shop_id = importer.shop.id
+        transaction.on_commit(lambda: refresh_facets.delay(shop_id))
+
+
+def start_import(shop, source, url=None, file=None):
+    """
+    Единая точка запуска импорта прайс-листа для API партнёра, админки и загрузки файла.
+
+    Загруженный файл сохраняется в хранилище (default_storage, общее для web и воркеров Celery),
+    в брокер уходит только ИД задачи импорта, а не содержимое прайс-листа.
+    """
+    job = ImportJob.objects.create(shop=shop, source=source, url=url, file=file)
+    transaction.on_commit(lambda: do_import.delay(job.id))
+    return job
+
+
+def open_feed(job, on_progress=None):
+    """
+    Открывает источник задачи импорта: загруженный файл или прайс-лист по ссылке.
+    Возвращает файловый объект, SHA-256 содержимого и HTTP-валидаторы для ссылки магазина
+    (None для других источников).
+    """
+    if job.file:
+        feed_file = job.file.open('rb')
+        content_hash = hashlib.sha256()
+        for block in feed_file.chunks():
+            content_hash.update(block)
+        feed_file.seek(0)
+        return feed_file, content_hash.hexdigest(), None
 
+    # Проверка наличия URL
+    if not job.url:
+        raise FeedDownloadError(f"У магазина '{job.shop.name}' не указан URL для импорта.")
     # Проверяем, что URL валидный
-    validate_url = URLValidator()
+    URLValidator()(job.url)
+    if job.url != job.shop.url:
+        feed_file, content_hash, _ = download_feed(job.url, on_progress=on_progress)
+        return feed_file, content_hash, None
+    # условный запрос: сохранённые валидаторы относятся только к ссылке магазина
+    return download_feed(job.url, on_progress=on_progress, etag=job.shop.feed_etag,
+                         last_modified=job.shop.feed_last_modified)
+
+
+def remember_feed(job, validators):
+    """
+    Запоминает хеш и HTTP-валидаторы загруженного прайс-листа для следующих импортов.
+    Данные из другого источника сбрасывают валидаторы ссылки магазина.
+    """
+    Shop.objects.filter(pk=job.shop_id).update(feed_hash=job.content_hash,
+                                               feed_etag=(validators or {}).get('etag', ''),
+                                               feed_last_modified=(validators or {}).get('last_modified', ''))
+
+
+# освобождение и продление ключа блокировки в Redis, только если в нём ещё токен этого воркера
+RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+EXTEND_LOCK_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                      "return redis.call('expire', KEYS[1], ARGV[2]) end return 0")
+
+
+def _owned_key(script, key, token, *args):
+    """
+    Выполняет script над ключом кеша key, если ключ хранит token. На django-redis - атомарно скриптом Lua,
+    на других бэкендах кеша (LocMemCache в тестах) - чтением и записью.
+    """
+    client = getattr(cache, 'client', None)
+    if hasattr(client, 'get_client'):
+        return bool(client.get_client(write=True).eval(script, 1, cache.make_key(key), client.encode(token), *args))
+    if cache.get(key) != token:
+        return False
+    if script == RELEASE_LOCK_SCRIPT:
+        return cache.delete(key)
+    return cache.touch(key, *args)
+
+
+class ImportLock:
+    """
+    Распределённая блокировка импорта в кеше (Redis): не больше одного импорта на магазин
+    и не больше IMPORT_MAX_CONCURRENCY импортов одновременно на всех воркерах.
+
+    Ключи хранят уникальный токен воркера: блокировку, истёкшую по таймауту и взятую другим воркером,
+    прежний владелец не продлевает и не снимает.
+    """
+
+    def __init__(self, shop_id):
+        self.shop_key = self.shop_lock_key(shop_id)
+        self.slot_key = None
+        self.token = uuid.uuid4().hex
+        self.extended_at = None
+
+    @staticmethod
+    def shop_lock_key(shop_id):
+        return f'import-lock:shop:{shop_id}'
+
+    @classmethod
+    def is_held(cls, shop_id):
+        """
+        Идёт ли сейчас импорт магазина на каком-либо воркере
+        """
+        return cache.get(cls.shop_lock_key(shop_id)) is not None
+
+    def acquire(self):
+        # ключи создаются с таймаутом, чтобы упавший воркер не держал блокировку вечно
+        if not cache.add(self.shop_key, self.token, timeout=settings.IMPORT_LOCK_TIMEOUT):
+            return False
+        for slot in range(settings.IMPORT_MAX_CONCURRENCY):
+            if cache.add(f'import-slot:{slot}', self.token, timeout=settings.IMPORT_LOCK_TIMEOUT):
+                self.slot_key = f'import-slot:{slot}'
+                self.extended_at = time.monotonic()
+                return True
+        _owned_key(RELEASE_LOCK_SCRIPT, self.shop_key, self.token)
+        return False
+
+    def extend(self):
+        """
+        Продлевает таймаут ключей для долгого импорта; вызывается из отчётов о прогрессе,
+        поэтому в кеш обращается не чаще раза в четверть IMPORT_LOCK_TIMEOUT
+        """
+        if time.monotonic() - self.extended_at < settings.IMPORT_LOCK_TIMEOUT / 4:
+            return
+        self.extended_at = time.monotonic()
+        for key in (self.shop_key, self.slot_key):
+            _owned_key(EXTEND_LOCK_SCRIPT, key, self.token, settings.IMPORT_LOCK_TIMEOUT)
+
+    def release(self):
+        for key in (self.slot_key, self.shop_key):
+            _owned_key(RELEASE_LOCK_SCRIPT, key, self.token)
+
+
+@contextmanager
+def import_lock(shop_id):
+    """
+    Блокировка импорта магазина (см. ImportLock). Выдаёт ImportLock или None, если блокировку взять не удалось.
+    """
+    lock = ImportLock(shop_id)
+    if not lock.acquire():
+        yield None
+        return
     try:
-        validate_url(url)
-    except ValidationError as e:
-        # URL невалидный, логируем или уведомляем администратора
-        print(f"Некорректный URL '{url}' для магазина '{shop.name}': {str(e)}")
+        yield lock
+    finally:
+        lock.release()
+
+
+def free_import_slots():
+    """
+    Количество свободных слотов IMPORT_MAX_CONCURRENCY
+    """
+    busy = cache.get_many([f'import-slot:{slot}' for slot in range(settings.IMPORT_MAX_CONCURRENCY)])
+    return settings.IMPORT_MAX_CONCURRENCY - len(busy)
+
+
+def refresh_delay(shop):
+    """
+    Время до следующего обновления магазина: интервал с экспоненциальной задержкой после
+    неудачных обновлений и случайной добавкой, чтобы обновления магазинов не совпадали по времени
+    """
+    minutes = min(shop.refresh_interval * 2 ** shop.refresh_failures,
+                  max(shop.refresh_interval, settings.IMPORT_REFRESH_MAX_BACKOFF))
+    return datetime.timedelta(minutes=minutes * (1 + random.uniform(0, settings.IMPORT_REFRESH_JITTER)))
+
+
+def schedule_refresh(job):
+    """
+    Планирует следующее обновление магазина после импорта по его ссылке
+    """
+    shop = Shop.objects.get(pk=job.shop_id)
+    if not shop.refresh_interval or job.url != shop.url:
         return
+    shop.refresh_failures = shop.refresh_failures + 1 if job.state == 'failed' else 0
+    shop.next_refresh_at = timezone.now() + refresh_delay(shop)
+    Shop.objects.filter(pk=shop.pk).update(refresh_failures=shop.refresh_failures,
+                                           next_refresh_at=shop.next_refresh_at)
+
+
+def fail_stale_jobs(now=None):
+    """
+    Помечает ошибкой задачи импорта, брошенные упавшим воркером: незавершённые дольше IMPORT_JOB_TIMEOUT,
+    магазин которых не заблокирован идущим импортом. Возвращает количество таких задач.
+    """
+    now = now or timezone.now()
+    active_states = [state for state, _ in IMPORT_STATE_CHOICES if state not in IMPORT_FINISHED_STATES]
+    stale = ImportJob.objects.filter(
+        state__in=active_states, created_at__lt=now - datetime.timedelta(seconds=settings.IMPORT_JOB_TIMEOUT))
+    failed = 0
+    for job in stale:
+        if ImportLock.is_held(job.shop_id):
+            continue
+        # условие на статус: задача, завершившаяся между выборкой и обновлением, не перезаписывается
+        if ImportJob.objects.filter(pk=job.pk, state__in=active_states).update(
+                state='failed', error='Импорт прерван: задача не завершилась за отведённое время', finished_at=now):
+            logger.warning('Задача импорта %s магазина %s брошена в статусе %s', job.id, job.shop_id, job.state)
+            if job.file:
+                job.file.delete(save=False)
+            failed += 1
+    return failed
+
+
+@shared_task
+def refresh_feeds():
+    """
+    Запуск обновлений прайс-листов по расписанию (Celery beat, раз в минуту).
+
+    Магазины без даты следующего обновления получают случайную дату в пределах интервала,
+    запускается не больше импортов, чем свободно слотов IMPORT_MAX_CONCURRENCY. Магазины с незавершённым
+    импортом пропускаются; брошенные задачи сначала помечаются ошибкой (см. fail_stale_jobs).
+    """
+    now = timezone.now()
+    fail_stale_jobs(now)
+    shops = Shop.objects.filter(refresh_interval__isnull=False).exclude(url__isnull=True).exclude(url='')
+
+    for shop in shops.filter(next_refresh_at__isnull=True):
+        shop.next_refresh_at = now + datetime.timedelta(minutes=random.uniform(0, shop.refresh_interval))
+        shop.save(update_fields=['next_refresh_at'])
+
+    active_states = [state for state, _ in IMPORT_STATE_CHOICES if state not in IMPORT_FINISHED_STATES]
+    due = shops.filter(next_refresh_at__lte=now).exclude(
+        import_jobs__state__in=active_states).order_by('next_refresh_at')[:free_import_slots()]
+    started = 0
+    for shop in due:
+        # дата сдвигается сразу, чтобы магазин не запускался повторно, пока идёт импорт
+        shop.next_refresh_at = now + refresh_delay(shop)
+        shop.save(update_fields=['next_refresh_at'])
+        start_import(shop, 'schedule', url=shop.url)
+        started += 1
+    return started
+
+
+def import_result(job):
+    """
+    Краткий итог задачи импорта для агрегирования в import_summary
+    """
+    return {'job': job.id, 'shop': job.shop_id, 'state': job.state, 'rows_written': job.rows_written,
+            'error': job.error}
+
 
+@shared_task(bind=True, max_retries=None)
+def do_import(self, job_id):
+    """
+    Загрузка прайс-листа из задачи импорта в базу данных.
+
+    Пока идёт импорт этого же магазина или заняты все слоты IMPORT_MAX_CONCURRENCY, задача
+    откладывается и повторяется позже.
+    """
     try:
-        # Получаем данные из URL
-        response = requests.get(url)
-        response.raise_for_status()
-        data = yaml.safe_load(response.content)
+        job = ImportJob.objects.select_related('shop').get(id=job_id)
+    except ImportJob.DoesNotExist:
+        logger.warning('Задача импорта с ID %s не найдена', job_id)
+        return None
+
+    if job.state in IMPORT_FINISHED_STATES:
+        return import_result(job)
+
+    with import_lock(job.shop_id) as lock:
+        if lock:
+            run_import_job(job, lock)
+            return import_result(job)
+
+    if self.request.retries >= settings.IMPORT_LOCK_RETRIES:
+        job.state = 'failed'
+        job.error = 'Не удалось дождаться завершения других импортов магазина'
+        job.finished_at = timezone.now()
+        job.save(update_fields=['state', 'error', 'finished_at'])
+        return import_result(job)
+    # случайная добавка к задержке, чтобы отложенные задачи не просыпались одновременно
+    delay = settings.IMPORT_LOCK_RETRY_DELAY
+    raise self.retry(countdown=delay + random.randint(0, delay))
+
 
-        # Загружаем данные в базу данных
-        load_data_to_db(data, shop)
+@shared_task
+def import_summary(results):
+    """
+    Сводка по группе импортов (callback для chord из команды import_shops)
+    """
+    results = [result for result in results if result]
+    summary = {'jobs': len(results), 'rows_written': sum(result['rows_written'] for result in results)}
+    for state in IMPORT_FINISHED_STATES:
+        summary[state] = sum(1 for result in results if result['state'] == state)
+    summary['errors'] = {result['shop']: result['error'] for result in results if result['state'] == 'failed'}
+    return summary
+
+
+def run_import_job(job, lock=None):
+    """
+    Загрузка, проверка на повтор и запись прайс-листа задачи импорта.
 
-        print(f"Данные успешно импортированы для магазина '{shop.name}'.")
-    except requests.exceptions.RequestException as e:
+    Прайс-лист по ссылке магазина запрашивается условно (If-None-Match / If-Modified-Since):
+    при ответе 304 или совпадении хеша с последним загруженным разбор и запись пропускаются.
+    Блокировка lock продлевается при каждом отчёте о прогрессе.
+    """
+    job.state = 'fetching'
+    job.started_at = timezone.now()
+    job.save(update_fields=['state', 'started_at'])
+
+    def report_download(bytes_read):
+        if lock:
+            lock.extend()
+        job.set_progress(state='fetching', bytes_read=bytes_read)
+
+    def report_import(stats):
+        if lock:
+            lock.extend()
+        job.set_progress(state='importing', bytes_read=job.bytes_read, goods_parsed=stats.goods,
+                         rows_written=stats.rows)
+
+    try:
+        started = time.monotonic()
+        feed_file, job.content_hash, validators = open_feed(job, on_progress=report_download)
+        with feed_file:
+            job.bytes_read = feed_file.seek(0, os.SEEK_END)
+            feed_file.seek(0)
+            job.fetch_time = time.monotonic() - started
+
+            if job.is_duplicate():
+                job.state = 'skipped'
+                if validators is not None:
+                    # содержимое то же, сохраняем новые валидаторы, чтобы следующий запрос вернул 304
+                    remember_feed(job, validators)
+            else:
+                job.state = 'importing'
+                job.save(update_fields=['state', 'bytes_read', 'content_hash', 'fetch_time'])
+                stats = load_feed_to_db(feed_file, job.shop, on_progress=report_import)
+    except FeedNotModified:
+        job.state = 'skipped'
+        job.fetch_time = time.monotonic() - started
+    except (ValidationError, requests.exceptions.RequestException, FeedDownloadError) as e:
         # Обработка ошибок запроса
-        print(f"Ошибка при запросе к URL '{url}' для магазина '{shop.name}': {str(e)}")
-    except yaml.YAMLError as e:
-        # Ошибка при разборе YAML
-        print(f"Ошибка при обработке YAML для магазина '{shop.name}': {str(e)}")
+        job.state = 'failed'
+        job.error = f"Ошибка при запросе к URL '{job.url}': {e}"
+    except (yaml.YAMLError, FeedFormatError) as e:
+        # Ошибка при разборе прайс-листа
+        job.state = 'failed'
+        job.error = f'Ошибка при разборе прайс-листа: {e}'
     except Exception as e:
-        # Непредвиденная ошибка
-        print(f"Непредвиденная ошибка при импорте данных для магазина '{shop.name}': {str(e)}")
+        # Непредвиденная ошибка, логируем в Sentry
+        sentry_sdk.capture_exception(e)
+        job.state = 'failed'
+        job.error = f'Непредвиденная ошибка при импорте данных: {e}'
+    else:
+        if job.state == 'importing':
+            job.state = 'done'
+            job.goods_parsed = stats.goods
+            job.rows_written = stats.rows
+            job.inserted = stats.inserted
+            job.updated = stats.updated
+            job.unchanged = stats.unchanged
+            job.removed = stats.removed
+            job.parse_time = stats.parse_time
+            job.write_time = stats.write_time
+            remember_feed(job, validators)
+
+    if job.file:
+        # загруженный файл больше не нужен
+        job.file.delete(save=False)
+    job.finished_at = timezone.now()
+    job.save()
+    schedule_refresh(job)
+
+
+@shared_task
+def refresh_facets(shop_id):
+    """
+    Пересчёт фасетов категорий магазина (например, после смены статуса магазина)
+    """
+    refresh_shop_facets(shop_id)
 
 
 @shared_task
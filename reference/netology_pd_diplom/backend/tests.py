@@ -1,14 +1,43 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import tempfile
+from unittest.mock import patch
+
+import requests
+import yaml
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.core import mail
+from django.core.management import call_command
+from django.conf import settings
 from django.core.cache import cache
 from django.contrib.auth import get_user_model
+from django.contrib.admin import site
+from django.db import connection
+from django.db.models import F
 from django.dispatch import Signal
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
 # Импортируем сигналы и ресиверы
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from backend.models import Order
+from backend.models import Order, OrderItem, Shop, Category, ProductInfo, Parameter, ProductParameter, ImportJob, \
+    Contact
 from backend.signals import new_order
+from backend.catalog_cache import product_scopes
+from backend.checkout import cancel_order
+from backend.fast_serializers import orders_data, product_info_rows, product_infos_data
+from backend.feeds import FeedFormatError, iter_feed
+from backend.renderers import UJSONRenderer
+from backend.serializers import OrderSerializer, ProductInfoSerializer, parse_fields
+from backend.search import stem
+from backend.tasks import load_data_to_db, load_feed_to_db, do_import, import_lock, refresh_feeds
 
 User = get_user_model()
 
@@ -130,3 +159,1236 @@ class ThrottlingTestCase(TestCase):
     def tearDown(self):
         # Очистка кеша после каждого теста
         cache.clear()
+
+
+def make_feed(goods_count, shop_name='Тестовый магазин'):
+    """
+    Формирует прайс-лист в формате shop1.yaml с заданным количеством товаров
+    """
+    return {
+        'shop': shop_name,
+        'categories': [{'id': 224, 'name': 'Смартфоны'}, {'id': 15, 'name': 'Аксессуары'}],
+        'goods': [
+            {
+                'id': 1000 + index,
+                'category': 224 if index % 2 else 15,
+                'model': f'model/{index}',
+                'name': f'Товар {index}',
+                'price': 100 + index,
+                'price_rrc': 150 + index,
+                'quantity': index,
+                'parameters': {'Цвет': 'черный', 'Встроенная память (Гб)': 256},
+            }
+            for index in range(goods_count)
+        ],
+    }
+
+
+def catalog_queries(context):
+    """
+    Запросы к таблицам backend без служебных запросов профилировщика silk
+    """
+    return [query['sql'] for query in context.captured_queries
+            if 'backend_' in query['sql'] and not query['sql'].startswith(('EXPLAIN', 'INSERT INTO "silk'))]
+
+
+class ProductImporterTestCase(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(name='Тестовый магазин')
+
+    def test_import_creates_rows(self):
+        """
+        Тестирует, что импорт создаёт категории, товары и параметры и привязывает категории к магазину.
+        """
+        stats = load_data_to_db(make_feed(10), self.shop)
+
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 10)
+        self.assertEqual(ProductParameter.objects.filter(product_info__shop=self.shop).count(), 20)
+        self.assertEqual(set(self.shop.categories.values_list('id', flat=True)), {224, 15})
+        self.assertEqual(stats.inserted, 10)
+        self.assertEqual(
+            ProductParameter.objects.get(product_info__external_id=1000, parameter__name='Встроенная память (Гб)').value,
+            '256')
+
+    def test_query_count_does_not_depend_on_feed_size(self):
+        """
+        Тестирует, что количество запросов к БД не растёт с размером прайс-листа.
+        """
+        with CaptureQueriesContext(connection) as small:
+            load_data_to_db(make_feed(5), self.shop, batch_size=1000)
+        Category.objects.all().delete()
+        Parameter.objects.all().delete()
+        with CaptureQueriesContext(connection) as large:
+            load_data_to_db(make_feed(40), self.shop, batch_size=1000)
+
+        self.assertEqual(len(small), len(large))
+
+    def test_reimport_updates_only_changed_rows(self):
+        """
+        Тестирует, что повторный импорт обновляет изменённые товары, пропускает неизменённые
+        и снимает с продажи пропавшие, не удаляя позиции заказов.
+        """
+        feed = make_feed(5)
+        load_data_to_db(feed, self.shop)
+        user = User.objects.create_user(email='buyer@example.com', password='password123')
+        order = Order.objects.create(user=user, state='basket')
+        removed_info = ProductInfo.objects.get(shop=self.shop, external_id=1004)
+        OrderItem.objects.create(order=order, product_info=removed_info, quantity=1)
+
+        feed['goods'][0]['price'] = 999
+        feed['goods'][1]['parameters'] = {'Цвет': 'белый'}
+        del feed['goods'][4]
+        stats = load_data_to_db(feed, self.shop)
+
+        self.assertEqual((stats.inserted, stats.updated, stats.unchanged, stats.removed), (0, 2, 2, 1))
+        self.assertEqual(ProductInfo.objects.get(shop=self.shop, external_id=1000).price, 999)
+        self.assertEqual(
+            list(ProductParameter.objects.filter(product_info__external_id=1001).values_list('value', flat=True)),
+            ['белый'])
+        removed_info.refresh_from_db()
+        self.assertFalse(removed_info.is_active)
+        self.assertTrue(OrderItem.objects.filter(order=order).exists())
+
+
+class FeedParserTestCase(TestCase):
+    def test_streaming_parser_matches_safe_load(self):
+        """
+        Тестирует, что потоковый разбор прайс-листа даёт те же данные, что и yaml.safe_load.
+        """
+        content = yaml.safe_dump(make_feed(7), allow_unicode=True).encode()
+        parsed = {'categories': [], 'goods': []}
+        chunks = []
+        for section, value in iter_feed(io.BytesIO(content), chunk_size=3):
+            if section == 'shop':
+                parsed['shop'] = value
+            else:
+                parsed[section].extend(value)
+                chunks.append(len(value))
+
+        self.assertEqual(parsed, yaml.safe_load(content))
+        self.assertEqual(chunks, [2, 3, 3, 1])
+
+    def _parse(self, content):
+        parsed = {'categories': [], 'goods': []}
+        for section, value in iter_feed(io.BytesIO(content), chunk_size=3):
+            if section != 'shop':
+                parsed[section].extend(value)
+        return parsed
+
+    def test_formats_are_detected(self):
+        """
+        Тестирует, что сжатый YAML, JSON Lines и CSV разбираются в те же данные, что и YAML.
+        """
+        feed = make_feed(7)
+        expected = {'categories': feed['categories'], 'goods': feed['goods']}
+        for good in expected['goods']:
+            good['parameters'] = {name: str(value) for name, value in good['parameters'].items()}
+
+        jsonl = '\n'.join(
+            [json.dumps({'type': 'shop', 'name': feed['shop']})] +
+            [json.dumps({'type': 'category', **category}) for category in feed['categories']] +
+            [json.dumps({'type': 'good', **good}) for good in expected['goods']])
+
+        categories = {category['id']: category['name'] for category in feed['categories']}
+        csv_file = io.StringIO()
+        writer = csv.writer(csv_file, delimiter=';')
+        writer.writerow(['id', 'category', 'category_name', 'name', 'model', 'price', 'price_rrc', 'quantity',
+                         'parameters.Цвет', 'parameters.Встроенная память (Гб)'])
+        for good in feed['goods']:
+            writer.writerow([good['id'], good['category'], categories[good['category']], good['name'], good['model'],
+                             good['price'], good['price_rrc'], good['quantity'], *good['parameters'].values()])
+
+        yaml_feed = make_feed(7)
+        self.assertEqual(self._parse(gzip.compress(yaml.safe_dump(yaml_feed, allow_unicode=True).encode())),
+                         {'categories': yaml_feed['categories'], 'goods': yaml_feed['goods']})
+        self.assertEqual(self._parse(gzip.compress(jsonl.encode())), expected)
+
+        parsed = self._parse(csv_file.getvalue().encode())
+        self.assertEqual(sorted(parsed['categories'], key=lambda category: category['id']),
+                         sorted(expected['categories'], key=lambda category: category['id']))
+        self.assertEqual(parsed['goods'], expected['goods'])
+
+    def test_yaml_with_leading_comment(self):
+        """
+        Тестирует, что YAML, начинающийся с комментария с запятой, не принимается за CSV.
+        """
+        feed = make_feed(3)
+        content = ('# прайс-лист, выгрузка 2024-01-01\n\n' + yaml.safe_dump(feed, allow_unicode=True)).encode()
+        self.assertEqual(self._parse(content), {'categories': feed['categories'], 'goods': feed['goods']})
+
+    def test_corrupt_feed(self):
+        """
+        Тестирует, что повреждённый сжатый прайс-лист даёт ошибку формата.
+        """
+        content = gzip.compress(yaml.safe_dump(make_feed(3)).encode())[:-20]
+        with self.assertRaises(FeedFormatError):
+            self._parse(content)
+
+    def test_load_feed_to_db(self):
+        """
+        Тестирует потоковую загрузку прайс-листа в базу данных.
+        """
+        shop = Shop.objects.create(name='Тестовый магазин')
+        content = yaml.safe_dump(make_feed(5), allow_unicode=True).encode()
+
+        stats = load_feed_to_db(io.BytesIO(content), shop, batch_size=2)
+
+        self.assertEqual(stats.inserted, 5)
+        self.assertEqual(ProductInfo.objects.filter(shop=shop).count(), 5)
+
+
+class PartnerImportTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='shop@example.com', password='password123', type='shop',
+                                             is_active=True)
+        self.shop = Shop.objects.create(name='Тестовый магазин', user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _feed_file(self, goods_count=3):
+        feed_file = tempfile.TemporaryFile()
+        feed_file.write(yaml.safe_dump(make_feed(goods_count), allow_unicode=True).encode())
+        feed_file.seek(0)
+        return feed_file
+
+    def test_update_by_url_returns_job_and_imports_in_task(self):
+        """
+        Тестирует, что partner/update сразу возвращает 202 с задачей импорта, а загрузка идёт в задаче Celery.
+        """
+        with patch.object(do_import, 'delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('backend:partner-update'), {'url': 'https://example.com/shop.yaml'})
+        self.assertEqual(response.status_code, 202)
+        job = ImportJob.objects.get(id=response.json()['Job'])
+        self.assertEqual(job.state, 'pending')
+        delay.assert_called_once_with(job.id)
+
+        with patch('backend.tasks.download_feed', return_value=(self._feed_file(), 'hash', None)):
+            do_import(job.id)
+
+        response = self.client.get(reverse('backend:partner-import-status', args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], 'done')
+        self.assertEqual(response.json()['goods_parsed'], 3)
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 3)
+
+    def test_update_by_file_goes_through_storage(self):
+        """
+        Тестирует, что загруженный файл передаётся в задачу через хранилище, а не через брокер.
+        """
+        upload = SimpleUploadedFile('shop.yaml', yaml.safe_dump(make_feed(4), allow_unicode=True).encode())
+        with patch.object(do_import, 'delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('backend:partner-update'), {'file': upload})
+        self.assertEqual(response.status_code, 202)
+        job = ImportJob.objects.get(id=response.json()['Job'])
+        self.assertEqual(job.source, 'file')
+        self.assertTrue(job.file)
+        delay.assert_called_once_with(job.id)
+
+        do_import(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'done')
+        self.assertFalse(job.file)
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 4)
+
+    def test_identical_feed_is_skipped(self):
+        """
+        Тестирует, что повторная загрузка того же прайс-листа не записывает каталог заново.
+        """
+        first = ImportJob.objects.create(shop=self.shop, url='https://example.com/shop.yaml')
+        with patch('backend.tasks.download_feed', return_value=(self._feed_file(), 'hash', None)):
+            do_import(first.id)
+        second = ImportJob.objects.create(shop=self.shop, url='https://example.com/shop.yaml')
+        with patch('backend.tasks.download_feed', return_value=(self._feed_file(), 'hash', None)), \
+                patch('backend.tasks.load_feed_to_db') as load_feed:
+            do_import(second.id)
+
+        second.refresh_from_db()
+        self.assertEqual(second.state, 'skipped')
+        load_feed.assert_not_called()
+
+        response = self.client.get(reverse('backend:partner-imports'))
+        self.assertEqual([job['state'] for job in response.json()], ['skipped', 'done'])
+
+    def test_not_modified_feed_is_skipped(self):
+        """
+        Тестирует условную загрузку по ссылке магазина: при ответе 304 прайс-лист не разбирается.
+        """
+        self.shop.url = 'https://example.com/shop.yaml'
+        self.shop.save()
+        first = ImportJob.objects.create(shop=self.shop, url=self.shop.url)
+        validators = {'etag': '"v1"', 'last_modified': 'Wed, 01 Jan 2025 00:00:00 GMT'}
+        with patch('backend.tasks.download_feed', return_value=(self._feed_file(), 'hash', validators)):
+            do_import(first.id)
+        self.shop.refresh_from_db()
+        self.assertEqual((self.shop.feed_etag, self.shop.feed_hash), ('"v1"', 'hash'))
+
+        second = ImportJob.objects.create(shop=self.shop, url=self.shop.url)
+        with patch('backend.feeds.requests.get') as get, patch('backend.tasks.load_feed_to_db') as load_feed:
+            get.return_value.__enter__.return_value.status_code = 304
+            do_import(second.id)
+
+        self.assertEqual(get.call_args.kwargs['headers'], {'If-None-Match': '"v1"',
+                                                           'If-Modified-Since': 'Wed, 01 Jan 2025 00:00:00 GMT'})
+        load_feed.assert_not_called()
+        second.refresh_from_db()
+        self.assertEqual(second.state, 'skipped')
+
+    def test_invalid_url(self):
+        """
+        Тестирует, что некорректная ссылка отклоняется без создания задачи импорта.
+        """
+        response = self.client.post(reverse('backend:partner-update'), {'url': 'not-a-url'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_invalid_request_does_not_create_shop(self):
+        """
+        Тестирует, что запрос без прайс-листа или с некорректной ссылкой не создаёт магазин партнёру без магазина.
+        """
+        user = User.objects.create_user(email='new-shop@example.com', password='password123', type='shop',
+                                        is_active=True)
+        self.client.force_authenticate(user)
+        for data in ({}, {'url': 'not-a-url'}):
+            response = self.client.post(reverse('backend:partner-update'), data)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Shop.objects.filter(user=user).exists())
+
+
+class ParallelImportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.shops = [
+            Shop.objects.create(name=f'Магазин {number}', url=f'https://example.com/shop{number}.yaml',
+                                user=User.objects.create_user(email=f'shop{number}@example.com', password='password123',
+                                                              type='shop', is_active=True))
+            for number in range(3)
+        ]
+
+    def _download(self, url, on_progress=None, etag=None, last_modified=None):
+        feed_file = tempfile.TemporaryFile()
+        feed_file.write(yaml.safe_dump(make_feed(3), allow_unicode=True).encode())
+        feed_file.seek(0)
+        return feed_file, url, {'etag': '"v1"', 'last_modified': ''}
+
+    @override_settings(IMPORT_MAX_CONCURRENCY=2)
+    def test_import_lock_is_per_shop_and_bounded(self):
+        """
+        Тестирует, что один магазин не импортируется дважды одновременно, а число импортов ограничено.
+        """
+        with import_lock(self.shops[0].id) as locked:
+            self.assertTrue(locked)
+            with import_lock(self.shops[0].id) as locked_again:
+                self.assertFalse(locked_again)
+            with import_lock(self.shops[1].id) as second:
+                self.assertTrue(second)
+                with import_lock(self.shops[2].id) as third:
+                    self.assertFalse(third)
+        with import_lock(self.shops[0].id) as locked:
+            self.assertTrue(locked)
+
+    def test_expired_lock_is_not_released_by_previous_owner(self):
+        """
+        Тестирует, что воркер, чья блокировка истекла и досталась другому, не снимает чужую блокировку.
+        """
+        with import_lock(self.shops[0].id) as lock:
+            # ключи истекли, блокировку и слот взял другой воркер
+            cache.set(lock.shop_key, 'other-worker')
+            cache.set(lock.slot_key, 'other-worker')
+            lock.extended_at -= settings.IMPORT_LOCK_TIMEOUT
+            lock.extend()
+        self.assertEqual(cache.get(lock.shop_key), 'other-worker')
+        self.assertEqual(cache.get(lock.slot_key), 'other-worker')
+        with import_lock(self.shops[0].id) as locked_again:
+            self.assertFalse(locked_again)
+
+    @override_settings(IMPORT_LOCK_RETRIES=0)
+    def test_locked_shop_is_not_imported(self):
+        """
+        Тестирует, что задача не пишет в базу, пока магазин заблокирован другим импортом.
+        """
+        job = ImportJob.objects.create(shop=self.shops[0], url=self.shops[0].url)
+        with import_lock(self.shops[0].id), patch('backend.tasks.download_feed') as download:
+            do_import(job.id)
+        download.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'failed')
+        self.assertFalse(ProductInfo.objects.filter(shop=self.shops[0]).exists())
+
+    def test_import_shops_command(self):
+        """
+        Тестирует, что команда import_shops импортирует все магазины и выводит сводку.
+        """
+        out = io.StringIO()
+        with patch('backend.tasks.download_feed', side_effect=self._download):
+            call_command('import_shops', stdout=out)
+        self.assertIn('Завершено: 3', out.getvalue())
+        for shop in self.shops:
+            self.assertEqual(ProductInfo.objects.filter(shop=shop).count(), 3)
+            self.assertEqual(shop.import_jobs.get().state, 'done')
+
+
+class ScheduledRefreshTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.shop = Shop.objects.create(name='Магазин', url='https://example.com/shop.yaml', refresh_interval=60)
+
+    def test_first_refresh_is_spread_over_interval(self):
+        """
+        Тестирует, что магазины без даты обновления получают случайную дату в пределах интервала, а не запускаются сразу.
+        """
+        with patch.object(do_import, 'delay') as delay:
+            refresh_feeds()
+        delay.assert_not_called()
+        self.shop.refresh_from_db()
+        self.assertLessEqual(self.shop.next_refresh_at, timezone.now() + datetime.timedelta(minutes=60))
+
+    @override_settings(IMPORT_REFRESH_JITTER=0, IMPORT_MAX_CONCURRENCY=1)
+    def test_failed_refresh_backs_off(self):
+        """
+        Тестирует запуск обновления по расписанию, удвоение интервала после ошибки и ограничение числа импортов.
+        """
+        Shop.objects.create(name='Другой магазин', url='https://example.com/other.yaml', refresh_interval=60)
+        Shop.objects.update(next_refresh_at=timezone.now() - datetime.timedelta(minutes=1))
+
+        with patch('backend.tasks.download_feed', side_effect=requests.exceptions.ConnectionError('нет связи')), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(refresh_feeds(), 1)
+
+        job = ImportJob.objects.get()
+        self.assertEqual((job.source, job.state), ('schedule', 'failed'))
+        shop = Shop.objects.get(pk=job.shop_id)
+        self.assertEqual(shop.refresh_failures, 1)
+        self.assertAlmostEqual((shop.next_refresh_at - job.finished_at).total_seconds(), 120 * 60, delta=5)
+        # второй магазин ждёт свободного слота до следующего запуска
+        self.assertEqual(Shop.objects.filter(next_refresh_at__lte=timezone.now()).count(), 1)
+
+
+    def test_stale_job_does_not_block_refresh(self):
+        """
+        Тестирует, что задача, брошенная упавшим воркером, помечается ошибкой и не блокирует обновление,
+        а свежая незавершённая задача или задача магазина с идущим импортом - блокирует.
+        """
+        self.shop.next_refresh_at = timezone.now() - datetime.timedelta(minutes=1)
+        self.shop.save()
+        job = ImportJob.objects.create(shop=self.shop, source='schedule', url=self.shop.url, state='importing')
+        with patch.object(do_import, 'delay'):
+            self.assertEqual(refresh_feeds(), 0)
+
+        ImportJob.objects.filter(pk=job.pk).update(
+            created_at=timezone.now() - datetime.timedelta(seconds=settings.IMPORT_JOB_TIMEOUT + 60))
+        with import_lock(self.shop.id), patch.object(do_import, 'delay'):
+            self.assertEqual(refresh_feeds(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'importing')
+
+        with patch.object(do_import, 'delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(refresh_feeds(), 1)
+        delay.assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'failed')
+        self.assertIsNotNone(job.finished_at)
+
+
+class ProductListTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.shop = Shop.objects.create(name='Тестовый магазин')
+        load_data_to_db(make_feed(25), self.shop)
+        other = Shop.objects.create(name='Другой магазин')
+        load_data_to_db(make_feed(5, shop_name='Другой магазин'), other)
+        self.client = APIClient()
+
+    def test_cursor_pagination(self):
+        """
+        Тестирует постраничный вывод каталога по курсору с фильтром по магазину.
+        """
+        url = reverse('backend:shops') + f'?shop_id={self.shop.id}&page_size=10'
+        ids = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.json()['results'])
+            url = response.json()['next']
+            pages += 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, list(ProductInfo.objects.filter(shop=self.shop).order_by('id').values_list('id', flat=True)))
+
+    def test_page_queries_do_not_depend_on_position(self):
+        """
+        Тестирует, что следующая страница выбирается тем же числом запросов, что и первая.
+        """
+        url = reverse('backend:shops') + '?page_size=5'
+        with CaptureQueriesContext(connection) as first_page:
+            response = self.client.get(url)
+        next_url = response.json()['next']
+        with CaptureQueriesContext(connection) as next_page:
+            self.client.get(next_url)
+        first_page, next_page = catalog_queries(first_page), catalog_queries(next_page)
+        self.assertEqual(len(first_page), len(next_page))
+        self.assertNotIn('OFFSET', next_page[0].upper())
+        self.assertNotIn('DISTINCT', next_page[0].upper())
+
+    def test_keyset_over_equal_values(self):
+        """
+        Тестирует переход по страницам вперёд и назад внутри серии равных цен: условие по (цена, id) без OFFSET.
+        """
+        ProductInfo.objects.filter(shop=self.shop).update(price=100)
+        expected = list(ProductInfo.objects.filter(shop=self.shop).order_by('-price', '-id').values_list(
+            'id', flat=True))
+        url = reverse('backend:shops') + f'?shop_id={self.shop.id}&ordering=-price&page_size=4'
+        pages = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get(url).json()
+            for sql in catalog_queries(queries):
+                self.assertNotIn('OFFSET', sql.upper())
+            pages.append(([item['id'] for item in data['results']], data['previous']))
+            url = data['next']
+        self.assertEqual([item_id for ids, _ in pages for item_id in ids], expected)
+
+        # ссылка «назад» с последней страницы ведёт на предпоследнюю
+        data = self.client.get(pages[-1][1]).json()
+        self.assertEqual([item['id'] for item in data['results']], pages[-2][0])
+        self.assertIsNotNone(data['next'])
+
+    def test_category_copy_is_filled_outside_import(self):
+        """
+        Тестирует копию категории в ProductInfo: задаётся при сохранении не импортом и заполняется командой
+        для старых товаров, после чего они видны в фильтре по category_id.
+        """
+        product_info = ProductInfo.objects.filter(shop=self.shop).select_related('product').first()
+        created = ProductInfo.objects.create(product=product_info.product, shop=self.shop, external_id=5000,
+                                             quantity=1, price=1, price_rrc=1)
+        self.assertEqual(created.category_id, product_info.product.category_id)
+
+        ProductInfo.objects.filter(shop=self.shop).update(category=None)
+        out = io.StringIO()
+        call_command('sync_product_info_category', stdout=out)
+        self.assertIn(f'Обновлено товаров: {ProductInfo.objects.filter(shop=self.shop).count()}', out.getvalue())
+        category_id = product_info.product.category_id
+        response = self.client.get(reverse('backend:shops'), {'shop_id': self.shop.id, 'category_id': category_id,
+                                                              'page_size': 100})
+        self.assertEqual(len(response.json()['results']), ProductInfo.objects.filter(
+            shop=self.shop, product__category_id=category_id).count())
+
+    def test_price_and_stock_filters_with_ordering(self):
+        """
+        Тестирует фильтры по цене и наличию и сортировку по цене с переходом по страницам.
+        """
+        url = reverse('backend:shops') + (f'?shop_id={self.shop.id}&price_min=100&price_max=110&in_stock=true'
+                                          f'&ordering=-price&page_size=4')
+        prices = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            prices.extend(item['price'] for item in response.json()['results'])
+            url = response.json()['next']
+        # товар 1000 с ценой 100 не в наличии
+        self.assertEqual(prices, list(range(110, 100, -1)))
+
+        response = self.client.get(reverse('backend:shops'), {'category_id': 224, 'ordering': 'quantity'})
+        quantities = [item['quantity'] for item in response.json()['results']]
+        self.assertEqual(quantities, sorted(quantities))
+        self.assertEqual(len(quantities), ProductInfo.objects.filter(product__category_id=224).count())
+
+        response = self.client.get(reverse('backend:shops'), {'price_min': 'дёшево'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_sparse_fields(self):
+        """
+        Тестирует выбор полей: без параметров товара в ответе их запрос не выполняется.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('backend:shops'), {'fields': 'id,price,product.name', 'page_size': 5})
+            sql = catalog_queries(queries)
+        self.assertEqual(response.status_code, 200)
+        first = ProductInfo.objects.select_related('product').order_by('id').first()
+        self.assertEqual(response.json()['results'][0],
+                         {'id': first.id, 'price': first.price, 'product': {'name': first.product.name}})
+        self.assertFalse([query for query in sql if 'backend_productparameter' in query])
+        self.assertFalse([query for query in sql if 'backend_category' in query])
+
+        response = self.client.get(reverse('backend:shops'), {'fields': 'id,product_parameters.value'})
+        self.assertEqual(set(response.json()['results'][0]['product_parameters'][0]), {'value'})
+
+        response = self.client.get(reverse('backend:shops'), {'fields': 'id,secret'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('backend:shops'), {'fields': 'price.amount'})
+        self.assertEqual(response.status_code, 400)
+
+
+class OrderQueryShapeTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.partner = User.objects.create_user(email='partner@example.com', password='password123', type='shop',
+                                                is_active=True)
+        shop = Shop.objects.create(name='Тестовый магазин', user=self.partner)
+        other_shop = Shop.objects.create(name='Другой магазин')
+        load_data_to_db(make_feed(2), shop)
+        load_data_to_db(make_feed(2, shop_name='Другой магазин'), other_shop)
+        self.buyer = User.objects.create_user(email='buyer@example.com', password='password123', is_active=True)
+
+        # заказ с товарами двух магазинов: по две позиции каждого
+        self.order = Order.objects.create(user=self.buyer, state='new')
+        for product_info in ProductInfo.objects.all():
+            OrderItem.objects.create(order=self.order, product_info=product_info, quantity=2)
+        self.shop_total = sum(2 * product_info.price for product_info in ProductInfo.objects.filter(shop=shop))
+        self.client = APIClient()
+
+    def _get(self, user, url_name):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        for sql in catalog_queries(queries):
+            self.assertNotIn('DISTINCT', sql.upper())
+        return response.json()
+
+    def test_partner_orders_total_covers_own_items(self):
+        """
+        Тестирует, что сумма заказа для магазина считается только по его позициям, без DISTINCT в запросах.
+        """
+        orders = self._get(self.partner, 'backend:partner-orders')['results']
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0]['total_sum'], self.shop_total)
+        self.assertEqual(len(orders[0]['ordered_items']), 2)
+
+    def test_user_orders_total(self):
+        """
+        Тестирует сумму заказа покупателя по всем позициям.
+        """
+        orders = self._get(self.buyer, 'backend:order')['results']
+        self.assertEqual(orders[0]['total_sum'],
+                         sum(2 * product_info.price for product_info in ProductInfo.objects.all()))
+        self.assertEqual(self._get(self.buyer, 'backend:basket'), [])
+
+
+class OrderHistoryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        shop = Shop.objects.create(name='Тестовый магазин')
+        load_data_to_db(make_feed(1), shop)
+        product_info = ProductInfo.objects.first()
+        self.buyer = User.objects.create_user(email='buyer@example.com', password='password123', is_active=True)
+        Order.objects.create(user=self.buyer, state='basket')
+        # пять заказов по одному в день с 1 по 5 мая, у двух заказов одинаковое время
+        start = timezone.make_aware(datetime.datetime(2024, 5, 1, 12))
+        self.orders = []
+        for day, state in enumerate(('new', 'delivered', 'canceled', 'delivered', 'new')):
+            order = Order.objects.create(user=self.buyer, state=state)
+            OrderItem.objects.create(order=order, product_info=product_info, quantity=1)
+            Order.objects.filter(pk=order.pk).update(dt=start + datetime.timedelta(days=min(day, 3)))
+            self.orders.append(order.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def _pages(self, params):
+        ids = []
+        url, params = reverse('backend:order'), dict(params)
+        while url:
+            data = self.client.get(url, params).json()
+            ids.extend(order['id'] for order in data['results'])
+            url, params = data['next'], None
+        return ids
+
+    def test_pages_from_newest(self):
+        """
+        Тестирует постраничный вывод по курсору от новых заказов к старым без пропусков и повторов.
+        """
+        self.assertEqual(self._pages({'page_size': 2}), [self.orders[4], self.orders[3]] + self.orders[2::-1])
+        # заказы 3 и 4 с одинаковым временем на разных страницах: курсор по (dt, id) без OFFSET
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._pages({'page_size': 1}), self.orders[::-1])
+        self.assertFalse([query['sql'] for query in queries
+                          if 'backend_order' in query['sql'] and 'OFFSET' in query['sql'].upper()])
+
+    def test_filters(self):
+        """
+        Тестирует фильтры по статусу и периоду; дата без времени в date_to включает весь день.
+        """
+        self.assertEqual(self._pages({'state': 'delivered,new'}),
+                         [self.orders[4], self.orders[3], self.orders[1], self.orders[0]])
+        self.assertEqual(self._pages({'date_from': '2024-05-02', 'date_to': '2024-05-03'}),
+                         [self.orders[2], self.orders[1]])
+        self.assertEqual(self._pages({'date_to': '2024-05-02T11:00:00+03:00'}), [self.orders[0]])
+
+        for params in ({'state': 'basket'}, {'date_from': '01.05.2024'}, {'view': 'tree'}):
+            response = self.client.get(reverse('backend:order'), params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_summary(self):
+        """
+        Тестирует сводный вид списка: без ordered_items и без запроса позиций заказов.
+        """
+        for fast in (True, False):
+            with override_settings(FAST_SERIALIZATION=fast), CaptureQueriesContext(connection) as queries:
+                orders = self.client.get(reverse('backend:order'), {'view': 'summary'}).json()['results']
+            self.assertEqual(len(orders), 5)
+            self.assertEqual(set(orders[0]), {'id', 'state', 'dt', 'total_sum', 'contact'})
+            self.assertFalse([query['sql'] for query in queries if 'backend_orderitem' in query['sql']])
+
+
+class ProductSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.shop = Shop.objects.create(name='Связной')
+        self.feed = make_feed(0, shop_name='Связной')
+        self.feed['goods'] = [
+            {'id': 1, 'category': 224, 'model': 'apple/iphone/xs-max', 'name': 'Смартфон Apple iPhone XS Max 256GB (красный)',
+             'price': 110000, 'price_rrc': 116990, 'quantity': 14, 'parameters': {'Цвет': 'красный'}},
+            {'id': 2, 'category': 224, 'model': 'apple/iphone/xs-max', 'name': 'Смартфон Apple iPhone XS Max 512GB (золотистый)',
+             'price': 120000, 'price_rrc': 126990, 'quantity': 5, 'parameters': {'Цвет': 'золотистый'}},
+            {'id': 3, 'category': 15, 'model': 'xiaomi/mi-band', 'name': 'Фитнес-браслет Xiaomi Mi Band 4 красный',
+             'price': 2500, 'price_rrc': 2990, 'quantity': 40, 'parameters': {'Цвет': 'красный'}},
+            {'id': 4, 'category': 224, 'model': 'apple/iphone/11', 'name': 'Apple iPhone 11 64GB (черный)',
+             'price': 60000, 'price_rrc': 64990, 'quantity': 3, 'parameters': {'Цвет': 'черный'}},
+        ]
+        load_data_to_db(self.feed, self.shop)
+        self.client = APIClient()
+
+    def _search(self, query, **params):
+        response = self.client.get(reverse('backend:product-search'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item['product']['name'] for item in response.json()['results']]
+
+    def test_stem(self):
+        """
+        Тестирует, что формы одного слова приводятся к одной основе.
+        """
+        self.assertEqual({stem(word) for word in ('красный', 'красная', 'красные', 'красного')}, {'красн'})
+        self.assertEqual(stem('смартфонами'), stem('смартфон'))
+        self.assertEqual(stem('iPhone'), 'iphone')
+
+    def test_search_matches_all_words_and_ranks(self):
+        """
+        Тестирует поиск по названию, параметрам и категории с учётом словоформ.
+        """
+        self.assertEqual(self._search('iPhone 256 красные'), ['Смартфон Apple iPhone XS Max 256GB (красный)'])
+        # совпадение в названии весит больше, чем только в категории
+        found = self._search('смартфоны')
+        self.assertEqual(len(found), 3)
+        self.assertEqual(found[-1], 'Apple iPhone 11 64GB (черный)')
+        self.assertEqual(self._search('красный', category_id=15), ['Фитнес-браслет Xiaomi Mi Band 4 красный'])
+        self.assertEqual(self._search('телевизор'), [])
+        response = self.client.get(reverse('backend:product-search'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_is_updated_by_import(self):
+        """
+        Тестирует, что повторный импорт обновляет индекс только по изменённым товарам.
+        """
+        self.feed['goods'][1]['name'] = 'Смартфон Apple iPhone XS Max 512GB (серебристый)'
+        self.feed['goods'][1]['parameters'] = {'Цвет': 'серебристый'}
+        with CaptureQueriesContext(connection) as queries:
+            load_data_to_db(self.feed, self.shop)
+        # термы пересчитываются одним запросом и только для изменённого товара
+        inserts = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT INTO "backend_productsearchterm"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertNotIn('золотист', inserts[0])
+
+        self.assertEqual(self._search('серебристые'), ['Смартфон Apple iPhone XS Max 512GB (серебристый)'])
+        self.assertEqual(self._search('золотистый'), [])
+
+
+class CatalogFacetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='shop@example.com', password='password123', type='shop',
+                                             is_active=True)
+        self.shop = Shop.objects.create(name='Тестовый магазин', user=self.user)
+        self.feed = make_feed(6)
+        for index, good in enumerate(self.feed['goods']):
+            good['category'] = 224
+            good['parameters'] = {'Цвет': 'черный' if index % 2 else 'белый',
+                                  'Встроенная память (Гб)': 256 if index < 4 else 512}
+        # фасеты пересчитываются задачей после фиксации транзакции импорта
+        with self.captureOnCommitCallbacks(execute=True):
+            load_data_to_db(self.feed, self.shop)
+        self.client = APIClient()
+
+    def _get(self, **params):
+        response = self.client.get(reverse('backend:shops'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_parameter_filters(self):
+        """
+        Тестирует фильтрацию по параметрам: значения одного параметра через ИЛИ, разные параметры через И.
+        """
+        data = self._get(**{'param[Цвет]': 'черный', 'param[Встроенная память (Гб)]': '256'})
+        self.assertEqual({item['id'] for item in data['results']}, set(ProductInfo.objects.filter(
+            external_id__in=[1001, 1003]).values_list('id', flat=True)))
+        data = self._get(**{'param[Цвет]': ['черный', 'белый'], 'param[Встроенная память (Гб)]': '512'})
+        self.assertEqual(len(data['results']), 2)
+
+    def test_facets_are_materialized(self):
+        """
+        Тестирует, что фасеты категории отдаются одним запросом и пересчитываются при импорте и смене статуса.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            data = self._get(category_id=224)
+            facet_queries = [sql for sql in catalog_queries(queries) if 'backend_categoryfacet' in sql]
+        self.assertEqual(len(facet_queries), 1)
+        self.assertEqual(data['facets'], {'Цвет': {'белый': 3, 'черный': 3},
+                                          'Встроенная память (Гб)': {'256': 4, '512': 2}})
+
+        self.feed['goods'] = self.feed['goods'][:4]
+        with self.captureOnCommitCallbacks() as callbacks:
+            load_data_to_db(self.feed, self.shop)
+        # до фиксации импорта фасеты не пересчитываются
+        self.assertEqual(self._get(category_id=224)['facets']['Встроенная память (Гб)'], {'256': 4, '512': 2})
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self._get(category_id=224)['facets']['Встроенная память (Гб)'], {'256': 4})
+
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('backend:partner-state'), {'state': 'off'})
+        self.assertEqual(response.json()['Status'], True)
+        self.assertEqual(self._get(category_id=224)['facets'], {})
+
+    def test_numeric_ranges_and_ordering(self):
+        """
+        Тестирует фильтр по диапазону числового параметра и сортировку по нему с постраничным выводом.
+        """
+        self.assertEqual(ProductParameter.objects.filter(value_num=256).count(), 4)
+        self.assertEqual(ProductParameter.objects.filter(parameter__name='Цвет', value_num__isnull=False).count(), 0)
+
+        data = self._get(**{'param_min[Встроенная память (Гб)]': '300'})
+        self.assertEqual(len(data['results']), 2)
+        data = self._get(**{'param_min[Встроенная память (Гб)]': '200', 'param_max[Встроенная память (Гб)]': '256'})
+        self.assertEqual(len(data['results']), 4)
+
+        data = self._get(ordering='-param:Встроенная память (Гб)', page_size=4)
+        values = []
+        while True:
+            values.extend(int(parameter['value']) for item in data['results']
+                          for parameter in item['product_parameters'] if parameter['parameter'] == 'Встроенная память (Гб)')
+            if not data['next']:
+                break
+            data = self.client.get(data['next']).json()
+        self.assertEqual(values, [512, 512, 256, 256, 256, 256])
+
+        response = self.client.get(reverse('backend:shops'), {'param_min[Встроенная память (Гб)]': 'много'})
+        self.assertEqual(response.status_code, 400)
+
+
+class FastSerializerParityTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.partner = User.objects.create_user(email='partner@example.com', password='password123', type='shop',
+                                                is_active=True)
+        shop = Shop.objects.create(name='Тестовый магазин', user=self.partner)
+        load_data_to_db(make_feed(6), shop)
+        other_shop = Shop.objects.create(name='Другой магазин')
+        load_data_to_db(make_feed(2, shop_name='Другой магазин'), other_shop)
+        self.buyer = User.objects.create_user(email='buyer@example.com', password='password123', is_active=True)
+        contact = Contact.objects.create(user=self.buyer, city='Москва', street='Тверская', house='1',
+                                         phone='+79161234567')
+        for index, state in enumerate(['new', 'confirmed']):
+            order = Order.objects.create(user=self.buyer, state=state, contact=contact if index else None)
+            for product_info in ProductInfo.objects.all()[index:index + 4]:
+                OrderItem.objects.create(order=order, product_info=product_info, quantity=index + 1)
+        self.client = APIClient()
+
+    def assertSameJson(self, fast, reference):
+        self.assertEqual(fast, reference)
+        self.assertEqual(UJSONRenderer().render(fast), JSONRenderer().render(reference))
+
+    def test_product_infos(self):
+        """
+        Тестирует совпадение быстрой сериализации товаров с ProductInfoSerializer, в том числе с выбором полей.
+        """
+        queryset = ProductInfo.objects.order_by('id')
+        for value in (None, 'id,price,product.name', 'model,product,shop', 'product.category,product_parameters.value',
+                      'product_parameters'):
+            fields = parse_fields(value, ProductInfoSerializer)
+            reference = ProductInfoSerializer(ProductInfoSerializer.setup_queryset(queryset, fields), many=True,
+                                              fields=fields).data
+            fast = product_infos_data(product_info_rows(queryset, fields), fields)
+            self.assertSameJson(fast, reference)
+
+    def test_orders(self):
+        """
+        Тестирует совпадение быстрой сериализации заказов с OrderSerializer для покупателя и магазина.
+        """
+        orders = Order.objects.filter(user=self.buyer)
+        reference = OrderSerializer(orders.prefetch_related('ordered_items'), many=True).data
+        self.assertSameJson(orders_data(orders), reference)
+
+        shop_items = OrderItem.objects.filter(product_info__shop__user=self.partner)
+        self.client.force_authenticate(self.partner)
+        fast = self.client.get(reverse('backend:partner-orders')).content
+        with override_settings(FAST_SERIALIZATION=False):
+            slow = self.client.get(reverse('backend:partner-orders')).content
+        self.assertEqual(fast, slow)
+        self.assertEqual(sum(len(order['ordered_items']) for order in json.loads(fast)['results']),
+                         shop_items.count())
+
+    @override_settings(CATALOG_RESPONSE_CACHE_TIMEOUT=0)
+    def test_catalog_response(self):
+        """
+        Тестирует, что ответ каталога не меняется при отключении быстрой сериализации.
+        """
+        params = {'ordering': '-price', 'page_size': 3, 'category_id': 224}
+        fast = self.client.get(reverse('backend:shops'), params).content
+        with override_settings(FAST_SERIALIZATION=False):
+            slow = self.client.get(reverse('backend:shops'), params).content
+        self.assertEqual(fast, slow)
+
+
+class CatalogEtagTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.partner = User.objects.create_user(email='partner@example.com', password='password123', type='shop',
+                                                is_active=True)
+        self.shop = Shop.objects.create(name='Тестовый магазин', user=self.partner)
+        self.other_shop = Shop.objects.create(name='Другой магазин')
+        self.feed = make_feed(4)
+        load_data_to_db(self.feed, self.shop)
+        load_data_to_db(make_feed(2, shop_name='Другой магазин'), self.other_shop)
+        self.client = APIClient()
+
+    def _etag(self, **params):
+        response = self.client.get(reverse('backend:shops'), params)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_not_modified_without_queries(self):
+        """
+        Тестирует 304 на запрос с актуальным ETag без запросов к БД и заголовки Cache-Control и Vary.
+        """
+        response = self.client.get(reverse('backend:shops'), {'shop_id': self.shop.id})
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertIn('Accept', response['Vary'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('backend:shops'), {'shop_id': self.shop.id},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+            sql = catalog_queries(queries)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(sql, [])
+
+        response = self.client.get(reverse('backend:categories'))
+        response = self.client.get(reverse('backend:categories'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_versions_follow_imports_and_state(self):
+        """
+        Тестирует, что импорт меняет ETag только затронутых списков, а смена статуса магазина - всех.
+        """
+        own, other, everything = (self._etag(shop_id=self.shop.id), self._etag(shop_id=self.other_shop.id),
+                                  self._etag())
+
+        self.feed['goods'][0]['price'] += 1
+        load_data_to_db(self.feed, self.shop)
+        self.assertNotEqual(self._etag(shop_id=self.shop.id), own)
+        self.assertEqual(self._etag(shop_id=self.other_shop.id), other)
+        self.assertNotEqual(self._etag(), everything)
+
+        # прайс-лист без изменений ничего не инвалидирует
+        own = self._etag(shop_id=self.shop.id)
+        load_data_to_db(self.feed, self.shop)
+        self.assertEqual(self._etag(shop_id=self.shop.id), own)
+
+        self.client.force_authenticate(self.partner)
+        self.client.post(reverse('backend:partner-state'), {'state': 'false'})
+        self.assertNotEqual(self._etag(shop_id=self.other_shop.id), other)
+
+    def test_filter_values_are_normalized(self):
+        """
+        Тестирует, что «01» и «1» в shop_id дают одну версию, а некорректный ИД - версию всего списка.
+        """
+        padded = self._etag(shop_id=f'0{self.shop.id}')
+        factory = RequestFactory()
+        self.assertEqual(product_scopes(factory.get('/', {'shop_id': f'0{self.shop.id}'})),
+                         ['base', f'shop:{self.shop.id}'])
+        self.assertEqual(product_scopes(factory.get('/', {'shop_id': 'abc'})), ['base', 'products'])
+
+        self.feed['goods'][0]['price'] += 1
+        load_data_to_db(self.feed, self.shop)
+        self.assertNotEqual(self._etag(shop_id=f'0{self.shop.id}'), padded)
+
+    def test_admin_edits_change_versions(self):
+        """
+        Тестирует, что правка цены, параметра и удаление товара вне импорта (админка) меняют ETag магазина.
+        """
+        own, other = self._etag(shop_id=self.shop.id), self._etag(shop_id=self.other_shop.id)
+        product_info = ProductInfo.objects.filter(shop=self.shop).first()
+        product_info.price += 1
+        product_info.save()
+        self.assertNotEqual(self._etag(shop_id=self.shop.id), own)
+        self.assertEqual(self._etag(shop_id=self.other_shop.id), other)
+
+        own = self._etag(shop_id=self.shop.id)
+        product_parameter = ProductParameter.objects.filter(product_info=product_info).first()
+        product_parameter.value = 'другое'
+        product_parameter.save()
+        self.assertNotEqual(self._etag(shop_id=self.shop.id), own)
+
+        own = self._etag(shop_id=self.shop.id)
+        model_admin = site._registry[ProductInfo]
+        model_admin.delete_queryset(RequestFactory().post('/'), ProductInfo.objects.filter(pk=product_info.pk))
+        self.assertNotEqual(self._etag(shop_id=self.shop.id), own)
+        self.assertEqual(self._etag(shop_id=self.other_shop.id), other)
+
+    def test_response_cache_is_invalidated_per_shop(self):
+        """
+        Тестирует кеш ответов: повтор без запросов к БД, импорт другого магазина кеш не сбрасывает,
+        отключённый магазин сразу пропадает из списка.
+        """
+        self._etag(shop_id=self.shop.id)
+        with CaptureQueriesContext(connection) as queries:
+            self._etag(shop_id=self.shop.id)
+            sql = catalog_queries(queries)
+        self.assertEqual(sql, [])
+
+        load_data_to_db(make_feed(3, shop_name='Другой магазин'), self.other_shop)
+        with CaptureQueriesContext(connection) as queries:
+            self._etag(shop_id=self.shop.id)
+            sql = catalog_queries(queries)
+        self.assertEqual(sql, [])
+
+        self.feed['goods'][0]['price'] = 999
+        load_data_to_db(self.feed, self.shop)
+        prices = [item['price'] for item in self.client.get(
+            reverse('backend:shops'), {'shop_id': self.shop.id}).json()['results']]
+        self.assertIn(999, prices)
+
+        self.assertTrue(any(item['shop'] == self.shop.id
+                            for item in self.client.get(reverse('backend:shops')).json()['results']))
+        self.client.force_authenticate(self.partner)
+        self.client.post(reverse('backend:partner-state'), {'state': 'false'})
+        self.assertFalse(any(item['shop'] == self.shop.id
+                             for item in self.client.get(reverse('backend:shops')).json()['results']))
+
+
+class BasketTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        shop = Shop.objects.create(name='Тестовый магазин')
+        load_data_to_db(make_feed(200), shop)
+        self.product_ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+        self.buyer = User.objects.create_user(email='buyer@example.com', password='password123', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def _basket(self):
+        return dict(OrderItem.objects.filter(order__user=self.buyer, order__state='basket').values_list(
+            'product_info_id', 'quantity'))
+
+    def test_bulk_add(self):
+        """
+        Тестирует добавление 200 позиций за несколько запросов к БД со сложением повторяющихся товаров.
+        """
+        items = [{'product_info': product_id, 'quantity': 1} for product_id in self.product_ids]
+        items.append({'product_info': self.product_ids[0], 'quantity': 2})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('backend:basket'), {'items': json.dumps(items)})
+            sql = catalog_queries(queries)
+        self.assertEqual(response.json(), {'Status': True, 'Создано объектов': 200, 'Обновлено объектов': 0})
+        self.assertLessEqual(len(sql), 10)
+        basket = self._basket()
+        self.assertEqual(len(basket), 200)
+        self.assertEqual(basket[self.product_ids[0]], 3)
+
+        response = self.client.post(reverse('backend:basket'), {
+            'items': json.dumps([{'product_info': self.product_ids[1], 'quantity': 4}])})
+        self.assertEqual(response.json()['Обновлено объектов'], 1)
+        self.assertEqual(self._basket()[self.product_ids[1]], 5)
+
+    def test_invalid_item_rolls_back(self):
+        """
+        Тестирует, что ошибка в одной позиции не добавляет в корзину ни одной.
+        """
+        ProductInfo.objects.filter(id=self.product_ids[1]).update(is_active=False)
+        items = [{'product_info': self.product_ids[0], 'quantity': 1},
+                 {'product_info': self.product_ids[1], 'quantity': 1},
+                 {'product_info': 10 ** 9, 'quantity': 1}]
+        response = self.client.post(reverse('backend:basket'), {'items': json.dumps(items)})
+        self.assertFalse(response.json()['Status'])
+        self.assertEqual([error['item'] for error in response.json()['Errors']], [1, 2])
+        self.assertEqual(self._basket(), {})
+
+        response = self.client.post(reverse('backend:basket'), {
+            'items': json.dumps([{'product_info': self.product_ids[0], 'quantity': 0}])})
+        self.assertEqual(response.json()['Errors'][0]['item'], 0)
+
+    def test_bulk_update_remove_and_sync(self):
+        """
+        Тестирует изменение количества одним UPDATE, удаление одним запросом и синхронизацию корзины через PATCH.
+        """
+        self.client.post(reverse('backend:basket'), {'items': json.dumps(
+            [{'product_info': product_id, 'quantity': 1} for product_id in self.product_ids[:50]])})
+        item_ids = list(OrderItem.objects.filter(order__user=self.buyer).order_by('id').values_list('id', flat=True))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(reverse('backend:basket'), {'items': json.dumps(
+                [{'id': item_id, 'quantity': 7} for item_id in item_ids[:40]])})
+            updates = [sql for sql in catalog_queries(queries) if sql.startswith('UPDATE "backend_orderitem"')]
+        self.assertEqual(response.json(), {'Status': True, 'Обновлено объектов': 40})
+        self.assertEqual(len(updates), 1)
+
+        response = self.client.delete(reverse('backend:basket'), {'items': ','.join(map(str, item_ids[40:]))})
+        self.assertEqual(response.json(), {'Status': True, 'Удалено объектов': 10})
+
+        response = self.client.patch(reverse('backend:basket'), {
+            'remove': str(item_ids[0]),
+            'update': json.dumps([{'id': item_ids[1], 'quantity': 2}]),
+            'add': json.dumps([{'product_info': self.product_ids[2], 'quantity': 1},
+                               {'product_info': self.product_ids[100], 'quantity': 5}]),
+        }, format='json')
+        self.assertEqual(response.json(), {'Status': True, 'Создано объектов': 1, 'Обновлено объектов': 2,
+                                           'Удалено объектов': 1})
+        basket = self._basket()
+        self.assertNotIn(self.product_ids[0], basket)
+        self.assertEqual((basket[self.product_ids[1]], basket[self.product_ids[2]], basket[self.product_ids[100]]),
+                         (2, 8, 5))
+
+        # ошибка в добавлении откатывает удаление из того же запроса
+        response = self.client.patch(reverse('backend:basket'), {
+            'remove': str(item_ids[1]), 'add': json.dumps([{'product_info': 10 ** 9, 'quantity': 1}])},
+            format='json')
+        self.assertFalse(response.json()['Status'])
+        self.assertIn(self.product_ids[1], self._basket())
+
+
+class CheckoutTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        shop = Shop.objects.create(name='Тестовый магазин')
+        load_data_to_db(make_feed(4), shop)
+        # товары 1002 и 1003: остатки 2 и 3
+        self.scarce, self.plenty = ProductInfo.objects.filter(external_id__in=[1002, 1003]).order_by('external_id')
+        self.client = APIClient()
+
+    def _buyer(self, index, quantity):
+        buyer = User.objects.create_user(email=f'buyer{index}@example.com', password='password123', is_active=True)
+        contact = Contact.objects.create(user=buyer, city='Москва', street='Тверская', phone='+79161234567')
+        basket = Order.objects.create(user=buyer, state='basket')
+        OrderItem.objects.create(order=basket, product_info=self.plenty, quantity=1)
+        OrderItem.objects.create(order=basket, product_info=self.scarce, quantity=quantity)
+        return buyer, {'id': str(basket.id), 'contact': str(contact.id)}
+
+    def _checkout(self, buyer, data):
+        self.client.force_authenticate(buyer)
+        with patch('backend.views.new_order.send'):
+            return self.client.post(reverse('backend:order'), data)
+
+    def test_stock_is_reserved_and_not_oversold(self):
+        """
+        Тестирует резерв остатков при оформлении и отказ с ошибками по позициям, когда товара не хватает.
+        """
+        first, first_data = self._buyer(1, 2)
+        second, second_data = self._buyer(2, 1)
+        self.assertEqual(self._checkout(first, first_data).json(), {'Status': True})
+
+        response = self._checkout(second, second_data)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual([line['product_info'] for line in response.json()['Errors']], [self.scarce.id])
+        self.scarce.refresh_from_db()
+        self.plenty.refresh_from_db()
+        # резерв второго покупателя по товару, которого хватало, откачен
+        self.assertEqual((self.scarce.quantity, self.plenty.quantity), (0, 2))
+        self.assertEqual(Order.objects.get(id=second_data['id']).state, 'basket')
+
+    def test_cancel_releases_stock(self):
+        """
+        Тестирует возврат остатков при отмене заказа покупателем.
+        """
+        buyer, data = self._buyer(1, 2)
+        self._checkout(buyer, data)
+        response = self.client.delete(reverse('backend:order'), {'id': data['id']})
+        self.assertEqual(response.json(), {'Status': True})
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+        self.assertEqual(Order.objects.get(id=data['id']).state, 'canceled')
+
+        response = self.client.delete(reverse('backend:order'), {'id': data['id']})
+        self.assertEqual(response.status_code, 404)
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+
+    def test_admin_cancel_is_final(self):
+        """
+        Тестирует, что отмена заказа в админке возвращает остатки, а вернуть отменённый заказ в работу нельзя.
+        """
+        buyer, data = self._buyer(1, 2)
+        self._checkout(buyer, data)
+        order = Order.objects.get(id=data['id'])
+        admin_user = User.objects.create_superuser(email='admin@example.com', password='password123')
+        self.client.force_login(admin_user)
+        url = reverse('admin:backend_order_change', args=[order.id])
+        form = {'user': buyer.id, 'contact': order.contact_id}
+
+        response = self.client.post(url, {**form, 'state': 'canceled'})
+        self.assertEqual(response.status_code, 302)
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+
+        # статус отменённого заказа только для чтения, в том числе для формы, открытой до отмены
+        self.assertNotContains(self.client.get(url), 'name="state"')
+        self.client.post(url, {**form, 'state': 'confirmed'})
+        self.assertEqual(Order.objects.get(id=order.id).state, 'canceled')
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+
+    def test_only_reserved_orders_release_stock(self):
+        """
+        Тестирует, что админка не переводит корзину в работу без резерва, а отмена заказа без резерва
+        (созданного не через оформление) не увеличивает остатки.
+        """
+        buyer, data = self._buyer(1, 2)
+        basket = Order.objects.get(id=data['id'])
+        admin_user = User.objects.create_superuser(email='admin@example.com', password='password123')
+        self.client.force_login(admin_user)
+        url = reverse('admin:backend_order_change', args=[basket.id])
+        self.client.post(url, {'user': buyer.id, 'state': 'new'})
+        self.assertEqual(Order.objects.get(id=basket.id).state, 'basket')
+
+        order = Order.objects.create(user=buyer, state='new')
+        OrderItem.objects.create(order=order, product_info=self.scarce, quantity=2)
+        self.client.post(reverse('admin:backend_order_changelist'),
+                         {'action': 'cancel_orders', '_selected_action': [order.id]})
+        self.assertEqual(Order.objects.get(id=order.id).state, 'canceled')
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+
+        self._checkout(buyer, data)
+        self.assertTrue(Order.objects.get(id=data['id']).stock_reserved)
+        self.assertTrue(cancel_order(int(data['id'])))
+        self.assertFalse(Order.objects.get(id=data['id']).stock_reserved)
+        self.scarce.refresh_from_db()
+        self.assertEqual(self.scarce.quantity, 2)
+
+    def test_total_is_fixed_at_checkout(self):
+        """
+        Тестирует, что сумма оформленного заказа сохраняется по ценам на момент оформления,
+        а список заказов покупателя не суммирует позиции в запросе.
+        """
+        buyer, data = self._buyer(1, 2)
+        self._checkout(buyer, data)
+        total = self.plenty.price + 2 * self.scarce.price
+        ProductInfo.objects.filter(id=self.scarce.id).update(price=F('price') * 10)
+
+        with CaptureQueriesContext(connection) as queries:
+            orders = self.client.get(reverse('backend:order')).json()['results']
+        self.assertEqual(orders[0]['total_sum'], total)
+        self.assertFalse([query['sql'] for query in queries if 'SUM(' in query['sql'].upper()])
+
+        # позиция, добавленная в оформленный заказ, получает текущую цену и попадает в сумму
+        product_info = ProductInfo.objects.exclude(id__in=[self.scarce.id, self.plenty.id]).first()
+        OrderItem.objects.create(order_id=data['id'], product_info=product_info, quantity=1)
+        self.assertEqual(Order.objects.get(id=data['id']).total_sum, total + product_info.price)
+
+        # удаление позиции в админке пересчитывает сумму, каскадное удаление заказа не загружает позиции
+        item = OrderItem.objects.get(order_id=data['id'], product_info=product_info)
+        site._registry[OrderItem].delete_model(RequestFactory().post('/'), item)
+        self.assertEqual(Order.objects.get(id=data['id']).total_sum, total)
+        with CaptureQueriesContext(connection) as queries:
+            Order.objects.filter(id=data['id']).delete()
+        self.assertFalse([query['sql'] for query in queries
+                          if query['sql'].startswith('SELECT') and 'backend_orderitem' in query['sql']])
@@ -6,14 +6,16 @@ from django.conf.urls.static import static
 from django.contrib.auth.views import LoginView
 
 from backend.views import PartnerUpdate, RegisterAccount, LoginAccount, CategoryView, ShopView, ProductInfoView, \
-    BasketView, AccountDetails, ContactView, OrderView, PartnerState, PartnerOrders, ConfirmAccount, \
-    ImportProductsView, ErrorAPIView
+    BasketView, ProductSearchView, AccountDetails, ContactView, OrderView, PartnerState, PartnerOrders, ConfirmAccount, \
+    ImportProductsView, ErrorAPIView, PartnerImports, PartnerImportStatus
 
 app_name = 'backend'
 urlpatterns = [
     path('partner/update', PartnerUpdate.as_view(), name='partner-update'),
     path('partner/state', PartnerState.as_view(), name='partner-state'),
     path('partner/orders', PartnerOrders.as_view(), name='partner-orders'),
+    path('partner/imports', PartnerImports.as_view(), name='partner-imports'),
+    path('partner/import/<int:job_id>', PartnerImportStatus.as_view(), name='partner-import-status'),
     path('user/register', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccount.as_view(), name='user-register-confirm'),
     path('user/details', AccountDetails.as_view(), name='user-details'),
@@ -24,6 +26,7 @@ urlpatterns = [
     path('categories', CategoryView.as_view(), name='categories'),
     path('shops', ShopView.as_view(), name='shops'),
     path('products', ProductInfoView.as_view(), name='shops'),
+    path('products/search', ProductSearchView.as_view(), name='product-search'),
     path('basket', BasketView.as_view(), name='basket'),
     path('order', OrderView.as_view(), name='order'),
     path('import/', ImportProductsView.as_view(), name='import-products'),
@@ -8,16 +8,14 @@ from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
 from django.db import IntegrityError
-from django.db.models import Q, Sum, F
+from django.db.models import Q
 from django.http import JsonResponse
+from django.utils.decorators import method_decorator
 
-from django.core.files.storage import default_storage
 from django.conf import settings
-from .tasks import do_import
-import yaml
+from .tasks import start_import, refresh_facets
 import logging
 import sentry_sdk
-import requests
 
 from requests import get
 from rest_framework.authtoken.models import Token
@@ -32,9 +30,19 @@ from drf_spectacular.types import OpenApiTypes
 from ujson import loads as load_json
 
 from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+    Contact, ConfirmEmailToken, ImportJob
 from backend.serializers import UserSerializer, CategorySerializer, ShopSerializer, ProductInfoSerializer, \
-    OrderItemSerializer, OrderSerializer, ContactSerializer
+    OrderSerializer, ContactSerializer, ImportJobSerializer, SparseFieldsError, parse_fields
+from backend.basket import BasketError, add_to_basket, parse_remove_items, remove_from_basket, sync_basket, \
+    update_basket
+from backend.checkout import BUYER_CANCELABLE_STATES, CheckoutError, cancel_order, checkout
+from backend.catalog_cache import bump_catalog_version, cache_catalog_response, catalog_etag, product_scopes
+from backend.facets import category_facets
+from backend.fast_serializers import ordered_by_ids, orders_data, product_info_rows, product_infos_data
+from backend.filters import ORDER_VIEWS, CatalogFilterError, OrderFilterError, filter_catalog, filter_orders, \
+    order_catalog, order_list_view
+from backend.pagination import OrderCursorPagination, ProductInfoCursorPagination
+from backend.search import get_search_backend
 from backend.signals import new_user_registered, new_order
 
 
@@ -430,6 +438,7 @@ class LoginAccount(APIView):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+@method_decorator(catalog_etag(), name='get')
 class CategoryView(ListAPIView):
     """
     Класс для просмотра категорий
@@ -438,6 +447,7 @@ class CategoryView(ListAPIView):
     serializer_class = CategorySerializer
 
 
+@method_decorator(catalog_etag(), name='get')
 class ShopView(ListAPIView):
     """
     Класс для просмотра списка магазинов
@@ -446,6 +456,8 @@ class ShopView(ListAPIView):
     serializer_class = ShopSerializer
 
 
+@method_decorator(catalog_etag(product_scopes), name='get')
+@method_decorator(cache_catalog_response(product_scopes), name='get')
 class ProductInfoView(APIView):
     """
         A class for searching products.
@@ -458,7 +470,16 @@ class ProductInfoView(APIView):
         """
 
     @extend_schema(
-        description="Retrieve the product information based on optional filters: 'shop_id' and 'category_id'.",
+        description="Retrieve the product information based on optional filters: 'shop_id', 'category_id', "
+                    "'price_min'/'price_max', 'in_stock' and product parameters ('param[Цвет]=черный', "
+                    "repeat a parameter to match any of several values; "
+                    "'param_min[Диагональ (дюйм)]=6' and 'param_max[...]' for numeric ranges). "
+                    "'ordering' sorts by 'price' or 'quantity', or by a numeric parameter with 'param:<name>'; "
+                    "prefix it with '-' for descending order. 'fields' limits the returned fields. "
+                    "Results are paginated by cursor: follow the 'next' and 'previous' links. When 'category_id' "
+                    "is given, the response also contains 'facets': product counts per parameter value "
+                    "in the category. Responses carry an ETag that changes with the catalog: send it back "
+                    "in 'If-None-Match' to get 304 Not Modified.",
         parameters=[
             OpenApiParameter(
                 name='shop_id',
@@ -471,46 +492,133 @@ class ProductInfoView(APIView):
                 description='ID of the category to filter the products by',
                 required=False,
                 type=OpenApiTypes.INT
+            ),
+            OpenApiParameter(
+                name='price_min',
+                description='Minimum price',
+                required=False,
+                type=OpenApiTypes.INT
+            ),
+            OpenApiParameter(
+                name='price_max',
+                description='Maximum price',
+                required=False,
+                type=OpenApiTypes.INT
+            ),
+            OpenApiParameter(
+                name='in_stock',
+                description='true - only products with a positive quantity, false - only sold out products',
+                required=False,
+                type=OpenApiTypes.BOOL
+            ),
+            OpenApiParameter(
+                name='param[<name>]',
+                description='Value of the product parameter <name>, e.g. param[Цвет]=черный',
+                required=False,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='param_min[<name>]',
+                description='Minimum numeric value of the product parameter <name>, e.g. param_min[Диагональ (дюйм)]=6',
+                required=False,
+                type=OpenApiTypes.NUMBER
+            ),
+            OpenApiParameter(
+                name='param_max[<name>]',
+                description='Maximum numeric value of the product parameter <name>',
+                required=False,
+                type=OpenApiTypes.NUMBER
+            ),
+            OpenApiParameter(
+                name='ordering',
+                description='Sort order: "price", "-price", "quantity", "-quantity", '
+                            'or "param:<name>" / "-param:<name>" for a numeric parameter',
+                required=False,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='fields',
+                description='Comma-separated fields to return, nested fields with a dot: "id,model,price,product.name"',
+                required=False,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='cursor',
+                description='Opaque cursor from the "next" or "previous" link',
+                required=False,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='page_size',
+                description='Number of products per page',
+                required=False,
+                type=OpenApiTypes.INT
             )
         ],
         responses={
             200: OpenApiResponse(
                 response=ProductInfoSerializer(many=True),
-                description="List of product information based on the provided filters.",
+                description="Page of product information based on the provided filters.",
                 examples=[
                     OpenApiExample(
                         name="Ответ без фильтров",
-                        value=[
-                            {
-                                "product": {
-                                    "name": "Product A",
-                                    "category": {
-                                        "id": 1,
-                                        "name": "Electronics"
-                                    }
-                                },
-                                "shop": {
-                                    "id": 2,
-                                    "name": "Best Shop"
-                                },
-                                "quantity": 10,
-                                "price": 1000,
-                                "product_parameters": [
-                                    {
-                                        "parameter": {"name": "Color"},
-                                        "value": "Black"
+                        value={
+                            "next": "http://example.com/api/v1/products?cursor=cD00MA%3D%3D",
+                            "previous": None,
+                            "results": [
+                                {
+                                    "product": {
+                                        "name": "Product A",
+                                        "category": {
+                                            "id": 1,
+                                            "name": "Electronics"
+                                        }
                                     },
-                                    {
-                                        "parameter": {"name": "Size"},
-                                        "value": "M"
-                                    }
-                                ]
-                            }
-                        ]
+                                    "shop": {
+                                        "id": 2,
+                                        "name": "Best Shop"
+                                    },
+                                    "quantity": 10,
+                                    "price": 1000,
+                                    "product_parameters": [
+                                        {
+                                            "parameter": {"name": "Color"},
+                                            "value": "Black"
+                                        },
+                                        {
+                                            "parameter": {"name": "Size"},
+                                            "value": "M"
+                                        }
+                                    ]
+                                }
+                            ]
+                        }
                     ),
                     OpenApiExample(
                         name="Ответ с фильтрацией по магазину",
-                        value=[]
+                        value={"next": None, "previous": None, "results": []}
+                    ),
+                    OpenApiExample(
+                        name="Ответ с фильтрацией по категории и параметру",
+                        value={
+                            "next": None,
+                            "previous": None,
+                            "results": [],
+                            "facets": {
+                                "Встроенная память (Гб)": {"256": 12, "512": 4},
+                                "Цвет": {"черный": 10, "красный": 6}
+                            }
+                        }
+                    )
+                ]
+            ),
+            304: OpenApiResponse(description="The catalog has not changed since the ETag in If-None-Match"),
+            400: OpenApiResponse(
+                description="Invalid filter or ordering",
+                examples=[
+                    OpenApiExample(
+                        name="Некорректный фильтр",
+                        value={"Status": False, "Errors": "param_min[Диагональ (дюйм)]: ожидается число, получено 'abc'"}
                     )
                 ]
             )
@@ -526,25 +634,141 @@ class ProductInfoView(APIView):
                Returns:
                - Response: The response containing the product information.
                """
-        query = Q(shop__state=True)
-        shop_id = request.query_params.get('shop_id')
+        try:
+            fields = parse_fields(request.query_params.get('fields'), ProductInfoSerializer)
+            queryset, ordering = order_catalog(filter_catalog(ProductInfo.objects.all(), request.query_params),
+                                               request.query_params)
+        except (CatalogFilterError, SparseFieldsError) as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        queryset = product_info_rows(queryset, fields, ordering)
+
+        paginator = ProductInfoCursorPagination()
+        paginator.ordering = ordering
+        page = paginator.paginate_queryset(queryset, request, view=self)
+
+        response = paginator.get_paginated_response(product_infos_data(page, fields))
         category_id = request.query_params.get('category_id')
+        if category_id:
+            # значения параметров для панели фильтров категории
+            response.data['facets'] = category_facets(category_id)
+        return response
 
-        if shop_id:
-            query = query & Q(shop_id=shop_id)
 
-        if category_id:
-            query = query & Q(product__category_id=category_id)
+class ProductSearchView(APIView):
+    """
+    A class for full-text product search.
 
-        # фильтруем и отбрасываем дубликаты
-        queryset = ProductInfo.objects.filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+    Methods:
+    - get: Search products by name, model, category and parameter values.
 
-        serializer = ProductInfoSerializer(queryset, many=True)
+    Attributes:
+    - None
+    """
 
-        return Response(serializer.data)
+    @extend_schema(
+        description="Search products by name, model, category and parameter values. All words of the query must "
+                    "match (Russian words are matched by stem); results are ordered by relevance.",
+        parameters=[
+            OpenApiParameter(
+                name='q',
+                description='Search query, e.g. "iPhone 256 красный"',
+                required=True,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='shop_id',
+                description='ID of the shop to filter the products by',
+                required=False,
+                type=OpenApiTypes.INT
+            ),
+            OpenApiParameter(
+                name='category_id',
+                description='ID of the category to filter the products by',
+                required=False,
+                type=OpenApiTypes.INT
+            ),
+            OpenApiParameter(
+                name='fields',
+                description='Comma-separated fields to return, nested fields with a dot: "id,model,price,product.name"',
+                required=False,
+                type=OpenApiTypes.STR
+            ),
+            OpenApiParameter(
+                name='page_size',
+                description='Maximum number of products in the response',
+                required=False,
+                type=OpenApiTypes.INT
+            )
+        ],
+        responses={
+            200: OpenApiResponse(
+                response=ProductInfoSerializer(many=True),
+                description="Products matching the query, most relevant first.",
+                examples=[
+                    OpenApiExample(
+                        name="Найденные товары",
+                        value={
+                            "results": [
+                                {
+                                    "id": 1,
+                                    "model": "apple/iphone/xs-max",
+                                    "product": {"name": "Смартфон Apple iPhone XS Max 256GB (красный)",
+                                                "category": "Смартфоны"},
+                                    "shop": 1,
+                                    "quantity": 14,
+                                    "price": 110000,
+                                    "price_rrc": 116990,
+                                    "product_parameters": [
+                                        {"parameter": "Цвет", "value": "красный"}
+                                    ]
+                                }
+                            ]
+                        }
+                    )
+                ]
+            ),
+            400: OpenApiResponse(
+                description="Search query is missing",
+                examples=[
+                    OpenApiExample(
+                        name="Нет запроса",
+                        value={"Status": False, "Errors": "Не указаны все необходимые аргументы"}
+                    )
+                ]
+            )
+        }
+    )
+    def get(self, request: Request, *args, **kwargs):
+        """
+        Search products by the query in the 'q' parameter.
+
+        Args:
+        - request (Request): The Django request object.
+
+        Returns:
+        - Response: The response containing the matching products.
+        """
+        search_query = request.query_params.get('q', '').strip()
+        if not search_query:
+            return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'}, status=400)
+
+        try:
+            limit = min(int(request.query_params.get('page_size', settings.PRODUCTS_PAGE_SIZE)),
+                        settings.PRODUCTS_MAX_PAGE_SIZE)
+        except ValueError:
+            limit = settings.PRODUCTS_PAGE_SIZE
+
+        try:
+            fields = parse_fields(request.query_params.get('fields'), ProductInfoSerializer)
+            queryset = filter_catalog(ProductInfo.objects.all(), request.query_params)
+        except (CatalogFilterError, SparseFieldsError) as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+
+        # поиск возвращает ИД в порядке релевантности, сами товары выбираются одним запросом
+        found = get_search_backend().search(queryset, search_query, max(limit, 1))
+        rows = product_info_rows(ProductInfo.objects.filter(id__in=found), fields)
+
+        return Response({'results': product_infos_data(ordered_by_ids(rows, found), fields)})
 
 
 class BasketView(APIView):
@@ -553,9 +777,10 @@ class BasketView(APIView):
 
     Methods:
     - get: Retrieve the items in the user's basket.
-    - post: Add an item to the user's basket.
+    - post: Add items to the user's basket in one transaction.
     - put: Update the quantity of an item in the user's basket.
     - delete: Remove an item from the user's basket.
+    - patch: Add, update and remove items in one request.
 
     Attributes:
     - None
@@ -608,14 +833,10 @@ class BasketView(APIView):
                 """
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        basket = Order.objects.filter(
-            user_id=request.user.id, state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        # сумма корзины - по текущим ценам, у оформленных заказов - сохранённая
+        basket = Order.objects.filter(user_id=request.user.id, state='basket').with_basket_total()
 
-        serializer = OrderSerializer(basket, many=True)
-        return Response(serializer.data)
+        return Response(orders_data(basket, total='basket_total'))
 
     # редактировать корзину
     def post(self, request, *args, **kwargs):
@@ -634,32 +855,23 @@ class BasketView(APIView):
         items_sting = request.data.get('items')
         if items_sting:
             try:
-                items_dict = load_json(items_sting)
+                items_dict = load_json(items_sting) if isinstance(items_sting, str) else items_sting
             except ValueError as e:
                 # Логируем ошибку в Sentry
                 sentry_sdk.capture_exception(e)
                 return JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-                objects_created = 0
-                for order_item in items_dict:
-                    order_item.update({'order': basket.id})
-                    serializer = OrderItemSerializer(data=order_item)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            # Логируем ошибку в Sentry
-                            sentry_sdk.capture_exception(error)
-                            return JsonResponse({'Status': False, 'Errors': str(error)})
-                        else:
-                            objects_created += 1
-
-                    else:
-
-                        return JsonResponse({'Status': False, 'Errors': serializer.errors})
+                try:
+                    objects_created, objects_updated = add_to_basket(request.user.id, items_dict)
+                except BasketError as error:
+                    return JsonResponse({'Status': False, 'Errors': error.errors})
+                except IntegrityError as error:
+                    # Логируем ошибку в Sentry
+                    sentry_sdk.capture_exception(error)
+                    return JsonResponse({'Status': False, 'Errors': str(error)})
 
-                return JsonResponse({'Status': True, 'Создано объектов': objects_created})
+                return JsonResponse({'Status': True, 'Создано объектов': objects_created,
+                                     'Обновлено объектов': objects_updated})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
     # удалить товары из корзины
@@ -678,17 +890,12 @@ class BasketView(APIView):
 
         items_sting = request.data.get('items')
         if items_sting:
-            items_list = items_sting.split(',')
-            basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-            query = Q()
-            objects_deleted = False
-            for order_item_id in items_list:
-                if order_item_id.isdigit():
-                    query = query | Q(order_id=basket.id, id=order_item_id)
-                    objects_deleted = True
-
-            if objects_deleted:
-                deleted_count = OrderItem.objects.filter(query).delete()[0]
+            try:
+                item_ids = parse_remove_items(items_sting)
+            except BasketError as error:
+                return JsonResponse({'Status': False, 'Errors': error.errors})
+            if item_ids:
+                deleted_count = remove_from_basket(request.user.id, item_ids)
                 return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -709,22 +916,86 @@ class BasketView(APIView):
         items_sting = request.data.get('items')
         if items_sting:
             try:
-                items_dict = load_json(items_sting)
+                items_dict = load_json(items_sting) if isinstance(items_sting, str) else items_sting
             except ValueError as e:
                 # Логируем ошибку в Sentry
                 sentry_sdk.capture_exception(e)
                 return JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-                objects_updated = 0
-                for order_item in items_dict:
-                    if type(order_item['id']) == int and type(order_item['quantity']) == int:
-                        objects_updated += OrderItem.objects.filter(order_id=basket.id, id=order_item['id']).update(
-                            quantity=order_item['quantity'])
+                try:
+                    objects_updated = update_basket(request.user.id, items_dict)
+                except BasketError as error:
+                    return JsonResponse({'Status': False, 'Errors': error.errors})
 
                 return JsonResponse({'Status': True, 'Обновлено объектов': objects_updated})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
+    @extend_schema(
+        description="Synchronize the basket in one request and one transaction: 'remove' deletes basket items "
+                    "by id, 'update' sets new quantities, 'add' adds goods (quantities of goods already in the "
+                    "basket are increased). Nothing is changed if any line is invalid.",
+        request={
+            "application/json": {
+                "type": "object",
+                "properties": {
+                    "add": {"type": "string", "description": 'JSON list: [{"product_info": 1, "quantity": 2}]'},
+                    "update": {"type": "string", "description": 'JSON list: [{"id": 5, "quantity": 3}]'},
+                    "remove": {"type": "string", "description": 'Comma-separated basket item ids: "6,7"'}
+                }
+            }
+        },
+        responses={
+            200: OpenApiResponse(
+                description="Basket updated or line-level errors",
+                examples=[
+                    OpenApiExample(
+                        name="Успех",
+                        value={"Status": True, "Создано объектов": 1, "Обновлено объектов": 1, "Удалено объектов": 2}
+                    ),
+                    OpenApiExample(
+                        name="Ошибка в позиции",
+                        value={"Status": False, "Errors": [{"item": 0, "error": "Товар 1 не найден или не продаётся"}]}
+                    )
+                ]
+            )
+        }
+    )
+    # добавить, изменить и удалить позиции корзины одним запросом
+    def patch(self, request, *args, **kwargs):
+        """
+               Add, update and remove basket items in one transaction.
+
+               Args:
+               - request (Request): The Django request object.
+
+               Returns:
+               - JsonResponse: The response indicating the status of the operation and any errors.
+               """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        add, update, remove = (request.data.get(key) for key in ('add', 'update', 'remove'))
+        if not (add or update or remove):
+            return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
+        try:
+            add, update = (load_json(items) if isinstance(items, str) else items for items in (add, update))
+        except ValueError as e:
+            # Логируем ошибку в Sentry
+            sentry_sdk.capture_exception(e)
+            return JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
+
+        try:
+            result = sync_basket(request.user.id, add=add, update=update, remove=remove)
+        except BasketError as error:
+            return JsonResponse({'Status': False, 'Errors': error.errors})
+        except IntegrityError as error:
+            # Логируем ошибку в Sentry
+            sentry_sdk.capture_exception(error)
+            return JsonResponse({'Status': False, 'Errors': str(error)})
+
+        return JsonResponse({'Status': True, 'Создано объектов': result['created'],
+                             'Обновлено объектов': result['updated'], 'Удалено объектов': result['deleted']})
+
 
 class PartnerUpdate(APIView):
     """
@@ -738,13 +1009,13 @@ class PartnerUpdate(APIView):
     """
 
     @extend_schema(
-        description="Update the partner (shop) information by providing either a 'url' to a YAML file or uploading a local 'file' with product data.",
+        description="Update the partner (shop) information by providing either a 'url' to a price list or uploading a local 'file' with product data. YAML, JSON Lines and CSV price lists are accepted, optionally compressed with gzip or zstd; the format is detected automatically.",
         request={
             "multipart/form-data": {
                 "type": "object",
                 "properties": {
-                    "url": {"type": "string", "format": "uri", "description": "URL to a YAML file with product data"},
-                    "file": {"type": "string", "format": "binary", "description": "Local YAML file with product data"}
+                    "url": {"type": "string", "format": "uri", "description": "URL to a price list (YAML, JSON Lines or CSV, optionally gzip/zstd)"},
+                    "file": {"type": "string", "format": "binary", "description": "Local price list file (YAML, JSON Lines or CSV, optionally gzip/zstd)"}
                 }
             }
         },
@@ -754,11 +1025,11 @@ class PartnerUpdate(APIView):
                 examples=[
                     OpenApiExample(
                         name="Успех (URL)",
-                        value={"Status": True, "Message": "Данные загружаются"}
+                        value={"Status": True, "Message": "Данные загружаются", "Job": 1}
                     ),
                     OpenApiExample(
                         name="Успех (File)",
-                        value={"Status": True, "Message": "Данные загружаются"}
+                        value={"Status": True, "Message": "Данные загружаются", "Job": 2}
                     )
                 ]
             ),
@@ -772,14 +1043,6 @@ class PartnerUpdate(APIView):
                     OpenApiExample(
                         name="Неверный формат URL",
                         value={"Status": False, "Error": "Enter a valid URL."}
-                    ),
-                    OpenApiExample(
-                        name="Ошибка при запросе URL",
-                        value={"Status": False, "Error": "Ошибка при запросе URL: <details>"}
-                    ),
-                    OpenApiExample(
-                        name="Ошибка YAML",
-                        value={"Status": False, "Error": "Ошибка при обработке YAML: <details>"}
                     )
                 ]
             ),
@@ -795,15 +1058,6 @@ class PartnerUpdate(APIView):
                         value={"Status": False, "Error": "Только для магазинов"}
                     )
                 ]
-            ),
-            500: OpenApiResponse(
-                description="Internal server error",
-                examples=[
-                    OpenApiExample(
-                        name="Непредвиденная ошибка",
-                        value={"Status": False, "Error": "Непредвиденная ошибка: <details>"}
-                    )
-                ]
             )
         },
         examples=[
@@ -844,9 +1098,19 @@ class PartnerUpdate(APIView):
 
         return JsonResponse({'Status': False, 'Error': 'Не указаны все необходимые аргументы'}, status=400)
 
+    @staticmethod
+    def _get_shop(user):
+        """
+        Магазин партнёра; создаётся только для проверенного запроса на загрузку прайс-листа
+        """
+        shop = Shop.objects.filter(user_id=user.id).first()
+        if shop is None:
+            shop = Shop.objects.create(user_id=user.id, name=(user.company or user.email)[:50])
+        return shop
+
     def _process_url(self, url, user):
         """
-        Обработка данных из URL
+        Обработка данных из URL: прайс-лист скачивается и загружается в задаче Celery
         """
         validate_url = URLValidator()
         try:
@@ -856,48 +1120,141 @@ class PartnerUpdate(APIView):
             sentry_sdk.capture_exception(e)
             return JsonResponse({'Status': False, 'Error': str(e)}, status=400)
 
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            data = yaml.safe_load(response.content)
+        # Запуск задачи Celery для загрузки данных
+        job = start_import(self._get_shop(user), 'url', url=url)
+        return JsonResponse({'Status': True, 'Message': 'Данные загружаются', 'Job': job.id}, status=202)
 
-            # Запуск задачи Celery для загрузки данных
-            do_import.delay(data, user.id)
+    def _process_file(self, file, user):
+        """
+        Обработка данных из локального файла: файл сохраняется в хранилище и загружается в задаче Celery
+        """
+        job = start_import(self._get_shop(user), 'file', file=file)
+        return JsonResponse({'Status': True, 'Message': 'Данные загружаются', 'Job': job.id}, status=202)
 
-            return JsonResponse({'Status': True, 'Message': 'Данные загружаются'}, status=202)
-        except requests.exceptions.RequestException as e:
-            # Логируем ошибку в Sentry
-            sentry_sdk.capture_exception(e)
-            return JsonResponse({'Status': False, 'Error': f'Ошибка при запросе URL: {str(e)}'}, status=400)
-        except yaml.YAMLError as e:
-            # Логируем ошибку в Sentry
-            sentry_sdk.capture_exception(e)
-            return JsonResponse({'Status': False, 'Error': f'Ошибка при обработке YAML: {str(e)}'}, status=400)
-        except Exception as e:
-            # Логируем ошибку в Sentry
-            sentry_sdk.capture_exception(e)
-            return JsonResponse({'Status': False, 'Error': f'Непредвиденная ошибка: {str(e)}'}, status=500)
 
-    def _process_file(self, file, user):
+class PartnerImports(APIView):
+    """
+    Класс для получения истории импортов прайс-листа
+    """
+
+    @extend_schema(
+        description="Retrieve the latest price list imports of the authenticated partner.",
+        responses={
+            200: OpenApiResponse(
+                response=ImportJobSerializer(many=True),
+                description="Import history, newest first."
+            ),
+            403: OpenApiResponse(
+                description="User not authenticated or not a shop",
+                examples=[
+                    OpenApiExample(
+                        name="Не аутентифицирован",
+                        value={"Status": False, "Error": "Log in required"}
+                    ),
+                    OpenApiExample(
+                        name="Не магазин",
+                        value={"Status": False, "Error": "Только для магазинов"}
+                    )
+                ]
+            )
+        }
+    )
+    def get(self, request, *args, **kwargs):
         """
-        Обработка данных из локального файла
+               Retrieve the import history of the partner.
+
+               Args:
+               - request (Request): The Django request object.
+
+               Returns:
+               - Response: The response containing the import jobs.
+               """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
+
+        jobs = ImportJob.objects.filter(shop__user_id=request.user.id)[:settings.IMPORT_HISTORY_SIZE]
+        serializer = ImportJobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+
+class PartnerImportStatus(APIView):
+    """
+    Класс для получения статуса и прогресса импорта прайс-листа
+    """
+
+    @extend_schema(
+        description="Retrieve the state and progress of a price list import started by the authenticated partner.",
+        responses={
+            200: OpenApiResponse(
+                response=ImportJobSerializer,
+                description="Import job state and progress.",
+                examples=[
+                    OpenApiExample(
+                        name="Успех",
+                        value={
+                            "id": 1,
+                            "url": "https://example.com/shop1.yaml",
+                            "state": "importing",
+                            "bytes_read": 1048576,
+                            "goods_parsed": 2000,
+                            "rows_written": 8000,
+                            "error": "",
+                            "created_at": "2024-01-01T12:00:00Z",
+                            "finished_at": None
+                        }
+                    )
+                ]
+            ),
+            403: OpenApiResponse(
+                description="User not authenticated or not a shop",
+                examples=[
+                    OpenApiExample(
+                        name="Не аутентифицирован",
+                        value={"Status": False, "Error": "Log in required"}
+                    ),
+                    OpenApiExample(
+                        name="Не магазин",
+                        value={"Status": False, "Error": "Только для магазинов"}
+                    )
+                ]
+            ),
+            404: OpenApiResponse(
+                description="Import job not found",
+                examples=[
+                    OpenApiExample(
+                        name="Не найдено",
+                        value={"Status": False, "Error": "Импорт не найден"}
+                    )
+                ]
+            )
+        }
+    )
+    def get(self, request, job_id, *args, **kwargs):
         """
-        try:
-            # Чтение содержимого файла
-            data = yaml.safe_load(file.read())
+               Retrieve the state and progress of the import job.
 
-            # Запуск задачи Celery для загрузки данных
-            do_import.delay(data, user.id)
+               Args:
+               - request (Request): The Django request object.
+               - job_id (int): The import job ID.
 
-            return JsonResponse({'Status': True, 'Message': 'Данные загружаются'}, status=202)
-        except yaml.YAMLError as e:
-            # Логируем ошибку в Sentry
-            sentry_sdk.capture_exception(e)
-            return JsonResponse({'Status': False, 'Error': f'Ошибка при обработке YAML: {str(e)}'}, status=400)
-        except Exception as e:
-            # Логируем ошибку в Sentry
-            sentry_sdk.capture_exception(e)
-            return JsonResponse({'Status': False, 'Error': f'Непредвиденная ошибка: {str(e)}'}, status=500)
+               Returns:
+               - Response: The response containing the import job state.
+               """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
+
+        job = ImportJob.objects.filter(id=job_id, shop__user_id=request.user.id).first()
+        if not job:
+            return JsonResponse({'Status': False, 'Error': 'Импорт не найден'}, status=404)
+
+        serializer = ImportJobSerializer(job)
+        return Response(serializer.data)
 
 
 class PartnerState(APIView):
@@ -1045,6 +1402,10 @@ class PartnerState(APIView):
         if state:
             try:
                 Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state))
+                # товары магазина появились в каталоге или пропали из него - пересчитываем фасеты
+                for shop_id in Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True):
+                    bump_catalog_version('base', f'shop:{shop_id}')
+                    refresh_facets.delay(shop_id)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 # Логируем ошибку в Sentry
@@ -1054,6 +1415,63 @@ class PartnerState(APIView):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+ORDER_LIST_DESCRIPTION = (
+    "Results are paginated by cursor on the order date: follow the 'next' and 'previous' links, "
+    "'page_size' sets the page size. Filter by 'state' (comma-separated) and by the order date with "
+    "'date_from'/'date_to'. 'view=summary' returns orders without 'ordered_items'.")
+
+ORDER_LIST_PARAMETERS = [
+    OpenApiParameter(
+        name='state',
+        description='Order states, comma-separated, e.g. new,confirmed',
+        required=False,
+        type=OpenApiTypes.STR
+    ),
+    OpenApiParameter(
+        name='date_from',
+        description='Orders placed at or after this date (YYYY-MM-DD) or ISO 8601 date and time',
+        required=False,
+        type=OpenApiTypes.STR
+    ),
+    OpenApiParameter(
+        name='date_to',
+        description='Orders placed up to this date inclusive (YYYY-MM-DD) or ISO 8601 date and time',
+        required=False,
+        type=OpenApiTypes.STR
+    ),
+    OpenApiParameter(
+        name='view',
+        description="'full' (default) - orders with their items, 'summary' - orders without 'ordered_items'",
+        required=False,
+        type=OpenApiTypes.STR,
+        enum=list(ORDER_VIEWS)
+    ),
+    OpenApiParameter(
+        name='page_size',
+        description='Number of orders per page',
+        required=False,
+        type=OpenApiTypes.INT
+    ),
+]
+
+
+def order_history(view, request, orders, items=None, total='total_sum'):
+    """
+    Страница истории заказов с фильтрами из запроса. Курсор выбирает ИД заказов страницы по (dt, id),
+    затем данные собираются только для этих заказов.
+    """
+    try:
+        orders = filter_orders(orders, request.query_params)
+        summary = order_list_view(request.query_params)
+    except OrderFilterError as error:
+        return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+
+    paginator = OrderCursorPagination()
+    page = paginator.paginate_queryset(orders.values('id', 'dt'), request, view=view)
+    orders = orders.filter(id__in=[row['id'] for row in page]).order_by(*paginator.ordering)
+    return paginator.get_paginated_response(orders_data(orders, items, total, summary))
+
+
 class PartnerOrders(APIView):
     """
     Класс для получения заказов поставщиками
@@ -1065,47 +1483,63 @@ class PartnerOrders(APIView):
     """
 
     @extend_schema(
-        description="Retrieve all non-basket orders related to the authenticated partner (shop).",
+        description="Retrieve non-basket orders related to the authenticated partner (shop), newest first, "
+                    "with the shop's own items and their total. " + ORDER_LIST_DESCRIPTION,
+        parameters=ORDER_LIST_PARAMETERS,
         responses={
             200: OpenApiResponse(
                 response=OrderSerializer(many=True),
-                description="List of orders for the partner.",
+                description="Page of orders for the partner.",
                 examples=[
                     OpenApiExample(
                         name="Успех",
-                        value=[
-                            {
-                                "id": 10,
-                                "state": "new",
-                                "contact": {
-                                    "id": 5,
-                                    "city": "Moscow",
-                                    "street": "Tverskaya",
-                                    "phone": "+7 123 456-78-90"
-                                },
-                                "total_sum": 3000,
-                                "ordered_items": [
-                                    {
-                                        "product_info": {
-                                            "product": {
-                                                "name": "Laptop",
-                                                "category": {
-                                                    "id": 2,
-                                                    "name": "Electronics"
-                                                }
-                                            },
-                                            "shop": {
-                                                "id": 3,
-                                                "name": "Best Shop"
-                                            },
-                                            "quantity": 1,
-                                            "price": 3000
-                                        },
-                                        "quantity": 1
+                        value={
+                            "next": "http://localhost:8000/api/v1/...?cursor=cD0yMDI0LTA1LTAx",
+                            "previous": None,
+                            "results": [
+                                {
+                                    "id": 10,
+                                    "ordered_items": [
+                                        {"id": 21, "product_info": 7, "quantity": 1}
+                                    ],
+                                    "state": "new",
+                                    "dt": "2024-05-01T12:00:00+03:00",
+                                    "total_sum": 3000,
+                                    "contact": {
+                                        "id": 5,
+                                        "city": "Moscow",
+                                        "street": "Tverskaya",
+                                        "phone": "+7 123 456-78-90"
                                     }
-                                ]
-                            }
-                        ]
+                                }
+                            ]
+                        }
+                    ),
+                    OpenApiExample(
+                        name="Сводка (view=summary)",
+                        value={
+                            "next": None,
+                            "previous": None,
+                            "results": [
+                                {
+                                    "id": 10,
+                                    "state": "new",
+                                    "dt": "2024-05-01T12:00:00+03:00",
+                                    "total_sum": 3000,
+                                    "contact": None
+                                }
+                            ]
+                        }
+                    )
+                ]
+            ),
+            400: OpenApiResponse(
+                description="Invalid filter",
+                examples=[
+                    OpenApiExample(
+                        name="Некорректный фильтр",
+                        value={"Status": False, "Errors": "date_from: ожидается дата YYYY-MM-DD или дата и время "
+                                                          "ISO 8601, получено '01.05.2024'"}
                     )
                 ]
             ),
@@ -1140,14 +1574,11 @@ class PartnerOrders(APIView):
         if request.user.type != 'shop':
             return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
 
-        order = Order.objects.filter(
-            ordered_items__product_info__shop__user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        # магазин видит только свои позиции заказа и их сумму
+        shop_items = OrderItem.objects.filter(product_info__shop__user_id=request.user.id)
+        orders = Order.objects.with_shop(request.user.id).exclude(state='basket').with_shop_total(request.user.id)
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        return order_history(self, request, orders, shop_items, total='shop_total')
 
 
 class ContactView(APIView):
@@ -1471,54 +1902,70 @@ class OrderView(APIView):
     - get: Retrieve the details of a specific order.
     - post: Create a new order.
     - put: Update the details of a specific order.
-    - delete: Delete a specific order.
+    - delete: Cancel an order and release its reserved stock.
 
     Attributes:
     - None
     """
 
     @extend_schema(
-        description="Retrieve all orders (except 'basket') of the authenticated user.",
+        description="Retrieve orders (except 'basket') of the authenticated user, newest first. "
+                    + ORDER_LIST_DESCRIPTION,
+        parameters=ORDER_LIST_PARAMETERS,
         responses={
             200: OpenApiResponse(
                 response=OrderSerializer(many=True),
-                description="List of user orders.",
+                description="Page of user orders.",
                 examples=[
                     OpenApiExample(
                         name="Успех",
-                        value=[
-                            {
-                                "id": 5,
-                                "state": "new",
-                                "contact": {
-                                    "id": 3,
-                                    "city": "Moscow",
-                                    "street": "Tverskaya",
-                                    "phone": "+7 123 456-78-90"
-                                },
-                                "total_sum": 2000,
-                                "ordered_items": [
-                                    {
-                                        "product_info": {
-                                            "product": {
-                                                "name": "Smartphone",
-                                                "category": {
-                                                    "id": 1,
-                                                    "name": "Electronics"
-                                                }
-                                            },
-                                            "shop": {
-                                                "id": 2,
-                                                "name": "Gadget Store"
-                                            },
-                                            "quantity": 1,
-                                            "price": 2000
-                                        },
-                                        "quantity": 1
+                        value={
+                            "next": "http://localhost:8000/api/v1/...?cursor=cD0yMDI0LTA1LTAx",
+                            "previous": None,
+                            "results": [
+                                {
+                                    "id": 5,
+                                    "ordered_items": [
+                                        {"id": 21, "product_info": 7, "quantity": 1}
+                                    ],
+                                    "state": "new",
+                                    "dt": "2024-05-01T12:00:00+03:00",
+                                    "total_sum": 2000,
+                                    "contact": {
+                                        "id": 5,
+                                        "city": "Moscow",
+                                        "street": "Tverskaya",
+                                        "phone": "+7 123 456-78-90"
                                     }
-                                ]
-                            }
-                        ]
+                                }
+                            ]
+                        }
+                    ),
+                    OpenApiExample(
+                        name="Сводка (view=summary)",
+                        value={
+                            "next": None,
+                            "previous": None,
+                            "results": [
+                                {
+                                    "id": 5,
+                                    "state": "new",
+                                    "dt": "2024-05-01T12:00:00+03:00",
+                                    "total_sum": 2000,
+                                    "contact": None
+                                }
+                            ]
+                        }
+                    )
+                ]
+            ),
+            400: OpenApiResponse(
+                description="Invalid filter",
+                examples=[
+                    OpenApiExample(
+                        name="Некорректный фильтр",
+                        value={"Status": False, "Errors": "date_from: ожидается дата YYYY-MM-DD или дата и время "
+                                                          "ISO 8601, получено '01.05.2024'"}
                     )
                 ]
             ),
@@ -1546,17 +1993,14 @@ class OrderView(APIView):
                """
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        order = Order.objects.filter(
-            user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        orders = Order.objects.filter(
+            user_id=request.user.id).exclude(state='basket')
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        return order_history(self, request, orders)
 
     @extend_schema(
-        description="Place an order from the user's basket by providing the order ID and a contact ID.",
+        description="Place an order from the user's basket by providing the order ID and a contact ID. "
+                    "Stock is reserved for every line; if any line is short, nothing is reserved.",
         request={
             "application/json": {
                 "type": "object",
@@ -1586,6 +2030,16 @@ class OrderView(APIView):
                     )
                 ]
             ),
+            409: OpenApiResponse(
+                description="Not enough stock for some lines; nothing was reserved",
+                examples=[
+                    OpenApiExample(
+                        name="Недостаточно товара",
+                        value={"Status": False, "Errors": [
+                            {"product_info": 12, "error": "Недостаточно товара: заказано 3, доступно 1"}]}
+                    )
+                ]
+            ),
             403: OpenApiResponse(
                 description="User not authenticated",
                 examples=[
@@ -1631,40 +2085,90 @@ class OrderView(APIView):
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
 
         if {'id', 'contact'}.issubset(request.data):
-            if request.data['id'].isdigit():
+            if str(request.data['id']).isdigit() and str(request.data['contact']).isdigit():
                 try:
-                    is_updated = Order.objects.filter(
-                        user_id=request.user.id, id=request.data['id']).update(
-                        contact_id=request.data['contact'],
-                        state='new')
+                    checkout(request.user.id, int(request.data['id']), int(request.data['contact']))
+                except CheckoutError as error:
+                    # 409 - не хватает остатков по позициям, 400 - неверная корзина или контакт
+                    out_of_stock = any(line['product_info'] is not None for line in error.errors)
+                    return JsonResponse({'Status': False, 'Errors': error.errors}, status=409 if out_of_stock else 400)
                 except IntegrityError as error:
-                    # print(error)
                     # Логируем ошибку в Sentry
                     sentry_sdk.capture_exception(error)
                     return JsonResponse({'Status': False, 'Errors': 'Неправильно указаны аргументы'})
                 else:
-                    if is_updated:
-                        new_order.send(sender=self.__class__, user_id=request.user.id)
-                        return JsonResponse({'Status': True})
+                    new_order.send(sender=self.__class__, user_id=request.user.id)
+                    return JsonResponse({'Status': True})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
+    @extend_schema(
+        description="Cancel the user's order in state 'new' or 'confirmed'; the reserved stock is returned.",
+        request={
+            "application/json": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string", "example": "5"}
+                },
+                "required": ["id"]
+            }
+        },
+        responses={
+            200: OpenApiResponse(
+                description="Order canceled",
+                examples=[OpenApiExample(name="Успех", value={"Status": True})]
+            ),
+            404: OpenApiResponse(
+                description="No such order that can be canceled",
+                examples=[OpenApiExample(name="Заказ не найден",
+                                         value={"Status": False, "Errors": "Заказ не найден или не может быть отменён"})]
+            )
+        }
+    )
+    # отменить заказ
+    def delete(self, request, *args, **kwargs):
+        """
+               Cancel an order and release the reserved stock.
+
+               Args:
+               - request (Request): The Django request object.
+
+               Returns:
+               - JsonResponse: The response indicating the status of the operation and any errors.
+               """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        order_id = str(request.data.get('id', ''))
+        if not order_id.isdigit():
+            return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
+        if not cancel_order(int(order_id), user_id=request.user.id, states=BUYER_CANCELABLE_STATES):
+            return JsonResponse({'Status': False, 'Errors': 'Заказ не найден или не может быть отменён'}, status=404)
+        return JsonResponse({'Status': True})
+
 
 class ImportProductsView(APIView):
     """
-    View для запуска задачи импорта товаров
+    View для запуска задачи импорта товаров из загруженного файла.
+    Магазин задаётся параметром shop_id (для администраторов) или определяется по пользователю-магазину.
     """
 
     def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({"error": "Требуется аутентификация"}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.user.is_staff and request.data.get('shop_id'):
+            shop = Shop.objects.filter(id=request.data['shop_id']).first()
+        else:
+            shop = Shop.objects.filter(user_id=request.user.id).first()
+        if not shop:
+            return Response({"error": "Магазин не найден"}, status=status.HTTP_400_BAD_REQUEST)
+
         file = request.FILES.get('file')
         if file:
-            file_path = default_storage.save(file.name, file)
-            with open(file_path, 'r') as f:
-                yaml_data = f.read()
-
             # Запускаем асинхронную задачу
-            do_import.delay(yaml_data)
-            return Response({"status": "Импорт начат"}, status=status.HTTP_200_OK)
+            job = start_import(shop, 'file', file=file)
+            return Response({"status": "Импорт начат", "job": job.id}, status=status.HTTP_200_OK)
 
         return Response({"error": "Файл не найден"}, status=status.HTTP_400_BAD_REQUEST)
 
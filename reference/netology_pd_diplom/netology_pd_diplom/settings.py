@@ -160,6 +160,41 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Импорт прайс-листов: размер пачки для bulk_create/bulk_update
+IMPORT_BATCH_SIZE = env.int('IMPORT_BATCH_SIZE', default=1000)
+# diff - обновлять только изменившиеся товары, replace - удалять и загружать прайс-лист заново
+IMPORT_MODE = env('IMPORT_MODE', default='diff')
+# Загрузка прайс-листов по ссылке: таймауты соединения и чтения, общее время и максимальный размер
+IMPORT_CONNECT_TIMEOUT = env.int('IMPORT_CONNECT_TIMEOUT', default=10)
+IMPORT_READ_TIMEOUT = env.int('IMPORT_READ_TIMEOUT', default=60)
+IMPORT_FETCH_DEADLINE = env.int('IMPORT_FETCH_DEADLINE', default=15 * 60)
+IMPORT_MAX_FEED_SIZE = env.int('IMPORT_MAX_FEED_SIZE', default=500 * 1024 * 1024)
+# Максимальный размер прайс-листа после распаковки gzip/zstd
+IMPORT_MAX_UNPACKED_SIZE = env.int('IMPORT_MAX_UNPACKED_SIZE', default=5 * 1024 * 1024 * 1024)
+# Количество последних импортов в истории партнёра
+IMPORT_HISTORY_SIZE = 50
+# Параллельный импорт: не больше IMPORT_MAX_CONCURRENCY импортов одновременно, один импорт на магазин.
+# Задача, не получившая блокировку, повторяется через IMPORT_LOCK_RETRY_DELAY секунд (до IMPORT_LOCK_RETRIES раз)
+IMPORT_MAX_CONCURRENCY = env.int('IMPORT_MAX_CONCURRENCY', default=4)
+IMPORT_LOCK_TIMEOUT = env.int('IMPORT_LOCK_TIMEOUT', default=60 * 60)
+IMPORT_LOCK_RETRY_DELAY = env.int('IMPORT_LOCK_RETRY_DELAY', default=30)
+IMPORT_LOCK_RETRIES = env.int('IMPORT_LOCK_RETRIES', default=120)
+# Незавершённая задача импорта старше IMPORT_JOB_TIMEOUT секунд, магазин которой не заблокирован импортом,
+# брошена упавшим воркером: она помечается ошибкой и не мешает обновлению по расписанию
+IMPORT_JOB_TIMEOUT = env.int('IMPORT_JOB_TIMEOUT',
+                             default=max(IMPORT_LOCK_TIMEOUT, 2 * IMPORT_LOCK_RETRY_DELAY * IMPORT_LOCK_RETRIES))
+# Обновление прайс-листов по расписанию: к интервалу магазина добавляется случайная доля до IMPORT_REFRESH_JITTER,
+# после неудачных обновлений интервал удваивается, но не больше IMPORT_REFRESH_MAX_BACKOFF минут
+IMPORT_REFRESH_JITTER = env.float('IMPORT_REFRESH_JITTER', default=0.1)
+IMPORT_REFRESH_MAX_BACKOFF = env.int('IMPORT_REFRESH_MAX_BACKOFF', default=24 * 60)
+
+CELERY_BEAT_SCHEDULE = {
+    'refresh-feeds': {
+        'task': 'backend.tasks.refresh_feeds',
+        'schedule': 60.0,
+    },
+}
+
 EASY_THUMBNAILS_HIGH_RESOLUTION = True
 EASY_THUMBNAILS_QUALITY = 85
 EASY_THUMBNAILS_ALIASES = {
@@ -174,7 +209,7 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 40,
 
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
+        'backend.renderers.UJSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ),
 
@@ -195,6 +230,22 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# Каталог товаров: размер страницы по умолчанию и максимальный размер, который можно запросить в page_size
+PRODUCTS_PAGE_SIZE = env.int('PRODUCTS_PAGE_SIZE', default=REST_FRAMEWORK['PAGE_SIZE'])
+PRODUCTS_MAX_PAGE_SIZE = env.int('PRODUCTS_MAX_PAGE_SIZE', default=200)
+# История заказов покупателя и магазина: размер страницы по умолчанию и максимальный
+ORDERS_PAGE_SIZE = env.int('ORDERS_PAGE_SIZE', default=REST_FRAMEWORK['PAGE_SIZE'])
+ORDERS_MAX_PAGE_SIZE = env.int('ORDERS_MAX_PAGE_SIZE', default=200)
+# Поиск товаров: index - обратный индекс в таблице БД, postgres - полнотекстовый поиск PostgreSQL,
+# auto - postgres на PostgreSQL, иначе index
+SEARCH_BACKEND = env('SEARCH_BACKEND', default='auto')
+# Списки товаров и заказов собираются из .values() без ModelSerializer (см. backend.fast_serializers)
+FAST_SERIALIZATION = env.bool('FAST_SERIALIZATION', default=True)
+# Сколько секунд CDN и браузеры могут отдавать ответ каталога без перепроверки ETag
+CATALOG_CACHE_MAX_AGE = env.int('CATALOG_CACHE_MAX_AGE', default=60)
+# Сколько секунд хранится кеш ответов списка товаров (0 - не кешировать); устаревает при изменении каталога
+CATALOG_RESPONSE_CACHE_TIMEOUT = env.int('CATALOG_RESPONSE_CACHE_TIMEOUT', default=300)
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTHENTICATION_BACKENDS = (